@@ -0,0 +1,246 @@
+# ---
+# 檔名：admission_control.py
+# 目的：(Phase 6) 計畫執行前的准入控制 (admission control)：依 CBO 預測成本限制同時執行量，依優先權排隊 / 捨棄
+# 功能：
+#   1. 每種計畫 (PLAN_A / PLAN_B / PLAN_IVF) 各有一個「成本預算」(ms)：同時執行中的查詢，
+#      其 CBO 預測成本總和不能超過預算 (成本加權的 semaphore)。
+#      一個大範圍的計畫 A 掃描會佔掉很多預算，便宜的計畫 B 則幾乎不受影響 (各計畫的預算互相獨立)
+#   2. 預算不足時依優先權排隊 (數字越小越優先，同優先權先到先服務)；
+#      佇列已滿時，新請求若比佇列中最不重要的請求更優先，就把那一個擠掉，否則直接捨棄新請求；
+#      排隊超過 QUEUE_TIMEOUT_S 也捨棄。被捨棄的請求收到 Overloaded (服務回傳 503 + Retry-After)
+#   3. 准入後設定這個請求的 statement_timeout (預測成本 × STATEMENT_TIMEOUT_FACTOR，有上下限)，
+#      cbo_proxy 在執行 SQL 前以 SET LOCAL 套用，預測嚴重失準的查詢不會無限期佔住連線
+#   4. gauges()：佇列深度、執行中筆數 / 成本、准入 / 捨棄 / 逾時次數，輸出到 /metrics
+# 說明：
+#   沒有准入控制時，一波寬篩選被 CBO 導到計畫 A (暴力掃描) 會塞滿 Postgres，
+#   排在後面的便宜查詢也一起變慢；限制「昂貴的查詢同時跑幾個」，p99 才能在尖峰時維持穩定。
+#   設 CBO_ADMISSION_CONTROL=0 可關閉 (仍會套用 statement_timeout)。
+# ---
+
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# --- 1. 設定 ---
+ENABLE_ADMISSION_CONTROL = os.environ.get("CBO_ADMISSION_CONTROL", "1") == "1"
+
+# 各計畫同時執行中的預測成本總和上限 (ms)
+PLAN_BUDGETS_MS = {
+    "PLAN_A": float(os.environ.get("CBO_ADMISSION_BUDGET_PLAN_A_MS", "400")),
+    "PLAN_B": float(os.environ.get("CBO_ADMISSION_BUDGET_PLAN_B_MS", "1000")),
+    "PLAN_IVF": float(os.environ.get("CBO_ADMISSION_BUDGET_PLAN_IVF_MS", "400")),
+}
+MIN_COST_MS = 1.0           # 預測成本很小 (或未知) 的查詢至少佔這麼多預算，避免無限制地同時執行
+
+# 佇列
+MAX_QUEUE_DEPTH = int(os.environ.get("CBO_ADMISSION_MAX_QUEUE", "64"))
+QUEUE_TIMEOUT_S = float(os.environ.get("CBO_ADMISSION_QUEUE_TIMEOUT_S", "2.0"))
+RETRY_AFTER_S = 1
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+DEFAULT_PRIORITY = PRIORITIES["normal"]
+
+# statement_timeout = 預測成本 × STATEMENT_TIMEOUT_FACTOR，限制在 [MIN, MAX] 之間 (ms)；MAX 設 0 可關閉
+STATEMENT_TIMEOUT_FACTOR = 20.0
+STATEMENT_TIMEOUT_MIN_MS = 1000
+STATEMENT_TIMEOUT_MAX_MS = int(os.environ.get("CBO_STATEMENT_TIMEOUT_MAX_MS", "30000"))
+
+# Postgres 因 statement_timeout 取消查詢時的 SQLSTATE (query_canceled)
+QUERY_CANCELED = "57014"
+
+
+class Overloaded(Exception):
+    """請求在准入控制被捨棄 (佇列已滿、被更優先的請求擠掉、或排隊逾時)。"""
+
+    def __init__(self, plan, reason):
+        super().__init__(f"{plan} 負載過高，請稍後再試 ({reason})")
+        self.plan = plan
+        self.reason = reason
+        self.retry_after_s = RETRY_AFTER_S
+
+
+# --- 2. 模組狀態 ---
+class _Waiter:
+    __slots__ = ("priority", "seq", "weight", "state")
+
+    def __init__(self, priority, seq, weight):
+        self.priority = priority
+        self.seq = seq
+        self.weight = weight
+        self.state = "waiting"      # waiting -> admitted / shed
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _PlanGate:
+    """一種計畫的成本預算與等待佇列 (只在 _cond 內存取)。"""
+
+    def __init__(self, budget_ms):
+        self.budget_ms = budget_ms
+        self.in_flight = 0
+        self.in_flight_cost_ms = 0.0
+        self.waiters = []           # heap：(priority, seq) 最小的在最前面
+        self.counts = {"admitted": 0, "queued": 0, "shed": 0, "statement_timeouts": 0}
+
+
+_cond = threading.Condition()
+_gates = {plan: _PlanGate(budget) for plan, budget in PLAN_BUDGETS_MS.items()}
+_seq = itertools.count()
+_statement_timeout_ms = contextvars.ContextVar("statement_timeout_ms", default=None)
+
+
+def _gate(plan):
+    gate = _gates.get(plan)
+    if gate is None:
+        gate = _gates[plan] = _PlanGate(PLAN_BUDGETS_MS.get(plan, PLAN_BUDGETS_MS["PLAN_B"]))
+    return gate
+
+
+def _weight(gate, cost_ms):
+    # 超過整個預算的查詢以「整個預算」計：沒有其他查詢在執行時仍然可以單獨執行
+    return min(max(cost_ms or 0.0, MIN_COST_MS), gate.budget_ms)
+
+
+def _dispatch(gate):
+    """依優先權放行佇列最前面的請求，直到預算不足 (不跳過前面的大查詢，避免它永遠排不到)。"""
+    admitted = False
+    while gate.waiters:
+        head = gate.waiters[0]
+        if gate.in_flight and gate.in_flight_cost_ms + head.weight > gate.budget_ms:
+            break
+        heapq.heappop(gate.waiters)
+        head.state = "admitted"
+        gate.in_flight += 1
+        gate.in_flight_cost_ms += head.weight
+        gate.counts["admitted"] += 1
+        admitted = True
+    if admitted:
+        _cond.notify_all()
+
+
+def _remove_waiter(gate, waiter):
+    gate.waiters.remove(waiter)
+    heapq.heapify(gate.waiters)
+
+
+# --- 3. 准入 / 釋放 ---
+def acquire(plan, cost_ms, priority=DEFAULT_PRIORITY, timeout_s=QUEUE_TIMEOUT_S):
+    """取得執行許可，回傳佔用的預算 (交給 release)；被捨棄時拋出 Overloaded。"""
+    with _cond:
+        gate = _gate(plan)
+        weight = _weight(gate, cost_ms)
+        if not gate.waiters and (gate.in_flight == 0 or gate.in_flight_cost_ms + weight <= gate.budget_ms):
+            gate.in_flight += 1
+            gate.in_flight_cost_ms += weight
+            gate.counts["admitted"] += 1
+            return weight
+
+        waiter = _Waiter(priority, next(_seq), weight)
+        if len(gate.waiters) >= MAX_QUEUE_DEPTH:
+            victim = max(gate.waiters)
+            if not waiter < victim:
+                gate.counts["shed"] += 1
+                raise Overloaded(plan, "queue_full")
+            _remove_waiter(gate, victim)
+            victim.state = "shed"
+            gate.counts["shed"] += 1
+            _cond.notify_all()
+
+        heapq.heappush(gate.waiters, waiter)
+        gate.counts["queued"] += 1
+        deadline = time.monotonic() + timeout_s
+        while waiter.state == "waiting":
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                _remove_waiter(gate, waiter)
+                gate.counts["shed"] += 1
+                # 自己離開佇列後，後面較小的請求可能放得進去
+                _dispatch(gate)
+                raise Overloaded(plan, "queue_timeout")
+            _cond.wait(remaining)
+        if waiter.state == "shed":
+            raise Overloaded(plan, "preempted")
+        return weight
+
+
+def release(plan, weight):
+    with _cond:
+        gate = _gate(plan)
+        gate.in_flight -= 1
+        gate.in_flight_cost_ms = max(0.0, gate.in_flight_cost_ms - weight)
+        _dispatch(gate)
+
+
+def statement_timeout_for(cost_ms):
+    if STATEMENT_TIMEOUT_MAX_MS <= 0:
+        return None
+    timeout_ms = (cost_ms or 0.0) * STATEMENT_TIMEOUT_FACTOR
+    return int(min(STATEMENT_TIMEOUT_MAX_MS, max(STATEMENT_TIMEOUT_MIN_MS, timeout_ms)))
+
+
+def current_statement_timeout_ms():
+    """目前請求的 statement_timeout (ms)；不在 admit() 區塊內時回傳 None。"""
+    return _statement_timeout_ms.get()
+
+
+@contextmanager
+def admit(plan, cost_ms, priority=DEFAULT_PRIORITY):
+    """
+    包住一次計畫執行：等待准入 (記錄在 tracing 的 admission_wait 階段)，
+    區塊內的 SQL 套用依預測成本換算的 statement_timeout。
+    """
+    weight = None
+    if ENABLE_ADMISSION_CONTROL:
+        with tracing.stage("admission_wait"):
+            weight = acquire(plan, cost_ms, priority)
+    token = _statement_timeout_ms.set(statement_timeout_for(cost_ms))
+    try:
+        yield
+    finally:
+        _statement_timeout_ms.reset(token)
+        if weight is not None:
+            release(plan, weight)
+
+
+def record_statement_timeout(plan):
+    """執行器捕捉到 statement_timeout 取消查詢 (SQLSTATE 57014) 時呼叫。"""
+    with _cond:
+        _gate(plan).counts["statement_timeouts"] += 1
+
+
+# --- 4. 指標 ---
+def stats():
+    with _cond:
+        return {
+            plan: {
+                "budget_ms": gate.budget_ms,
+                "queue_depth": len(gate.waiters),
+                "in_flight": gate.in_flight,
+                "in_flight_cost_ms": gate.in_flight_cost_ms,
+                **gate.counts,
+            }
+            for plan, gate in _gates.items()
+        }
+
+
+def gauges():
+    """把准入控制的狀態輸出成 Prometheus gauge (tracing.render_prometheus 的 extra_gauges)。"""
+    result = {}
+    for plan, values in stats().items():
+        suffix = plan.lower()
+        result[f"admission_queue_depth_{suffix}"] = values["queue_depth"]
+        result[f"admission_in_flight_{suffix}"] = values["in_flight"]
+        result[f"admission_in_flight_cost_ms_{suffix}"] = values["in_flight_cost_ms"]
+        for key in ("admitted", "queued", "shed", "statement_timeouts"):
+            result[f"admission_{key}_{suffix}"] = values[key]
+    return result
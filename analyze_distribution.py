@@ -4,6 +4,11 @@
 #      在 'finalize_database.py' 執行完畢後，執行此腳本。
 #      用來「親眼驗證」我們資料庫中的資料分佈，
 #      這能幫助我們「預測」CBO 在 Phase 3 會如何決策。
+# 說明：
+#      直方圖、分位數與品牌排行都在資料庫端彙總 (width_bucket / percentile_cont / GROUP BY)，
+#      只把彙總後的幾百列傳回來，1000 萬筆的目錄也不會把整張表讀進記憶體。
+#      sample_rows() 以 TABLESAMPLE 抽樣 (不必 ORDER BY random() 排序整張表)，
+#      向量以 vector_send 二進位、server-side cursor 分批讀取；test.ipynb 的降維視覺化也使用它。
 # ---
 
 # --- 1. 匯入必要的函式庫 ---
@@ -14,6 +19,10 @@ import os                     # 用於讀取系統環境變數
 from dotenv import load_dotenv  # 用於讀取 .env 檔案中的密碼
 import time                   # 用於計算腳本執行時間
 import sys                    # 用於在 .env 檢查失敗時退出腳本
+import numpy as np              # 用於組合抽樣的向量矩陣
+from psycopg2 import sql        # 用於安全地組合 SQL (欄位名稱、抽樣比例)
+
+import embedding_store        # 向量的二進位解碼與 server-side cursor 分批讀取
 
 # --- 2. 載入設定 ---
 
@@ -29,6 +38,16 @@ DB_SETTINGS = {
     "database": os.environ.get("DB_NAME") # 應為 "db_project"
 }
 
+# 價格直方圖的範圍與分桶數 (>= 10000 視為極端值，0 元通常是錯誤資料)
+PRICE_MIN = 0
+PRICE_MAX = 10000
+PRICE_BINS = 100
+TOP_BRANDS = 30
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+# TABLESAMPLE 的抽樣比例會多抽一些，再於客戶端隨機挑出 n_rows 筆，避免抽到的資料列不足
+SAMPLE_OVERSAMPLE = 1.5
+
 # --- 3. [輔助函式] 檢查環境變數 ---
 def check_env_vars():
     """
@@ -58,61 +77,166 @@ def check_env_vars():
     print(f"    [成功] 所有環境變數均已載入 (DB_USER: {DB_SETTINGS['user']}, DB_NAME: {DB_SETTINGS['database']})。")
     return True
 
-# --- 4. [主函式] ---
+# --- 4. [彙總查詢] 全部在資料庫端計算，只傳回彙總結果 ---
+def fetch_price_histogram(cursor, n_bins=PRICE_BINS, lo=PRICE_MIN, hi=PRICE_MAX):
+    """
+    以 width_bucket 在資料庫端計算價格直方圖 (只計入 lo < sales_price < hi)。
+    回傳 DataFrame：bin_start, bin_end, count (沒有資料的桶補 0)。
+    """
+    cursor.execute("""
+        SELECT width_bucket(sales_price, %s, %s, %s) AS bucket, COUNT(*)
+        FROM products
+        WHERE sales_price > %s AND sales_price < %s
+        GROUP BY bucket
+        ORDER BY bucket;
+    """, (lo, hi, n_bins, lo, hi))
+    counts = dict(cursor.fetchall())
+    width = (hi - lo) / n_bins
+    buckets = range(1, n_bins + 1)
+    return pd.DataFrame({
+        "bin_start": [lo + (b - 1) * width for b in buckets],
+        "bin_end": [lo + b * width for b in buckets],
+        "count": [counts.get(b, 0) for b in buckets],
+    })
+
+
+def fetch_quantiles(cursor, column, fractions=QUANTILES):
+    """以 percentile_cont 計算數值欄位的分位數，並回傳有值 / 空值的筆數。"""
+    cursor.execute(sql.SQL("""
+        SELECT percentile_cont(%s::float8[]) WITHIN GROUP (ORDER BY {col}),
+               COUNT({col}), COUNT(*) - COUNT({col})
+        FROM products;
+    """).format(col=sql.Identifier(column)), (fractions,))
+    values, n_valid, n_null = cursor.fetchone()
+    return {"quantiles": dict(zip(fractions, values or [])), "n_valid": n_valid, "n_null": n_null}
+
+
+def fetch_value_counts(cursor, column, limit=None):
+    """以 GROUP BY 計算欄位每個值的筆數 (由多到少)；limit 為 None 時回傳全部。"""
+    cursor.execute(sql.SQL("""
+        SELECT {col} AS value, COUNT(*) AS count
+        FROM products
+        GROUP BY {col}
+        ORDER BY count DESC
+        {limit};
+    """).format(
+        col=sql.Identifier(column),
+        limit=sql.SQL("LIMIT {}").format(sql.Literal(limit)) if limit else sql.SQL(""),
+    ))
+    return pd.DataFrame(cursor.fetchall(), columns=["value", "count"])
+
+
+# --- 5. [抽樣] TABLESAMPLE + 二進位向量 + server-side cursor ---
+def sample_rows(conn, n_rows, method="SYSTEM", seed=None, with_embedding=True,
+                columns=("uniq_id", "product_name", "brand", "sales_price", "rating")):
+    """
+    抽樣約 n_rows 筆有向量的資料，回傳 (DataFrame, 向量矩陣 (n, 768) 或 None)。
+    method="SYSTEM"：以資料頁為單位抽樣，只讀取被抽到的頁 (最快，但同一頁的資料會一起出現)；
+    method="BERNOULLI"：逐列抽樣，分佈較均勻，但仍要掃過每一頁。
+    seed 不為 None 時加上 REPEATABLE，每次抽到相同的資料。
+    conn 不可為 autocommit (named cursor 需要在交易內)。
+    """
+    method = method.upper()
+    if method not in ("SYSTEM", "BERNOULLI"):
+        raise ValueError(f"不支援的抽樣方式：{method}")
+
+    # 以 pg_class.reltuples (ANALYZE 的估計值) 換算抽樣比例，不必 COUNT(*)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = 'products'::regclass;")
+        total_rows = max(int(cursor.fetchone()[0]), 1)
+    percent = min(100.0, 100.0 * n_rows * SAMPLE_OVERSAMPLE / total_rows)
+
+    select_list = sql.SQL(", ").join(sql.Identifier(c) for c in columns)
+    if with_embedding:
+        select_list = select_list + sql.SQL(", vector_send(embedding)")
+    query = sql.SQL("""
+        SELECT {select_list}
+        FROM products TABLESAMPLE {method} ({percent}) {repeatable}
+        WHERE embedding IS NOT NULL;
+    """).format(
+        select_list=select_list,
+        method=sql.SQL(method),
+        percent=sql.Literal(percent),
+        repeatable=sql.SQL("REPEATABLE ({})").format(sql.Literal(seed)) if seed is not None else sql.SQL(""),
+    )
+
+    records, vectors = [], []
+    for rows in embedding_store.iter_rows(conn, query, cursor_name="distribution_sample"):
+        for row in rows:
+            if with_embedding:
+                records.append(row[:-1])
+                vectors.append(embedding_store.decode_vector(row[-1]))
+            else:
+                records.append(row)
+    conn.commit()
+
+    # 抽樣結果依資料頁的實體順序回傳：在 SQL 端 LIMIT 會固定丟掉表尾 (較新匯入) 的資料。
+    # 改為全部取回後以同一個 seed 隨機挑出 n_rows 筆 (保留原本的相對順序)
+    if len(records) > n_rows:
+        keep = np.sort(np.random.default_rng(seed).choice(len(records), size=n_rows, replace=False))
+        records = [records[i] for i in keep]
+        if with_embedding:
+            vectors = [vectors[i] for i in keep]
+
+    df = pd.DataFrame(records, columns=list(columns))
+    embeddings = np.vstack(vectors) if vectors else None
+    return df, embeddings
+
+
+# --- 6. [主函式] ---
 def analyze_distribution():
     """
-    連線到資料庫，讀取 CBO 相關欄位，並繪製分佈直方圖。
+    連線到資料庫，在資料庫端彙總 CBO 相關欄位的分佈，並繪製分佈直方圖。
     """
     conn = None # 初始化連線變數
     try:
-        # --- 5. 連線並讀取「所有」CBO 相關欄位 ---
+        # --- 6.1 連線 ---
         print(f"\n步驟 2/5：正在連線至資料庫 '{DB_SETTINGS['database']}'...")
         conn = psycopg2.connect(**DB_SETTINGS)
-        
-        # [關鍵] 為了 CBO 分析，我們需要「全部」的資料，而不只是抽樣
-        # [優化] 我們「只」讀取 CBO (盾) 需要的「結構化」欄位。
-        #       我們「不需要」讀取 `embedding` (矛) 欄位，這會讓這個查詢快非常多！
-        query = "SELECT brand, sales_price, rating, amazon_prime_y_or_n FROM products;"
-        
-        
+        cursor = conn.cursor()
+
+        # --- 6.2 在資料庫端彙總 ---
+        # [優化] 不再把整張表讀進 pandas：直方圖 / 分位數 / 排行都在資料庫端算好，
+        #       只傳回幾百列彙總結果，目錄有 1000 萬筆也一樣快。
+        print("\n步驟 3/5：正在資料庫端計算直方圖、分位數與品牌排行...")
         start_time = time.time()
-        # 'pandas.read_sql_query' 是一個超棒的函式，
-        # 它會自動執行 query，並將「所有」結果直接打包成一個 DataFrame (df)。
-        df = pd.read_sql_query(query, conn)
+        price_hist = fetch_price_histogram(cursor)
+        price_stats = fetch_quantiles(cursor, "sales_price")
+        rating_stats = fetch_quantiles(cursor, "rating")
+        top_brands = fetch_value_counts(cursor, "brand", TOP_BRANDS + 1) # 多取一筆，排除空品牌後仍有 30 個
+        rating_counts = fetch_value_counts(cursor, "rating", 10)
+        prime_counts = fetch_value_counts(cursor, "amazon_prime_y_or_n")
+        conn.commit()
         end_time = time.time()
-        
-        print(f"    [成功] 成功讀取 {len(df)} 筆資料。花費時間：{end_time - start_time:.2f} 秒。")
-
-        # --- 6. 資料清理 ---
-        print("\n步驟 4/5：正在清理資料 (填補空值)...")
-        
-        # .fillna(0.0) 會將所有 None/NaN (空值) 替換為 0.0
-        # `errors='coerce'` 會將無法轉換的價格（例如空字串）變為 NaN，然後再被 fillna 捕捉
-        # 這是為了避免 'plot_3d' 中發生的 TypeError
-        df['sales_price'] = pd.to_numeric(df['sales_price'], errors='coerce').fillna(0.0)
-        df['brand'] = df['brand'].fillna('N/A') # 將空品牌設為 'N/A' 字串
-        df['rating'] = pd.to_numeric(df['rating'], errors='coerce').fillna(0.0)
-        df['amazon_prime_y_or_n'] = df['amazon_prime_y_or_n'].fillna('N')
-        print("    [成功] 資料清理完畢。")
+        print(f"    [成功] 彙總完成。花費時間：{end_time - start_time:.2f} 秒。")
+
+        # --- 6.3 印出分位數與類別欄位 ---
+        print("\n步驟 4/5：分位數與類別欄位摘要")
+        for name, stats in (("sales_price", price_stats), ("rating", rating_stats)):
+            print(f"    {name}：{stats['n_valid']} 筆有值，{stats['n_null']} 筆為空")
+            for q, value in stats["quantiles"].items():
+                print(f"      P{q * 100:g} = {'(無)' if value is None else f'{value:.2f}'}")
+        for name, counts in (("amazon_prime_y_or_n", prime_counts), ("rating (前 10)", rating_counts)):
+            print(f"    {name}：" + ", ".join(
+                f"{'N/A' if value is None else value}={count}" for value, count in counts.itertuples(index=False)))
 
         # --- 7. 繪製「價格 (sales_price)」直方圖 ---
         # 這是 CBO「預測」`WHERE price < 5000` 的依據
         print("\n步驟 5/5：正在生成互動式圖表...")
         print("    正在生成 'sales_price' 直方圖...")
-        
-        # 我們將價格 > 10000 的視為極端值 (outliers)，暫時濾掉以便觀察
+
+        # 我們將價格 >= 10000 的視為極端值 (outliers)，並且濾掉 0 元的商品（通常是錯誤資料或免費商品）
         # (PostgreSQL 的 `ANALYZE` 在建立直方圖時也會做類似的「離群值」處理)
-        # 並且濾掉 0 元的商品（通常是錯誤資料或免費商品）
-        df_filtered_price = df[ (df['sales_price'] < 10000) & (df['sales_price'] > 0) ] 
-        
-        # 使用 Plotly Express (px) 快速繪圖
-        fig_price = px.histogram(
-            df_filtered_price, 
-            x="sales_price",    # X 軸使用 'sales_price' 欄位
-            nbins=100,          # 將價格切成 100 個「長條」
-            title="商品價格分佈直方圖 (sales_price) [已過濾 0 元與 >5000 元]"
+        # 每個長條的筆數已經由 width_bucket 算好，這裡直接畫長條圖
+        fig_price = px.bar(
+            price_hist,
+            x="bin_start",      # X 軸：每個區間的起點
+            y="count",
+            title=f"商品價格分佈直方圖 (sales_price) [已過濾 0 元與 >={PRICE_MAX} 元]"
         )
-        
+        fig_price.update_traces(width=(PRICE_MAX - PRICE_MIN) / PRICE_BINS, offset=0) # 長條填滿整個區間
+        fig_price.update_xaxes(title="sales_price")
+
         # 儲存為 HTML 檔案
         price_output_file = "price_histogram.html"
         fig_price.write_html(price_output_file)
@@ -121,23 +245,23 @@ def analyze_distribution():
 
         # --- 8. 繪製「品牌 (brand)」直方圖 ---
         # 這是 CBO「預測」`WHERE brand = 'Gucci'` 的依據
-        print("    正在生成 'brand' 直方圖 (Top 30)...")
-        
-        # 計算前 30 大的品牌 (我們排除 'N/A'，因為它不是一個真實品牌)
-        top_30_brands = df[df['brand'] != 'N/A']['brand'].value_counts().nlargest(30).index
-        df_top_brands = df[df['brand'].isin(top_30_brands)]
-        
-        fig_brand = px.histogram(
-            df_top_brands, 
-            x="brand", # X 軸使用 'brand' 欄位
-            title="商品品牌分佈直方圖 (Top 30 品牌)"
-        ).update_xaxes(categoryorder="total descending") # 讓圖表從「最多」排到「最少」
-        
+        print(f"    正在生成 'brand' 直方圖 (Top {TOP_BRANDS})...")
+
+        # 前 30 大的品牌 (我們排除空品牌，因為它不是一個真實品牌)
+        top_brands = top_brands[top_brands["value"].notnull()].head(TOP_BRANDS)
+
+        fig_brand = px.bar(
+            top_brands,
+            x="value", # X 軸使用品牌名稱
+            y="count",
+            title=f"商品品牌分佈直方圖 (Top {TOP_BRANDS} 品牌)"
+        ).update_xaxes(title="brand", categoryorder="total descending") # 讓圖表從「最多」排到「最少」
+
         # 儲存為 HTML
         brand_output_file = "brand_histogram.html"
         fig_brand.write_html(brand_output_file)
         print(f"    【成功！】已儲存品牌直方圖： {brand_output_file}")
-        
+
         print("\n" + "="*40)
         print("【分析完畢】")
         print("請在瀏覽器中開啟 .html 檔案，查看 CBO 的『大腦食物』。")
@@ -0,0 +1,355 @@
+# ---
+# 檔名：benchmark_workload.py
+# 目的：(Phase 5) 混合搜尋路徑的「工作負載重播」效能基準測試
+# 功能：
+#   1. generate：產生合成工作負載 (JSONL)，篩選條件涵蓋從極稀有到不篩選的各種選擇率
+#   2. run：以指定的並行度重播工作負載，呼叫 cbo_proxy.hybrid_search，
+#      報告 QPS、p50/p95/p99 延遲、計畫選擇分佈與各計畫延遲、被准入控制捨棄 (shed) 的次數與原因，並寫出 JSON 結果
+#   3. compare：比較兩次 run 的 JSON 結果 (例如兩個 commit)，延遲退步超過門檻就以非 0 結束
+# 工作負載格式 (每行一個 JSON)：
+#   {"image": "img/xxx.jpg" 或 "catalog_id": "...", "text": "red color", "filter": "price < 500",
+#    "target_selectivity": 0.01}
+# 執行方式：
+#   python benchmark_workload.py generate --count 500 --out workload.jsonl
+#   python benchmark_workload.py run --workload workload.jsonl --concurrency 8 --out bench_HEAD.json
+#   python benchmark_workload.py compare bench_main.json bench_HEAD.json
+# ---
+
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+DB_SETTINGS = {
+    "host": os.environ.get("DB_HOST"),
+    "port": os.environ.get("DB_PORT"),
+    "user": os.environ.get("DB_USER"),
+    "password": os.environ.get("DB_PASSWORD"),
+    "database": os.environ.get("DB_NAME")
+}
+
+# 合成工作負載的目標選擇率 (1.0 代表不篩選)
+TARGET_SELECTIVITIES = [0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0]
+MODIFICATION_TEXTS = ["", "red color", "black", "long", "casual", "floral pattern", "short sleeve"]
+
+# compare 時，p50/p95/p99 或 QPS 退步超過這個比例就視為 regression
+REGRESSION_THRESHOLD = 0.10
+
+
+# --- 1. 產生合成工作負載 ---
+def _price_quantiles(cursor, n_points=201):
+    """在資料庫端計算價格分位數 (0%, 0.5%, ..., 100%)，不需要把整欄讀回來。"""
+    fractions = [i / (n_points - 1) for i in range(n_points)]
+    cursor.execute(
+        "SELECT percentile_cont(%s::float8[]) WITHIN GROUP (ORDER BY sales_price) "
+        "FROM products WHERE sales_price IS NOT NULL;",
+        (fractions,)
+    )
+    return fractions, [float(v) for v in cursor.fetchone()[0]]
+
+
+def _price_filter_for(selectivity, fractions, quantiles):
+    """隨機挑一段涵蓋約 selectivity 比例資料的價格區間。"""
+    span = max(1, int(round(selectivity * (len(fractions) - 1))))
+    start = random.randint(0, len(fractions) - 1 - span)
+    low, high = quantiles[start], quantiles[start + span]
+    if high <= low:
+        high = low + 1
+    return f"price BETWEEN {int(low)} AND {int(high + 0.999)}"
+
+
+def _brand_filters(cursor, total_rows):
+    """
+    依品牌的出現頻率分組，回傳 {目標選擇率: [品牌, ...]}。
+    只保留 query_parser.get_sql_filter 解析得了的品牌名稱 (英數字與空白)。
+    """
+    cursor.execute("""
+        SELECT brand, COUNT(*) FROM products
+        WHERE brand ~ '^[A-Za-z0-9 ]+$'
+        GROUP BY brand;
+    """)
+    by_selectivity = defaultdict(list)
+    for brand, count in cursor.fetchall():
+        selectivity = count / total_rows
+        nearest = min(TARGET_SELECTIVITIES, key=lambda s: abs(np.log(s) - np.log(selectivity)))
+        by_selectivity[nearest].append(brand.strip())
+    return by_selectivity
+
+
+def generate_workload(count, out_path, seed=42):
+    random.seed(seed)
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_SETTINGS)
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT COUNT(*) FROM products;")
+        total_rows = cursor.fetchone()[0]
+        fractions, quantiles = _price_quantiles(cursor)
+        brands = _brand_filters(cursor, total_rows)
+
+        # 查詢的「基準商品」：隨機抽樣 (TABLESAMPLE 不需要排序整張表)
+        cursor.execute(
+            "SELECT uniq_id FROM products TABLESAMPLE BERNOULLI (%s) WHERE embedding IS NOT NULL;",
+            (min(100.0, max(0.1, 100.0 * count * 2 / max(total_rows, 1))),)
+        )
+        catalog_ids = [row[0] for row in cursor.fetchall()]
+        if not catalog_ids:
+            print("❌ 資料表中沒有可用的商品向量。")
+            return
+    finally:
+        if conn:
+            conn.close()
+
+    with open(out_path, "w", encoding="utf-8") as f:
+        for _ in range(count):
+            selectivity = random.choice(TARGET_SELECTIVITIES)
+            if selectivity >= 1.0:
+                filter_text = ""
+            elif brands.get(selectivity) and random.random() < 0.3:
+                filter_text = f"brand {random.choice(brands[selectivity])}"
+            else:
+                filter_text = _price_filter_for(selectivity, fractions, quantiles)
+            entry = {
+                "catalog_id": random.choice(catalog_ids),
+                "text": random.choice(MODIFICATION_TEXTS),
+                "filter": filter_text,
+                "target_selectivity": selectivity,
+            }
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    print(f"✅ 已產生 {count} 筆查詢：{out_path}")
+
+
+# --- 2. 重播 ---
+def load_workload(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _prepare_queries(workload):
+    """
+    事先把每個查詢轉成 (查詢向量, SQL 篩選)。
+    CLIP 編碼不在被量測的範圍內 (除非 --include-encode)，讓結果反映的是「資料庫 + CBO」的效能。
+    """
+    import cbo_proxy
+    import query_parser
+
+    prepared = []
+    for entry in workload:
+        if entry.get("catalog_id"):
+            v_img = cbo_proxy.get_product_embedding(entry["catalog_id"])
+            v_query = None if v_img is None else query_parser.compose_query_vector(v_img, entry.get("text"))
+        else:
+            v_query = query_parser.get_query_vector(entry["image"], entry.get("text"))
+        if v_query is None:
+            continue
+        filter_text = entry.get("filter") or ""
+        sql_filter = query_parser.get_sql_filter(filter_text) if filter_text else "1 = 1"
+        prepared.append((entry, v_query, sql_filter))
+    return prepared
+
+
+def _percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    arr = np.asarray(values)
+    return {
+        "p50": float(np.percentile(arr, 50)),
+        "p95": float(np.percentile(arr, 95)),
+        "p99": float(np.percentile(arr, 99)),
+        "mean": float(arr.mean()),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def run_benchmark(workload_path, concurrency, iterations, warmup, use_cache, include_encode, out_path):
+    import admission_control
+    import cbo_proxy
+    import query_parser
+
+    workload = load_workload(workload_path)
+    cbo_proxy.init_pool(min(4, concurrency), concurrency)
+
+    print(f"🚀 載入 {len(workload)} 筆查詢，預先計算查詢向量...")
+    prepared = _prepare_queries(workload)
+    if not prepared:
+        print("❌ 沒有可執行的查詢。")
+        return None
+
+    def _one(item):
+        entry, v_query, sql_filter = item
+        start = time.perf_counter()
+        if include_encode:
+            if entry.get("image"):
+                v_query = query_parser.get_query_vector(entry["image"], entry.get("text"))
+            sql_filter = query_parser.get_sql_filter(entry.get("filter") or "") if entry.get("filter") else "1 = 1"
+        try:
+            outcome = cbo_proxy.hybrid_search(v_query, sql_filter, use_cache=use_cache)
+        except admission_control.Overloaded as e:
+            # 被准入控制捨棄：記為 shed (附原因)，不中斷整次重播，也不列入延遲統計
+            outcome = {"plan": e.plan, "results": [], "cache_hit": False, "shed": e.reason}
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        return entry, outcome, elapsed_ms
+
+    # 暖機：讓連線池、快取頁面、模型都就緒，不列入統計
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(_one, prepared[:warmup]))
+
+    schedule = prepared * iterations
+    print(f"⏱️  重播 {len(schedule)} 筆查詢 (並行度 {concurrency})...")
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(_one, schedule))
+    wall_s = time.perf_counter() - wall_start
+
+    shed_reasons = Counter(outcome["shed"] for _, outcome, _ in outcomes if "shed" in outcome)
+    served = [item for item in outcomes if "shed" not in item[1]]
+    latencies = [ms for _, _, ms in served]
+    plan_counts = Counter(outcome["plan"] for _, outcome, _ in served)
+    per_plan = defaultdict(list)
+    per_selectivity = defaultdict(list)
+    for entry, outcome, ms in served:
+        per_plan[outcome["plan"]].append(ms)
+        per_selectivity[str(entry.get("target_selectivity"))].append(ms)
+
+    report = {
+        "git_commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "workload": os.path.abspath(workload_path),
+            "queries": len(prepared),
+            "iterations": iterations,
+            "concurrency": concurrency,
+            "use_cache": use_cache,
+            "include_encode": include_encode,
+        },
+        "summary": {
+            "requests": len(outcomes),
+            "wall_seconds": wall_s,
+            "qps": len(served) / wall_s if wall_s > 0 else None,   # 只計實際執行的請求 (被捨棄的不算吞吐量)
+            "latency_ms": _percentiles(latencies),
+            "empty_results": sum(1 for _, outcome, _ in served if not outcome["results"]),
+            "cache_hits": sum(1 for _, outcome, _ in served if outcome["cache_hit"]),
+            "shed": len(outcomes) - len(served),
+            "shed_reasons": dict(shed_reasons),
+        },
+        "plan_distribution": {plan: count / len(served) for plan, count in plan_counts.items()},
+        "per_plan_latency_ms": {plan: _percentiles(values) for plan, values in per_plan.items()},
+        "per_selectivity_latency_ms": {sel: _percentiles(values) for sel, values in per_selectivity.items()},
+    }
+
+    print_report(report)
+    if out_path:
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 結果已寫入 {out_path}")
+    cbo_proxy.close_pool()
+    return report
+
+
+def print_report(report):
+    summary = report["summary"]
+    lat = summary["latency_ms"]
+    print("\n" + "=" * 60)
+    print("📊 Benchmark 結果")
+    print("=" * 60)
+    print(f"請求數: {summary['requests']}   QPS: {summary['qps']:.1f}")
+    if lat["p50"] is not None:
+        print(f"延遲 (ms): p50={lat['p50']:.2f}  p95={lat['p95']:.2f}  p99={lat['p99']:.2f}")
+    print(f"空結果: {summary['empty_results']}   快取命中: {summary['cache_hits']}")
+    if summary.get("shed"):
+        reasons = ", ".join(f"{reason}={count}" for reason, count in sorted(summary["shed_reasons"].items()))
+        print(f"⚠️  被准入控制捨棄: {summary['shed']} ({reasons})，不列入延遲統計")
+    print("\n計畫選擇分佈與延遲：")
+    for plan, share in sorted(report["plan_distribution"].items()):
+        p = report["per_plan_latency_ms"][plan]
+        print(f"  {plan:<10} {share * 100:6.1f}%   p50={p['p50']:.2f}  p95={p['p95']:.2f}  p99={p['p99']:.2f}")
+    print("=" * 60)
+
+
+# --- 3. 比較兩次結果 ---
+def compare_reports(baseline_path, candidate_path, threshold=REGRESSION_THRESHOLD):
+    """回傳是否有 regression。"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(candidate_path, "r", encoding="utf-8") as f:
+        candidate = json.load(f)
+
+    regressions = []
+    print(f"{'指標':<20} | {'baseline':>10} | {'candidate':>10} | {'變化':>8}")
+    print("-" * 60)
+
+    def _check(name, old, new, higher_is_better=False):
+        if old is None or new is None or old == 0:
+            return
+        change = (new - old) / old
+        worse = change < -threshold if higher_is_better else change > threshold
+        flag = " ⚠️" if worse else ""
+        print(f"{name:<20} | {old:>10.2f} | {new:>10.2f} | {change * 100:>+7.1f}%{flag}")
+        if worse:
+            regressions.append(name)
+
+    _check("qps", baseline["summary"]["qps"], candidate["summary"]["qps"], higher_is_better=True)
+    for key in ("p50", "p95", "p99"):
+        _check(f"latency_{key}", baseline["summary"]["latency_ms"][key], candidate["summary"]["latency_ms"][key])
+    for plan in sorted(set(baseline["per_plan_latency_ms"]) & set(candidate["per_plan_latency_ms"])):
+        _check(f"{plan}_p95", baseline["per_plan_latency_ms"][plan]["p95"],
+               candidate["per_plan_latency_ms"][plan]["p95"])
+
+    if regressions:
+        print(f"\n❌ 效能退步：{', '.join(regressions)}")
+    else:
+        print("\n✅ 沒有超過門檻的效能退步。")
+    return bool(regressions)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="混合搜尋工作負載重播 benchmark")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="產生合成工作負載")
+    gen.add_argument("--count", type=int, default=500)
+    gen.add_argument("--out", default="workload.jsonl")
+    gen.add_argument("--seed", type=int, default=42)
+
+    run = sub.add_parser("run", help="重播工作負載")
+    run.add_argument("--workload", default="workload.jsonl")
+    run.add_argument("--concurrency", type=int, default=8)
+    run.add_argument("--iterations", type=int, default=1, help="整份工作負載重播幾輪")
+    run.add_argument("--warmup", type=int, default=20, help="暖機查詢數 (不列入統計)")
+    run.add_argument("--use-cache", action="store_true", help="啟用結果快取 (預設關閉，量測真實執行成本)")
+    run.add_argument("--include-encode", action="store_true", help="把 CLIP 編碼與篩選解析也列入量測")
+    run.add_argument("--out", default=None, help="JSON 結果輸出路徑")
+
+    cmp_parser = sub.add_parser("compare", help="比較兩次 run 的結果")
+    cmp_parser.add_argument("baseline")
+    cmp_parser.add_argument("candidate")
+    cmp_parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    if args.command == "generate":
+        generate_workload(args.count, args.out, args.seed)
+    elif args.command == "run":
+        run_benchmark(args.workload, args.concurrency, args.iterations, args.warmup,
+                      args.use_cache, args.include_encode, args.out)
+    else:
+        sys.exit(1 if compare_reports(args.baseline, args.candidate, args.threshold) else 0)
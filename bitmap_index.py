@@ -0,0 +1,249 @@
+# ---
+# 檔名：bitmap_index.py
+# 目的：(Phase 6) 記憶體內的屬性 bitmap 索引：對任何可解析的 AND 篩選條件給出「精確」的符合筆數
+# 功能：
+#   1. 只讀取 products 的篩選欄位 (不含向量) 建立：
+#        - brand：每個品牌一個已排序的 row 編號清單 (posting list；品牌數很多時比每個品牌一個 bitmap 省記憶體)
+#        - amazon_prime_y_or_n：每個原始值 (區分大小寫，不含 NULL) 一個 bitmap
+#        - sales_price / rating：依值排序的 row 編號 + 等筆數分桶的 bitmap；
+#          範圍條件 = 完整覆蓋的桶做 OR + 邊界桶以排序後的實際值精確補齊 (boundary refinement)
+#   2. count(sql_filter)：解析條件 (embedding_store.parse_sql_filter)，AND 各條件的 bitmap 後計算 1 的個數；
+#      只有單一條件時直接由排序位置 / posting list 長度得到筆數，不需要組 bitmap
+#   3. 以 catalog 版本號判斷過期；過期時在背景執行緒重建，重建完成前呼叫端退回 EXPLAIN 預估。
+#      匯入期間版本號持續遞增，兩次重建之間至少間隔 REBUILD_MIN_INTERVAL_S；重建失敗後以指數退避重試
+# 說明：
+#   inspect_db_stats.py 顯示 Postgres 的 Plan Rows 對相關條件 / 窄區間的誤差很大；
+#   精確筆數讓 CBO 在「篩選筆數」這一側不會再選錯。
+# ---
+
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+import embedding_store
+
+logger = logging.getLogger(__name__)
+
+N_BUCKETS = 64          # 數值欄位的分桶數
+CHUNK_SIZE = 50000
+
+# 已有索引時，兩次背景重建之間的最短間隔 (秒)：匯入時每一批都會遞增版本號，不能每次都全表重建
+REBUILD_MIN_INTERVAL_S = float(os.environ.get("CBO_BITMAP_REBUILD_INTERVAL_S", "30"))
+# 重建失敗 (例如資料庫暫時無法連線) 後的重試間隔：RETRY_BACKOFF_S × 2^(連續失敗次數 - 1)，最多 RETRY_BACKOFF_MAX_S
+RETRY_BACKOFF_S = 5.0
+RETRY_BACKOFF_MAX_S = 300.0
+
+# 每個 byte 有幾個 1 (popcount 查表)
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(bitmap):
+    return int(_POPCOUNT[bitmap].sum(dtype=np.int64))
+
+
+class NumericColumn:
+    """數值欄位：依值排序的 row 編號 + 等筆數分桶的 bitmap。NULL 不在任何桶內 (與 SQL 語意相同)。"""
+
+    def __init__(self, values, n_rows):
+        self.n_rows = n_rows
+        valid = np.flatnonzero(~np.isnan(values))
+        self.order = valid[np.argsort(values[valid], kind="stable")]
+        self.sorted_values = values[self.order]
+        n_valid = len(self.order)
+        n_buckets = max(1, min(N_BUCKETS, n_valid))
+        self.bucket_starts = np.linspace(0, n_valid, n_buckets + 1).astype(np.int64)
+        self.bucket_bitmaps = []
+        for b in range(n_buckets):
+            bits = np.zeros(n_rows, dtype=bool)
+            bits[self.order[self.bucket_starts[b]:self.bucket_starts[b + 1]]] = True
+            self.bucket_bitmaps.append(np.packbits(bits))
+
+    def segments(self, op, value):
+        """把條件轉成排序後位置的區間 [(i, j), ...] (最多兩段)。"""
+        sv = self.sorted_values
+        if op == "between":
+            lo, hi = value
+            return [(np.searchsorted(sv, lo, "left"), np.searchsorted(sv, hi, "right"))]
+        left = np.searchsorted(sv, value, "left")
+        right = np.searchsorted(sv, value, "right")
+        return {
+            "<": [(0, left)], "<=": [(0, right)],
+            ">": [(right, len(sv))], ">=": [(left, len(sv))],
+            "=": [(left, right)], "<>": [(0, left), (right, len(sv))],
+        }[op]
+
+    def count(self, op, value):
+        return sum(max(0, j - i) for i, j in self.segments(op, value))
+
+    def bitmap(self, op, value):
+        result = np.zeros((self.n_rows + 7) // 8, dtype=np.uint8)
+        for i, j in self.segments(op, value):
+            if j <= i:
+                continue
+            # 完整落在 [i, j) 內的桶直接 OR，剩下的邊界以實際 row 編號補上
+            first = np.searchsorted(self.bucket_starts, i, "left")
+            last = np.searchsorted(self.bucket_starts, j, "right") - 1
+            if first < last:
+                for b in range(first, last):
+                    result |= self.bucket_bitmaps[b]
+                edges = np.concatenate([self.order[i:self.bucket_starts[first]],
+                                        self.order[self.bucket_starts[last]:j]])
+            else:
+                edges = self.order[i:j]
+            if len(edges):
+                bits = np.zeros(self.n_rows, dtype=bool)
+                bits[edges] = True
+                result |= np.packbits(bits)
+        return result
+
+
+class BitmapIndex:
+    def __init__(self, brands, prices, ratings, prime_flags, catalog_version=None):
+        n_rows = len(prices)
+        self.n_rows = n_rows
+        self.catalog_version = catalog_version
+        self.built_at = time.time()
+
+        self.sales_price = NumericColumn(prices, n_rows)
+        self.rating = NumericColumn(ratings, n_rows)
+
+        codes = np.array(brands, dtype=object)
+        has_brand = np.array([b is not None for b in codes], dtype=bool)
+        self.brand_nonnull = np.packbits(has_brand)
+        brand_rows = np.flatnonzero(has_brand)
+        names = codes[brand_rows].astype(str)
+        order = np.argsort(names, kind="stable")
+        sorted_names = names[order]
+        self.brand_rows = brand_rows[order]
+        unique, starts = np.unique(sorted_names, return_index=True)
+        ends = np.append(starts[1:], len(sorted_names))
+        self.brand_postings = {name: (s, e) for name, s, e in zip(unique, starts, ends)}
+
+        # 每個非 NULL 的原始值一個 bitmap：與 SQL 相同，比較區分大小寫，NULL 在 = 與 <> 下都不成立
+        prime_flags = np.array(prime_flags, dtype=object)
+        has_prime = np.array([p is not None for p in prime_flags], dtype=bool)
+        self.prime_nonnull = np.packbits(has_prime)
+        self.prime = {flag: np.packbits(prime_flags == flag) for flag in set(prime_flags[has_prime])}
+
+    # --- 單一條件 ---
+    def _brand_rows(self, name):
+        span = self.brand_postings.get(name)
+        if span is None:
+            return self.brand_rows[:0]
+        return self.brand_rows[span[0]:span[1]]
+
+    def _rows_to_bitmap(self, rows):
+        bits = np.zeros(self.n_rows, dtype=bool)
+        bits[rows] = True
+        return np.packbits(bits)
+
+    def _predicate_count(self, column, op, value):
+        if column in ("sales_price", "rating"):
+            return getattr(self, column).count(op, value)
+        if column == "brand":
+            matched = len(self._brand_rows(value))
+            return matched if op == "=" else _popcount(self.brand_nonnull) - matched
+        matched = _popcount(self.prime[value]) if value in self.prime else 0
+        return matched if op == "=" else _popcount(self.prime_nonnull) - matched
+
+    def _predicate_bitmap(self, column, op, value):
+        if column in ("sales_price", "rating"):
+            return getattr(self, column).bitmap(op, value)
+        if column == "brand":
+            matched = self._rows_to_bitmap(self._brand_rows(value))
+            return matched if op == "=" else self.brand_nonnull & ~matched
+        matched = self.prime.get(value)
+        if matched is None:
+            matched = np.zeros((self.n_rows + 7) // 8, dtype=np.uint8)
+        return matched if op == "=" else self.prime_nonnull & ~matched
+
+    # --- 對外介面 ---
+    def count(self, sql_filter_string):
+        """回傳精確的符合筆數；條件無法解析時回傳 None。"""
+        predicates = embedding_store.parse_sql_filter(sql_filter_string)
+        if predicates is None:
+            return None
+        if not predicates:
+            return self.n_rows
+        if len(predicates) == 1:
+            return self._predicate_count(*predicates[0])
+        result = self._predicate_bitmap(*predicates[0])
+        for predicate in predicates[1:]:
+            result = result & self._predicate_bitmap(*predicate)
+        return _popcount(result)
+
+
+def build_from_cursor(conn, catalog_version=None):
+    """以 server-side cursor 分批讀取篩選欄位並建立索引 (不讀取向量)。"""
+    start = time.time()
+    brands, prices, ratings, prime_flags = [], [], [], []
+    select_sql = "SELECT brand, sales_price, rating, amazon_prime_y_or_n FROM products;"
+    for rows in embedding_store.iter_rows(conn, select_sql, chunk_size=CHUNK_SIZE, cursor_name="bitmap_build"):
+        for brand, price, rating, prime in rows:
+            brands.append(brand)
+            prices.append(np.nan if price is None else float(price))
+            ratings.append(np.nan if rating is None else float(rating))
+            prime_flags.append(prime)
+    index = BitmapIndex(brands, np.array(prices, dtype=np.float64), np.array(ratings, dtype=np.float64),
+                        prime_flags, catalog_version)
+    logger.info("bitmap 索引建立完成：%s 筆，%s 個品牌，%.2f 秒 (catalog 版本 %s)",
+                index.n_rows, len(index.brand_postings), time.time() - start, catalog_version)
+    return index
+
+
+# --- 模組層級的索引 (過期時背景重建) ---
+_index = None
+_rebuild_lock = threading.Lock()
+_rebuilding = False
+_last_rebuild_at = 0.0      # 上次開始重建的時間 (time.monotonic)
+_failures = 0               # 連續失敗次數
+_retry_at = 0.0             # 失敗後，這個時間之前不再重建
+
+
+def _rebuild(catalog_version, connection_factory):
+    global _index, _rebuilding, _failures, _retry_at
+    try:
+        with connection_factory() as conn:
+            _index = build_from_cursor(conn, catalog_version)
+        with _rebuild_lock:
+            _failures = 0
+    except Exception:
+        with _rebuild_lock:
+            _failures += 1
+            backoff = min(RETRY_BACKOFF_S * 2 ** (_failures - 1), RETRY_BACKOFF_MAX_S)
+            _retry_at = time.monotonic() + backoff
+        logger.exception("bitmap 索引重建失敗 (連續 %s 次)，%.0f 秒後再重試", _failures, backoff)
+    finally:
+        with _rebuild_lock:
+            _rebuilding = False
+
+
+def get_index(catalog_version, connection_factory, wait=False):
+    """
+    回傳與 catalog_version 相符的索引。版本不符 (或尚未建立) 時啟動背景重建並回傳 None，
+    呼叫端這一次退回 EXPLAIN 預估。重建失敗後的退避期間、或距離上次重建不到 REBUILD_MIN_INTERVAL_S 時
+    不啟動重建 (同樣回傳 None)。wait=True 時同步建立 (服務啟動時使用，不受退避限制)。
+    connection_factory：回傳資料庫連線的 context manager (例如 cbo_proxy.db_connection)。
+    """
+    global _rebuilding, _last_rebuild_at
+    index = _index
+    if index is not None and index.catalog_version == catalog_version:
+        return index
+    if wait:
+        _rebuild(catalog_version, connection_factory)
+        index = _index
+        return index if index is not None and index.catalog_version == catalog_version else None
+    with _rebuild_lock:
+        now = time.monotonic()
+        if _rebuilding or now < _retry_at:
+            return None
+        if index is not None and now - _last_rebuild_at < REBUILD_MIN_INTERVAL_S:
+            return None
+        _rebuilding = True
+        _last_rebuild_at = now
+    threading.Thread(target=_rebuild, args=(catalog_version, connection_factory),
+                     name="bitmap-index-rebuild", daemon=True).start()
+    return None
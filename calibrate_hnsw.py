@@ -1,12 +1,14 @@
 # 檔名：calibrate_hnsw.py
 # 目的：(Phase 4 前置) HNSW 成本校準
-# 功能：測量 HNSW 索引召回 K=1000 筆資料的「固定成本」
-# 輸出：COST_B_FIXED 的建議值
+# 功能：掃描不同的 K (召回數量) 與 hnsw.ef_search，測量計畫 B 的 HNSW 召回成本，
+#       以最小平方法擬合 Time = COST_B_FIXED + COST_B_PER_K * K + COST_B_PER_EF * ef_search
+# 輸出：COST_B_FIXED / COST_B_PER_K / COST_B_PER_EF 的建議值，並寫入 cost_model.json
 
 import psycopg2
 import os
 import numpy as np
 from dotenv import load_dotenv
+import cost_model
 
 load_dotenv()
 DB_SETTINGS = {
@@ -17,54 +19,95 @@ DB_SETTINGS = {
     "database": os.environ.get("DB_NAME")
 }
 
-# 這是我們在 cbo_proxy.py 裡設定的 K 值
-K_CANDIDATES = 1000
+# 掃描的 K 與 ef_search 組合 (ef_search < K 的組合實際會以 ef_search = K 執行)
+# pgvector 的 hnsw.ef_search 上限為 1000，K 超過 1000 時拿不到 K 個候選，所以 K 也不超過 1000
+K_VALUES = [20, 50, 100, 200, 500, 1000]
+EF_SEARCH_VALUES = [40, 100, 200, 400]
+EF_SEARCH_MAX = 1000
+
+# 每個組合使用的查詢向量數量
+N_QUERY_VECTORS = 20
 VECTOR_DIM = 768
 
-def generate_random_vector(dim):
-    vec = np.random.rand(dim)
-    vec = vec / np.linalg.norm(vec)
-    return vec.tolist()
+def sample_query_vectors(cursor, n):
+    """
+    從資料表中抽樣「真實」的商品向量作為查詢向量。
+    (隨機均勻向量全部落在正象限，和 CLIP 向量的分佈差很多，會讓 HNSW 的走訪路徑失真)
+    """
+    cursor.execute(
+        "SELECT embedding::text FROM products TABLESAMPLE SYSTEM (1) WHERE embedding IS NOT NULL LIMIT %s;",
+        (n,)
+    )
+    vectors = [row[0] for row in cursor.fetchall()]
+    if len(vectors) < n:
+        # 資料太少 (TABLESAMPLE 抽不滿) 時退回隨機向量補齊
+        for _ in range(n - len(vectors)):
+            vec = np.random.randn(VECTOR_DIM)
+            vectors.append(str((vec / np.linalg.norm(vec)).tolist()))
+    return vectors
 
 def calibrate_hnsw():
-    print(f"🚀 開始校準 HNSW 索引成本 (K={K_CANDIDATES})...")
-    
+    print(f"🚀 開始校準 HNSW 索引成本 (K={K_VALUES}, ef_search={EF_SEARCH_VALUES})...")
+
     conn = None
     try:
         conn = psycopg2.connect(**DB_SETTINGS)
         conn.autocommit = True
         cursor = conn.cursor()
 
-        measurements = []
-        # 跑 10 次取平均
-        for i in range(10):
-            query_vec = generate_random_vector(VECTOR_DIM)
-            
-            # [關鍵 SQL]
-            # 這裡不加任何 WHERE 條件，純粹測量 HNSW 索引抓取 Top-K 的時間
-            sql = f"""
-                EXPLAIN (ANALYZE, FORMAT JSON)
-                SELECT uniq_id 
-                FROM products 
-                ORDER BY embedding <-> '{query_vec}'
-                LIMIT {K_CANDIDATES};
-            """
-            
-            cursor.execute(sql)
-            plan = cursor.fetchone()[0]
-            exec_time = plan[0]['Execution Time']
-            measurements.append(exec_time)
-            print(f"  測試 {i+1}: {exec_time:.4f} ms")
-
-        avg_time = sum(measurements) / len(measurements)
-        
+        query_vectors = sample_query_vectors(cursor, N_QUERY_VECTORS)
+
+        k_samples, ef_samples, ms_samples = [], [], []
+        print(f"{'K':<8} | {'ef_search':<10} | {'平均耗時 (ms)':<15}")
+        print("-" * 40)
+
+        for ef_search in EF_SEARCH_VALUES:
+            for k in K_VALUES:
+                ef_eff = min(max(ef_search, k), EF_SEARCH_MAX)
+                cursor.execute("SET hnsw.ef_search = %s;", (ef_eff,))
+
+                trials = []
+                for query_vec in query_vectors:
+                    # [關鍵 SQL]
+                    # 與計畫 B 的內層 CTE 相同：走 HNSW 索引召回 Top-K，並回表讀取 brand / sales_price
+                    sql = f"""
+                        EXPLAIN (ANALYZE, FORMAT JSON)
+                        SELECT uniq_id, brand, sales_price
+                        FROM products
+                        ORDER BY embedding <=> '{query_vec}'
+                        LIMIT {k};
+                    """
+                    cursor.execute(sql)
+                    plan = cursor.fetchone()[0]
+                    exec_time = plan[0]['Execution Time']
+                    trials.append(exec_time)
+
+                    k_samples.append(k)
+                    ef_samples.append(ef_eff)
+                    ms_samples.append(exec_time)
+
+                print(f"{k:<8} | {ef_eff:<10} | {np.mean(trials):.4f} ms")
+
+        # --- 進行多元線性回歸 ---
+        fitted = cost_model.fit_plan_b_samples(k_samples, ef_samples, ms_samples)
+
         print("\n" + "="*40)
         print("📊 HNSW 校準結果")
         print("="*40)
-        print(f"平均搜尋時間: {avg_time:.4f} ms")
-        print(f"建議 COST_B_FIXED = {avg_time:.4f}")
+        print(f"方程式: Time = {fitted['cost_b_fixed']:.4f} "
+              f"+ {fitted.get('cost_b_per_k', 0):.6f} * K "
+              f"+ {fitted.get('cost_b_per_ef', 0):.6f} * ef_search")
+        print(f"建議 COST_B_FIXED  = {fitted['cost_b_fixed']:.4f}")
+        print(f"建議 COST_B_PER_K  = {fitted.get('cost_b_per_k', 0):.6f}")
+        print(f"建議 COST_B_PER_EF = {fitted.get('cost_b_per_ef', 0):.6f}")
         print("="*40)
 
+        # 寫入 cost_model.json，cbo_proxy 下次啟動 (或背景重新擬合) 時就會使用新係數
+        params = cost_model.load_model()
+        params.update(fitted)
+        cost_model.save_model(params, {"calibrate_hnsw": len(ms_samples)})
+        print(f"✅ 已寫入 {cost_model.MODEL_FILE}")
+
     except Exception as e:
         print(f"❌ 錯誤: {e}")
     finally:
@@ -72,4 +115,4 @@ def calibrate_hnsw():
             conn.close()
 
 if __name__ == "__main__":
-    calibrate_hnsw()
\ No newline at end of file
+    calibrate_hnsw()
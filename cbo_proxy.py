@@ -4,17 +4,38 @@
 # ---
 
 import psycopg2
-from psycopg2 import sql, extras
+from psycopg2 import sql, extras, pool
 import os
+import json
+import base64
 import shutil
+import threading
+import contextvars
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import time
 import sys
+import logging
+import re
+import numpy as np
 import query_parser 
+import tracing
+import cost_model
+import selectivity_feedback
+import result_cache
+import numpy_engine
+import ivf_index
+import embedding_store
+import bitmap_index
+import stats_maintenance
+import admission_control
 
 # --- 1. 載入設定 ---
 load_dotenv() 
 
+# 每個查詢都會走到的訊息改用 logging (CLI 腳本以 INFO 顯示；服務預設 WARNING，不付格式化成本)
+logger = logging.getLogger(__name__)
+
 DB_SETTINGS = {
     "host": os.environ.get("DB_HOST"),
     "port": os.environ.get("DB_PORT"),
@@ -23,41 +44,346 @@ DB_SETTINGS = {
     "database": os.environ.get("DB_NAME")
 }
 
+# --- 1.1 連線池 (長駐服務用) ---
+# 沒有呼叫 init_pool() 時 (例如 CLI 腳本)，每次查詢都建立新連線，行為與舊版相同。
+_pool = None
+_pool_slots = None
+
+def init_pool(minconn=2, maxconn=20):
+    """
+    建立執行緒安全的連線池。psycopg2 的 pool 在耗盡時會直接丟例外，
+    所以另外用 semaphore 讓超過 maxconn 的請求排隊等待。
+    """
+    global _pool, _pool_slots
+    if _pool is not None:
+        return
+    _pool = pool.ThreadedConnectionPool(minconn, maxconn, **DB_SETTINGS)
+    _pool_slots = threading.BoundedSemaphore(maxconn)
+    result_cache.set_version_source(fetch_catalog_version)
+    # 成本係數的背景重新擬合只在長駐程序 (服務、重播測試) 啟動；一次性的工具 import 本模組時不會多一條執行緒
+    if ENABLE_ONLINE_LEARNING:
+        cost_model.start_background_refit()
+
+def close_pool():
+    global _pool, _pool_slots
+    cost_model.stop_background_refit()
+    if _pool is not None:
+        _pool.closeall()
+    _pool = None
+    _pool_slots = None
+
+# --- 1.2 分片 (sharding.py 使用) ---
+# 在 use_shard() 區塊內，db_connection() 連到該分片，而且只使用以該分片自身統計資料為準的路徑
+# (EXPLAIN 預估、SQL 的計畫 A / B)；bitmap / NumPy / IVF 這些程序內結構都是針對單一 products 建的，停用。
+_current_shard = contextvars.ContextVar("cbo_current_shard", default=None)
+_shard_pools = {}   # {分片名稱: (pool, semaphore)}
+
+@contextmanager
+def use_shard(name, settings):
+    """在這個區塊內的查詢都送到指定的分片 (settings 與 DB_SETTINGS 格式相同)。"""
+    token = _current_shard.set((name, settings))
+    try:
+        yield
+    finally:
+        _current_shard.reset(token)
+
+def current_shard():
+    """回傳目前分片的名稱；不在 use_shard() 區塊內時回傳 None。"""
+    shard = _current_shard.get()
+    return shard[0] if shard is not None else None
+
+def init_shard_pool(name, settings, minconn=1, maxconn=10):
+    if name in _shard_pools:
+        return
+    _shard_pools[name] = (pool.ThreadedConnectionPool(minconn, maxconn, **settings),
+                          threading.BoundedSemaphore(maxconn))
+
+def close_shard_pools():
+    for pool_ref, _ in _shard_pools.values():
+        pool_ref.closeall()
+    _shard_pools.clear()
+
+@contextmanager
+def db_connection(autocommit=False):
+    """
+    取得一條資料庫連線：有連線池就從池中借用 (用完歸還)，否則建立新連線 (用完關閉)。
+    在 use_shard() 區塊內時連到該分片。
+    """
+    shard = _current_shard.get()
+    if shard is None:
+        settings, pool_ref, slots = DB_SETTINGS, _pool, _pool_slots
+    else:
+        settings = shard[1]
+        pool_ref, slots = _shard_pools.get(shard[0], (None, None))
+
+    if pool_ref is None:
+        conn = psycopg2.connect(**settings)
+        try:
+            conn.autocommit = autocommit
+            yield conn
+        finally:
+            conn.close()
+        return
+
+    slots.acquire()
+    conn = None
+    try:
+        conn = pool_ref.getconn()
+        conn.autocommit = autocommit
+        yield conn
+    finally:
+        broken = conn is None or conn.closed != 0
+        if conn is not None and not broken:
+            try:
+                # 結束未提交的交易 (連同交易中的 SET)，讓下一個借用者拿到乾淨的連線
+                if not conn.autocommit:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        if conn is not None:
+            pool_ref.putconn(conn, close=broken)
+        slots.release()
+
+def fetch_catalog_version():
+    with db_connection(autocommit=True) as conn:
+        return result_cache.get_catalog_version(conn.cursor())
+
+def get_product_embedding(uniq_id):
+    """從資料庫讀取某個商品已存好的 embedding (以商品作為基準圖片時使用)。"""
+    with db_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT embedding::text FROM products WHERE uniq_id = %s;", (uniq_id,))
+        row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return json.loads(row[0])
+
 # --- 2. CBO 參數設定 ---
 
 # [校準結果] 單一向量計算成本 (ms/row)
+# [注意] 這只是「初始值」；實際決策使用 cost_model 從執行紀錄持續擬合的係數
 C_VEC_CPU_COST = 0.0016 
 
-# [調整後參數] HNSW 索引搜尋的固定成本 (ms)
-# K=200 時預估約 9.0ms
-COST_B_FIXED = 9.0 
+# [參數化模型] 計畫 B 成本 = COST_B_FIXED + COST_B_PER_K * K + COST_B_PER_EF * ef_search
+# K=200, ef_search=200 時預估約 9.0ms (由 calibrate_hnsw.py 掃描 K / ef_search 擬合)
+COST_B_FIXED = 1.0 
+COST_B_PER_K = 0.03
+COST_B_PER_EF = 0.01
 
 # [兩階段篩選參數]
 K_CANDIDATES = 5  # HNSW 內部召回數量
 N_RESULTS = 20      # 最終回傳數量
 
+# [HNSW 搜尋參數] 每次計畫 B 執行前設定的 hnsw.ef_search (40 為 pgvector 預設值)
+HNSW_EF_SEARCH = 40
+# pgvector 的 hnsw.ef_search 只接受 1..1000，超過時 SET 直接失敗
+HNSW_EF_SEARCH_MAX = 1000
+
+# [批次執行] execute_batch 每個 SQL 陳述式最多包含幾個查詢向量 (控制單次傳送的參數大小)
+BATCH_MAX_QUERIES = 256
+
+# [計畫 B 所需 K] 篩選越嚴格，HNSW 要召回越多候選才能湊滿 N 筆：K ≈ N / 選擇率 * 安全係數
+K_SAFETY_FACTOR = 1.5
+# 沒有 iterative scan 時，HNSW 最多只能回傳 ef_search 筆候選，K 的上限與 ef_search 的上限相同；
+# pgvector >= 0.8 支援 hnsw.iterative_scan 時，索引掃描可以在 ef_search 之後繼續往下走，K 可以到 K_MAX_ITERATIVE
+K_MAX = HNSW_EF_SEARCH_MAX
+K_MAX_ITERATIVE = 4000
+
+# [選擇率回饋] 以計畫 A 回報的實際篩選筆數修正 EXPLAIN 預估 (設 CBO_SELECTIVITY_FEEDBACK=0 可關閉)
+ENABLE_SELECTIVITY_FEEDBACK = os.environ.get("CBO_SELECTIVITY_FEEDBACK", "1") == "1"
+
+# [精確篩選筆數] 可解析的篩選條件改用記憶體內的 bitmap 索引計算精確筆數，不做 EXPLAIN
+# (設 CBO_BITMAP_INDEX=0 可關閉；索引過期時背景重建，重建完成前退回 EXPLAIN)
+ENABLE_BITMAP_INDEX = os.environ.get("CBO_BITMAP_INDEX", "1") == "1"
+
+# [關鍵字篩選的筆數] LIKE / ILIKE 條件的 EXPLAIN 預估只是猜測 (pg_stats 沒有子字串的分佈)。
+# 改以 trigram GIN 索引實際計數，最多數到 KEYWORD_COUNT_CAP 筆就停：
+# 沒數滿時是精確值；數滿時只知道「至少這麼多」，作為 EXPLAIN 預估的下限。設 0 可關閉。
+KEYWORD_COUNT_CAP = int(os.environ.get("CBO_KEYWORD_COUNT_CAP", "20000"))
+_PATTERN_PREDICATE_RE = re.compile(r"\bI?LIKE\b", re.IGNORECASE)
+
+# [結果快取] 相同查詢向量 + 篩選 + N 直接回傳快取結果 (設 CBO_RESULT_CACHE=0 可關閉)
+ENABLE_RESULT_CACHE = os.environ.get("CBO_RESULT_CACHE", "1") == "1"
+
+# [表格統計快取] pg_class.reltuples 的快取秒數 (用來把預估筆數換算成選擇率)
+TABLE_STATS_TTL_S = 60.0
+_table_stats_cache = {}
+
+# [統計版本] stats_maintenance.py 每次 ANALYZE 會遞增 stats_version；CBO 每 STATS_CHECK_INTERVAL_S 秒最多檢查一次，
+# 版本改變時清掉總筆數快取與選擇率回饋 (回饋學到的是「舊統計」的誤差，ANALYZE 之後已不適用)
+STATS_CHECK_INTERVAL_S = 5.0
+_stats_versions = {}    # {分片: (stats_version, 檢查時間)}
+
+# [計畫 A 後端] "sql"：在 Postgres 中篩選 + 排序；"numpy"：使用程序內的 NumPy 精確搜尋 (numpy_engine.py)，
+# 篩選語法不支援或匯出資料過期時自動退回 SQL
+PLAN_A_BACKEND = os.environ.get("CBO_PLAN_A_BACKEND", "sql").lower()
+
+# [計畫 IVF] 程序內的 IVF / PQ 索引 (ivf_index.py) 作為第三個候選計畫 (設 CBO_IVF=1 啟用)
+ENABLE_IVF = os.environ.get("CBO_IVF", "0") == "1"
+IVF_NPROBE = ivf_index.DEFAULT_NPROBE
+IVF_RERANK_FACTOR = ivf_index.RERANK_FACTOR
+
+# [線上學習] 記錄每次執行的耗時，init_pool() 之後在背景重新擬合成本係數 (設 CBO_ONLINE_LEARNING=0 可關閉)
+ENABLE_ONLINE_LEARNING = os.environ.get("CBO_ONLINE_LEARNING", "1") == "1"
+
+cost_model.load_model({
+    "c_vec_cpu_cost": C_VEC_CPU_COST,
+    "cost_b_fixed": COST_B_FIXED,
+    "cost_b_per_k": COST_B_PER_K,
+    "cost_b_per_ef": COST_B_PER_EF,
+})
+
 # [匯率設定] 1 TWD = 2.6 INR
 EXCHANGE_RATE = 2.6
 
 # --- 3. [Phase 3.1] CBO 核心決策演算法 ---
-def get_cbo_decision(sql_filter_string):
-    print(f"\n--- [CBO 決策開始] ---")
+def check_stats_version(cursor):
+    """
+    stats_version 改變 (有人執行了 ANALYZE) 時，清掉這個分片的總筆數快取；
+    非分片模式另外清掉選擇率回饋。catalog_version 表還沒有 stats_version 欄位時不做任何事。
+    """
+    cache_key = current_shard() or "products"
+    known = _stats_versions.get(cache_key)
+    now = time.time()
+    if known and now - known[1] < STATS_CHECK_INTERVAL_S:
+        return
+    try:
+        version = stats_maintenance.get_stats_version(cursor)
+    except psycopg2.Error:
+        version = None # 尚未執行 stats_maintenance.py init
+    _stats_versions[cache_key] = (version, now)
+    if known is None or version == known[0]:
+        return
+    logger.info("統計資料已更新 (stats_version %s -> %s)，清除總筆數快取%s", known[0], version,
+                "" if current_shard() is not None else "與選擇率回饋")
+    _table_stats_cache.pop(cache_key, None)
+    if ENABLE_SELECTIVITY_FEEDBACK and current_shard() is None:
+        selectivity_feedback.reset()
+
+def get_total_rows(cursor):
+    """讀取 products 的總筆數估計 (pg_class.reltuples)，並快取 TABLE_STATS_TTL_S 秒 (每個分片各自快取)。"""
+    check_stats_version(cursor)
+    cache_key = current_shard() or "products"
+    cached = _table_stats_cache.get(cache_key)
+    if cached and time.time() - cached[1] < TABLE_STATS_TTL_S:
+        return cached[0]
+    cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = 'products'::regclass;")
+    total_rows = max(int(cursor.fetchone()[0]), 0)
+    _table_stats_cache[cache_key] = (total_rows, time.time())
+    return total_rows
+
+def required_k(n_filtered, total_rows, limit_n=N_RESULTS):
+    """
+    計畫 B 為了在後篩選之後仍湊滿 limit_n 筆，需要的 HNSW 候選數 K。
+    """
+    if not total_rows or n_filtered is None:
+        return max(K_CANDIDATES, limit_n)
+    k_max = K_MAX_ITERATIVE if _iterative_scan_supported else K_MAX
+    selectivity = min(1.0, n_filtered / total_rows)
+    if selectivity <= 0:
+        return k_max
+    k_needed = int(limit_n / selectivity * K_SAFETY_FACTOR + 0.5)
+    return max(limit_n, min(k_max, k_needed))
+
+def estimate_plan_costs(n_filtered, total_rows, limit_n=N_RESULTS, ef_search=HNSW_EF_SEARCH, params=None):
+    """
+    依目前的成本係數計算兩個計畫的預測耗時 (ms)。
+    計畫 B 使用「這個選擇率下實際需要的 K」，而不是固定的 K_CANDIDATES。
+    """
+    params = params or cost_model.get_params()
+    k_needed = required_k(n_filtered, total_rows, limit_n)
+    score_a = n_filtered * params["c_vec_cpu_cost"] + params["cost_a_fixed"]
+    score_b = cost_model.plan_b_cost(params, k_needed, ef_search)
+    return {"score_a": score_a, "score_b": score_b, "k_needed": k_needed}
+
+def get_cbo_estimate(sql_filter_string, limit_n=N_RESULTS):
+    """
+    回傳 CBO 的完整估計結果：
+    {"plan": "PLAN_A"/"PLAN_B"/"PLAN_IVF", "n_filtered": 預估筆數, "score_a": ms, "score_b": ms,
+     "k_needed": 計畫 B 需要的候選數, "score_ivf": ms (只有 IVF 可用時)}
+    """
+    logger.debug("--- [CBO 決策開始] ---")
+    params = cost_model.get_params()
+    no_filter_result = {
+        "plan": "PLAN_B", "n_filtered": None, "score_a": None,
+        "score_b": cost_model.plan_b_cost(params, limit_n, HNSW_EF_SEARCH), "k_needed": limit_n,
+    }
     
     if not sql_filter_string or sql_filter_string.strip() == "":
-        print("CBO 偵測：無 SQL 篩選。 [決策：計畫 B (Vector-First)]")
-        return "PLAN_B"
+        logger.info("CBO 偵測：無 SQL 篩選。 [決策：計畫 B (Vector-First)]")
+        return no_filter_result
 
-    conn = None
     try:
-        conn = psycopg2.connect(**DB_SETTINGS)
-        conn.autocommit = True
+        exact = exact_filter_count(sql_filter_string) if ENABLE_BITMAP_INDEX else None
+        exact_source = "bitmap"
+        keyword_floor = None
+        if exact is None and KEYWORD_COUNT_CAP > 0 and _PATTERN_PREDICATE_RE.search(sql_filter_string):
+            count, total_rows, complete = capped_filter_count(sql_filter_string, KEYWORD_COUNT_CAP)
+            if complete:
+                exact, exact_source = (count, total_rows), "trigram"
+            else:
+                keyword_floor = count
+
+        if exact is not None:
+            n_filtered_raw, total_rows = exact
+            n_filtered_sql = n_filtered_raw
+            logger.info("CBO 精確計數 (%s)：SQL 將篩選出 %s 筆資料 (共 %s 筆)。", exact_source, n_filtered_raw, total_rows)
+        else:
+            n_filtered_raw, total_rows = explain_row_estimate(sql_filter_string)
+            logger.info("CBO 預測 (pg_stats)：SQL 將篩選出 ≈ %s 筆資料 (共 %s 筆)。", n_filtered_raw, total_rows)
+            if keyword_floor is not None and n_filtered_raw < keyword_floor:
+                logger.info("CBO 關鍵字計數：至少 %s 筆，預估 ≈ %s -> %s 筆。", keyword_floor, n_filtered_raw, keyword_floor)
+                n_filtered_raw = keyword_floor
+
+            # 以執行回饋學到的修正倍率調整預估 (相關條件 / LIKE 條件的預估誤差特別大)
+            n_filtered_sql = n_filtered_raw
+            # 分片模式不套用：回饋紀錄以篩選字串為鍵，各分片的預估會互相覆蓋
+            if ENABLE_SELECTIVITY_FEEDBACK and current_shard() is None:
+                n_filtered_sql = selectivity_feedback.correct_estimate(sql_filter_string, n_filtered_raw)
+                if n_filtered_sql != n_filtered_raw:
+                    logger.info("CBO 回饋修正：≈ %s -> %.0f 筆。", n_filtered_raw, n_filtered_sql)
+
+        # 套用成本公式 (係數來自 cost_model，會隨執行紀錄更新)
+        costs = estimate_plan_costs(n_filtered_sql, total_rows, limit_n, params=params)
+        score_a = costs["score_a"]
+        score_b = costs["score_b"]
+
+        logger.info("CBO 成本模型計算 (單位: ms)：")
+        logger.info("  > 預測 Score(A) (SQL-First)    = %.4f ms", score_a)
+        logger.info("  > 預測 Score(B) (Vector-First) = %.4f ms (需要 K=%s)", score_b, costs["k_needed"])
+
+        if score_a < score_b:
+            logger.info("[CBO 決策：計畫 A (SQL-First)] (因為 A < B)")
+            plan = "PLAN_A"
+        else:
+            logger.info("[CBO 決策：計畫 B (Vector-First)] (因為 A >= B)")
+            plan = "PLAN_B"
+
+        ivf = usable_ivf_index(sql_filter_string)
+        if ivf is not None:
+            selectivity = n_filtered_sql / total_rows if total_rows else 1.0
+            rows_scanned = ivf.expected_rows_scanned(selectivity, limit_n, IVF_NPROBE, IVF_RERANK_FACTOR)
+            costs["score_ivf"] = params["cost_ivf_fixed"] + params["cost_ivf_per_row"] * rows_scanned
+            logger.info("  > 預測 Score(IVF) (程序內 IVF) = %.4f ms (掃描 ≈ %.0f 筆)", costs["score_ivf"], rows_scanned)
+            if costs["score_ivf"] < min(score_a, score_b):
+                logger.info("[CBO 決策：計畫 IVF] (因為 IVF < min(A, B))")
+                plan = "PLAN_IVF"
+        return {"plan": plan, "n_filtered": n_filtered_sql, "n_filtered_raw": n_filtered_raw, **costs}
+
+    except Exception as e:
+        logger.error("CBO 決策時發生錯誤：%s", e)
+        return no_filter_result
+
+def explain_row_estimate(sql_filter_string):
+    """以 EXPLAIN 取得 Postgres 預估的篩選筆數，回傳 (預估筆數, 總筆數)。"""
+    with db_connection(autocommit=True) as conn:
         cursor = conn.cursor()
-        
+
         # 使用 EXPLAIN 獲取預估筆數
         explain_query = sql.SQL("EXPLAIN (FORMAT JSON) SELECT uniq_id FROM products WHERE {sql_filter};").format(
             sql_filter=sql.SQL(sql_filter_string)
         )
-        
+
         cursor.execute(explain_query)
         explain_plan = cursor.fetchone()[0]
         # 注意：有些 Postgres 版本回傳結構可能是 List，這裡做個防呆
@@ -65,99 +391,717 @@ def get_cbo_decision(sql_filter_string):
             plan_data = explain_plan[0]
         else:
             plan_data = explain_plan
-            
-        n_filtered_sql = plan_data["Plan"]["Plan Rows"]
-        
-        print(f"CBO 預測 (pg_stats)：SQL 將篩選出 ≈ {n_filtered_sql} 筆資料。")
 
-        # 套用成本公式
-        score_a = n_filtered_sql * C_VEC_CPU_COST
-        score_b = COST_B_FIXED
+        return plan_data["Plan"]["Plan Rows"], get_total_rows(cursor)
 
-        print(f"CBO 成本模型計算 (單位: ms)：")
-        print(f"  > 預測 Score(A) (SQL-First)    = {score_a:.4f} ms")
-        print(f"  > 預測 Score(B) (Vector-First) = {score_b:.4f} ms")
+def capped_filter_count(sql_filter_string, cap):
+    """
+    實際計算符合的筆數，最多數到 cap 筆 (LIMIT 讓 Bitmap Heap Scan 數滿就停)。
+    回傳 (筆數, 總筆數, 是否為精確值)。
+    """
+    with db_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        count_query = sql.SQL("SELECT COUNT(*) FROM (SELECT 1 FROM products WHERE {sql_filter} LIMIT {cap}) AS matched;").format(
+            sql_filter=sql.SQL(sql_filter_string), cap=sql.Literal(cap)
+        )
+        with tracing.stage("keyword_count"):
+            cursor.execute(count_query)
+            count = cursor.fetchone()[0]
+        return count, get_total_rows(cursor), count < cap
 
-        if score_a < score_b:
-            print(f"[CBO 決策：計畫 A (SQL-First)] (因為 A < B)")
-            return "PLAN_A"
-        else:
-            print(f"[CBO 決策：計畫 B (Vector-First)] (因為 A >= B)")
-            return "PLAN_B"
+def exact_filter_count(sql_filter_string):
+    """
+    以 bitmap 索引計算精確的篩選筆數，回傳 (筆數, 總筆數)。
+    條件無法解析，或索引與目前的 catalog 版本不符 (背景重建中) 時回傳 None。
+    """
+    if current_shard() is not None:
+        return None
+    index = bitmap_index.get_index(result_cache.current_version(), db_connection)
+    if index is None:
+        return None
+    count = index.count(sql_filter_string)
+    if count is None:
+        return None
+    return count, index.n_rows
 
-    except Exception as e:
-        print(f"CBO 決策時發生錯誤：{e}")
-        return "PLAN_B"
-    finally:
-        if conn:
-            conn.close()
+def usable_ivf_index(sql_filter_string):
+    """
+    回傳可以用來執行這個篩選的 IVF 索引；未啟用、索引不存在、資料過期或篩選語法不支援時回傳 None。
+    """
+    if not ENABLE_IVF or current_shard() is not None:
+        return None
+    index = ivf_index.get_index()
+    if index is None:
+        return None
+    if index.catalog_version is not None and index.catalog_version != result_cache.current_version():
+        logger.warning("IVF 索引 (版本 %s) 已過期，不列入候選計畫", index.catalog_version)
+        return None
+    if embedding_store.parse_sql_filter(sql_filter_string) is None:
+        return None
+    return index
 
-# --- 4. [Phase 3.2] 計畫 A 執行器 ---
-def execute_plan_a(sql_filter_string, v_query, limit_n=N_RESULTS):
-    print("--- [執行：計畫 A (SQL-First)] ---")
-    conn = None
-    try:
-        conn = psycopg2.connect(**DB_SETTINGS)
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+def get_cbo_decision(sql_filter_string):
+    """回傳 "PLAN_A"、"PLAN_B" 或 "PLAN_IVF"。"""
+    return get_cbo_estimate(sql_filter_string)["plan"]
+
+# --- 4. [Phase 3.2] 計畫 A / B 的 SQL ---
+# 執行器與分析工具 (cbo_regret.py 以 EXPLAIN ANALYZE 量測) 共用同一份 SQL
+def filter_sql(sql_filter_string):
+    """
+    篩選字串 -> 可以放進「帶參數執行」查詢的 SQL 片段。
+    psycopg2 帶參數時會把 % 當作佔位符號，LIKE 樣式中的 % 必須寫成 %%。
+    (沒有參數的查詢，例如 EXPLAIN，直接用 sql.SQL(篩選字串))
+    """
+    return sql.SQL(sql_filter_string.replace("%", "%%"))
 
-        query_a = sql.SQL("""
-            SELECT uniq_id, brand, sales_price, (embedding <-> %s) AS similarity_score
+# 計畫 B 的候選 CTE 除了輸出欄位 (uniq_id, brand, sales_price) 之外，還要帶出的可篩選欄位
+CANDIDATE_FILTER_COLUMNS = sql.SQL("product_name, rating, amazon_prime_y_or_n")
+
+def _embedding_column(include_embedding, source="embedding"):
+    """include_embedding 時多帶出二進位的向量 (vector_send，由 _decode_embeddings 解碼)。"""
+    if not include_embedding:
+        return sql.SQL("")
+    return sql.SQL(", vector_send({}) AS embedding").format(sql.SQL(source))
+
+def _decode_embeddings(rows):
+    for row in rows:
+        if row.get("embedding") is not None:
+            row["embedding"] = embedding_store.decode_vector(row["embedding"])
+    return rows
+
+def build_plan_a_query(sql_filter_string, limit_n=N_RESULTS, include_embedding=False):
+    """計畫 A：先以 SQL 篩選，再對篩選結果做精確的向量排序。參數：(查詢向量,)"""
+    return sql.SQL("""
+        SELECT uniq_id, brand, sales_price, (embedding <-> %s) AS similarity_score,
+               COUNT(*) OVER () AS filtered_total {embedding_column}
+        FROM products
+        WHERE {sql_filter}
+        ORDER BY similarity_score ASC 
+        LIMIT {limit_n};
+    """).format(
+        embedding_column=_embedding_column(include_embedding),
+        sql_filter=filter_sql(sql_filter_string),
+        limit_n=sql.Literal(limit_n)
+    )
+
+def build_plan_b_query(sql_filter_string, k_candidates=K_CANDIDATES, limit_n=N_RESULTS, include_embedding=False):
+    """
+    計畫 B：先以 HNSW 召回 Top-K，再做後篩選。參數：(查詢向量, 查詢向量)
+    後篩選是在候選 CTE 上執行的，CTE 必須帶出所有可篩選的欄位 (CANDIDATE_FILTER_COLUMNS)。
+    """
+    return sql.SQL("""
+        WITH VectorCandidates AS (
+            SELECT uniq_id, brand, sales_price, {filter_columns}, (embedding <-> %s) AS similarity_score
+                   {candidate_embedding}
             FROM products
-            WHERE {sql_filter}
-            ORDER BY similarity_score ASC 
-            LIMIT {limit_n};
-        """).format(
-            sql_filter=sql.SQL(sql_filter_string),
-            limit_n=sql.Literal(limit_n)
+            ORDER BY embedding <=> %s -- 必須與 idx_embedding_hnsw 的 vector_cosine_ops 一致才會走索引
+            LIMIT {limit_k}
         )
-        
-        cursor.execute(query_a, (str(v_query),))
-        results = cursor.fetchall()
-        return [dict(row) for row in results]
+        SELECT uniq_id, brand, sales_price, similarity_score {embedding_column} FROM VectorCandidates
+        WHERE {sql_filter}
+        ORDER BY similarity_score ASC
+        LIMIT {limit_n};
+    """).format(
+        filter_columns=CANDIDATE_FILTER_COLUMNS,
+        candidate_embedding=sql.SQL(", embedding AS candidate_embedding" if include_embedding else ""),
+        embedding_column=_embedding_column(include_embedding, "candidate_embedding"),
+        limit_k=sql.Literal(k_candidates),
+        sql_filter=filter_sql(sql_filter_string),
+        limit_n=sql.Literal(limit_n)
+    )
+
+def _apply_hnsw_settings(cursor, k_candidates, ef_search):
+    """
+    以 SET LOCAL 設定計畫 B 的 hnsw.ef_search (只影響目前交易)，回傳實際可用的 K。
+    K 超過 ef_search 時改用 iterative scan 讓索引掃描繼續往下走；pgvector 不支援時 K 只能降到 ef_search。
+    """
+    cursor.execute("SET LOCAL hnsw.ef_search = %s;", (ef_search,))
+    # 第一次呼叫時順便檢查 iterative scan (之後 required_k 才會給出超過 K_MAX 的 K)
+    iterative = supports_iterative_scan(cursor)
+    if k_candidates <= ef_search:
+        return k_candidates
+    if iterative:
+        # relaxed_order：外層會依 similarity_score 重新排序，候選不必嚴格依距離輸出
+        cursor.execute("SET LOCAL hnsw.iterative_scan = relaxed_order;")
+        return k_candidates
+    logger.warning("K=%s 超過 hnsw.ef_search 上限 %s 且不支援 iterative scan，K 降為 %s",
+                   k_candidates, HNSW_EF_SEARCH_MAX, ef_search)
+    return ef_search
+
+def _apply_statement_timeout(cursor):
+    """在 admission_control.admit() 區塊內時，以 SET LOCAL 套用這個請求的 statement_timeout (只影響目前交易)。"""
+    timeout_ms = admission_control.current_statement_timeout_ms()
+    if timeout_ms:
+        cursor.execute("SET LOCAL statement_timeout = %s;", (timeout_ms,))
+
+# 執行器發生錯誤時回傳空結果 (服務照常回應)；評估工具以這個計數分辨「失敗」與「真的沒有結果」
+_execution_errors = {"PLAN_A": 0, "PLAN_B": 0, "PLAN_IVF": 0}
+
+def execution_error_count():
+    """累計的執行器錯誤次數 (所有計畫合計)。"""
+    return sum(_execution_errors.values())
+
+def _log_execution_error(plan, label, e):
+    """執行器的錯誤紀錄；被 statement_timeout 取消的查詢另外計入准入控制的逾時次數。"""
+    _execution_errors[plan] = _execution_errors.get(plan, 0) + 1
+    if getattr(e, "pgcode", None) == admission_control.QUERY_CANCELED:
+        admission_control.record_statement_timeout(plan)
+        logger.warning("執行%s逾時 (statement_timeout = %s ms)，已取消", label,
+                       admission_control.current_statement_timeout_ms())
+    else:
+        logger.error("執行%s時發生錯誤：%s", label, e)
+
+# --- 5. [Phase 3.2] 計畫 A 執行器 ---
+def execute_plan_a(sql_filter_string, v_query, limit_n=N_RESULTS, n_estimated=None, include_embedding=False):
+    """
+    n_estimated: CBO 預估的篩選筆數 (由 get_cbo_estimate 取得)；
+                 有提供時，本次耗時會回饋給 cost_model 作為擬合樣本。
+    include_embedding: 結果多帶 "embedding" (np.ndarray)，給 rerank_by_attributes 使用，不必再查一次。
+    查詢會順便以 COUNT(*) OVER () 取得「實際」篩選筆數 (排序本來就要掃過全部篩選結果，幾乎不增加成本)，
+    回饋給 selectivity_feedback 與 cost_model。
+    """
+    if PLAN_A_BACKEND == "numpy" and current_shard() is None:
+        rows = _execute_plan_a_numpy(sql_filter_string, v_query, limit_n, n_estimated)
+        if rows is not None:
+            return rows
+
+    logger.info("--- [執行：計畫 A (SQL-First)] ---")
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+            query_a = build_plan_a_query(sql_filter_string, limit_n, include_embedding)
+            _apply_statement_timeout(cursor)
+
+            start = time.perf_counter()
+            with tracing.stage("plan_execute"):
+                cursor.execute(query_a, (str(v_query),))
+            with tracing.stage("fetch"):
+                results = cursor.fetchall()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+
+            rows = _decode_embeddings([dict(row) for row in results])
+            actual_rows = rows[0]["filtered_total"] if rows else 0
+            for row in rows:
+                del row["filtered_total"]
+
+            if ENABLE_SELECTIVITY_FEEDBACK and current_shard() is None:
+                selectivity_feedback.record_actual(sql_filter_string, actual_rows)
+            if ENABLE_ONLINE_LEARNING and n_estimated is not None:
+                # 計畫 A 的耗時與「實際」篩選筆數成正比，用實際值擬合較準
+                cost_model.record_observation("PLAN_A", actual_rows, None, None, elapsed_ms)
+            return rows
 
     except Exception as e:
-        print(f"執行計畫 A 時發生錯誤：{e}")
+        _log_execution_error("PLAN_A", "計畫 A ", e)
         return []
-    finally:
-        if conn:
-            conn.close()
 
-# --- 5. [Phase 3.3] 計畫 B 執行器 ---
-def execute_plan_b(sql_filter_string, v_query, k_candidates=K_CANDIDATES, limit_n=N_RESULTS):
-    print(f"--- [執行：計畫 B (Vector-First) (K={k_candidates} -> N={limit_n})] ---")
-    conn = None
+def _execute_plan_a_numpy(sql_filter_string, v_query, limit_n, n_estimated):
+    """
+    以 numpy_engine 執行計畫 A；無法使用 (沒有匯出檔、資料過期、篩選不支援) 時回傳 None。
+    耗時同樣記錄為 PLAN_A 的觀測，讓成本模型學到「目前使用中的」計畫 A 後端的成本。
+    """
+    engine = numpy_engine.get_engine()
+    if engine is None:
+        return None
+    if engine.catalog_version is not None and engine.catalog_version != result_cache.current_version():
+        logger.warning("NumPy 引擎的資料 (版本 %s) 已過期，計畫 A 退回 SQL", engine.catalog_version)
+        return None
+
+    logger.info("--- [執行：計畫 A (NumPy)] ---")
+    start = time.perf_counter()
+    with tracing.stage("plan_execute"):
+        outcome = engine.search(sql_filter_string, v_query, limit_n)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if outcome is None:
+        logger.info("篩選條件無法在 NumPy 端評估，計畫 A 退回 SQL")
+        return None
+
+    rows, actual_rows = outcome
+    if ENABLE_SELECTIVITY_FEEDBACK:
+        selectivity_feedback.record_actual(sql_filter_string, actual_rows)
+    if ENABLE_ONLINE_LEARNING and n_estimated is not None:
+        cost_model.record_observation("PLAN_A", actual_rows, None, None, elapsed_ms)
+    return rows
+
+# --- 6. [Phase 3.3] 計畫 B 執行器 ---
+def execute_plan_b(sql_filter_string, v_query, k_candidates=K_CANDIDATES, limit_n=N_RESULTS,
+                   ef_search=HNSW_EF_SEARCH, n_estimated=None, include_embedding=False):
+    logger.info("--- [執行：計畫 B (Vector-First) (K=%s -> N=%s)] ---", k_candidates, limit_n)
+    # HNSW 掃描最多只回傳 ef_search 筆，ef_search 必須 >= K 才拿得到 K 個候選 (但不能超過 pgvector 的上限)
+    ef_search = min(max(ef_search, k_candidates), HNSW_EF_SEARCH_MAX)
     try:
-        conn = psycopg2.connect(**DB_SETTINGS)
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor) 
-        
-        query_b = sql.SQL("""
-            WITH VectorCandidates AS (
-                SELECT uniq_id, brand, sales_price, embedding, (embedding <-> %s) AS similarity_score
+        with db_connection() as conn:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor) 
+
+            k_candidates = _apply_hnsw_settings(cursor, k_candidates, ef_search)
+            query_b = build_plan_b_query(sql_filter_string, k_candidates, limit_n, include_embedding)
+            _apply_statement_timeout(cursor)
+
+            v_str = str(v_query)
+            start = time.perf_counter()
+            with tracing.stage("plan_execute"):
+                cursor.execute(query_b, (v_str, v_str))
+            with tracing.stage("fetch"):
+                results = cursor.fetchall()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+
+            if ENABLE_ONLINE_LEARNING:
+                cost_model.record_observation("PLAN_B", n_estimated, k_candidates, ef_search, elapsed_ms)
+            return _decode_embeddings([dict(row) for row in results])
+
+    except Exception as e:
+        _log_execution_error("PLAN_B", "計畫 B ", e)
+        return []
+
+# --- 6.1 計畫 IVF 執行器 ---
+def execute_plan_ivf(sql_filter_string, v_query, limit_n=N_RESULTS, n_estimated=None):
+    """
+    以程序內的 IVF 索引執行 (篩選 bitmap 在 list 掃描中套用，最後精確重排)。
+    索引無法使用時退回計畫 A。
+    """
+    index = usable_ivf_index(sql_filter_string)
+    if index is None:
+        logger.info("IVF 索引無法使用，退回計畫 A")
+        return execute_plan_a(sql_filter_string, v_query, limit_n=limit_n, n_estimated=n_estimated)
+
+    logger.info("--- [執行：計畫 IVF (nprobe>=%s, 重排 %s 筆)] ---", IVF_NPROBE, limit_n * IVF_RERANK_FACTOR)
+    try:
+        start = time.perf_counter()
+        with tracing.stage("plan_execute"):
+            results, rows_scanned = index.search(sql_filter_string, v_query, limit_n,
+                                                 IVF_NPROBE, IVF_RERANK_FACTOR)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if ENABLE_ONLINE_LEARNING:
+            cost_model.record_observation("PLAN_IVF", rows_scanned, None, None, elapsed_ms)
+        return results
+    except Exception as e:
+        _log_execution_error("PLAN_IVF", "計畫 IVF ", e)
+        return []
+
+# --- 7. [Phase 5] 整合入口：快取 -> CBO 決策 -> 執行 ---
+def execute_plan(estimate, sql_filter_string, v_query, limit_n=N_RESULTS, include_embedding=False):
+    """
+    依 CBO 估計結果執行對應的計畫。
+    include_embedding 只對 SQL 執行的計畫 A / B 有效；程序內的後端 (NumPy / IVF) 不帶向量，
+    rerank_by_attributes 會自行補查。
+    """
+    if estimate["plan"] == "PLAN_A":
+        return execute_plan_a(sql_filter_string, v_query, limit_n=limit_n,
+                              n_estimated=estimate["n_filtered"], include_embedding=include_embedding)
+    if estimate["plan"] == "PLAN_IVF":
+        return execute_plan_ivf(sql_filter_string, v_query, limit_n=limit_n,
+                                n_estimated=estimate["n_filtered"])
+    return execute_plan_b(sql_filter_string, v_query, k_candidates=estimate["k_needed"],
+                          limit_n=limit_n, n_estimated=estimate["n_filtered"],
+                          include_embedding=include_embedding)
+
+def predicted_cost_ms(estimate):
+    """CBO 對所選計畫的預測耗時 (ms)。"""
+    key = {"PLAN_A": "score_a", "PLAN_IVF": "score_ivf"}.get(estimate["plan"], "score_b")
+    return estimate.get(key) or 0.0
+
+def hybrid_search(v_query, sql_filter_string, limit_n=N_RESULTS, use_cache=ENABLE_RESULT_CACHE,
+                  priority=admission_control.DEFAULT_PRIORITY):
+    """
+    完整的混合搜尋流程。回傳 {"plan": ..., "results": [...], "cache_hit": bool}。
+    命中結果快取時，不做 EXPLAIN、不執行計畫，也不連資料庫 (除了定期的版本檢查)。
+    計畫執行前經過准入控制 (admission_control)：負載過高時依 priority 排隊，或拋出 admission_control.Overloaded。
+    """
+    cache_key = cache_version = None
+    if use_cache:
+        with tracing.stage("cache_lookup"):
+            cache_key = result_cache.make_key(v_query, sql_filter_string, limit_n)
+            cached, cache_version = result_cache.get(cache_key)
+        if cached is not None:
+            plan, results = cached
+            tracing.set_plan("CACHE_HIT")
+            return {"plan": plan, "results": [dict(row) for row in results], "cache_hit": True}
+
+    with tracing.stage("cbo_decision"):
+        estimate = get_cbo_estimate(sql_filter_string, limit_n)
+    tracing.set_plan(estimate["plan"])
+    with admission_control.admit(estimate["plan"], predicted_cost_ms(estimate), priority):
+        results = execute_plan(estimate, sql_filter_string, v_query, limit_n)
+
+    # 執行失敗時 executor 回傳空 list；不要把失敗結果放進快取。
+    # 以查詢時的版本號存入：執行期間 catalog 已更新時 put() 會丟掉這個 (可能過期的) 結果
+    if use_cache and results:
+        result_cache.put(cache_key, (estimate["plan"], [dict(row) for row in results]), cache_version)
+    return {"plan": estimate["plan"], "results": results, "cache_hit": False}
+
+# --- 7.1 批次執行：多個 (查詢向量, 篩選) 一次送出 ---
+def build_batch_group_query(plan, sql_filter_string, k_candidates, limit_n):
+    """
+    一個 (篩選, 計畫) 群組的批次 SQL。參數：(查詢向量文字陣列, 原始序號陣列)
+    查詢向量與它在批次中的序號以 unnest(向量陣列, 序號陣列) 展開，每個向量以 LATERAL 子查詢取 Top-N。
+    計畫 A 的篩選結果先 MATERIALIZED 一次，群組內的所有查詢共用 (不必每個查詢重新篩選)。
+    """
+    queries = """
+        Q AS (
+            SELECT q.query_index, q.vec::vector AS v
+            FROM unnest(%s::text[], %s::int[]) AS q(vec, query_index)
+        )
+    """
+    if plan == "PLAN_A":
+        return sql.SQL("""
+            (WITH Filtered AS MATERIALIZED (
+                SELECT uniq_id, brand, sales_price, embedding FROM products WHERE {sql_filter}
+            ), {queries}
+            SELECT Q.query_index, r.uniq_id, r.brand, r.sales_price, r.similarity_score,
+                   (SELECT COUNT(*) FROM Filtered) AS filtered_total
+            FROM Q CROSS JOIN LATERAL (
+                SELECT uniq_id, brand, sales_price, (embedding <-> Q.v) AS similarity_score
+                FROM Filtered
+                ORDER BY similarity_score ASC
+                LIMIT {limit_n}
+            ) r)
+        """).format(sql_filter=filter_sql(sql_filter_string), queries=sql.SQL(queries),
+                    limit_n=sql.Literal(limit_n))
+    return sql.SQL("""
+        (WITH {queries}
+        SELECT Q.query_index, r.uniq_id, r.brand, r.sales_price, r.similarity_score,
+               NULL::bigint AS filtered_total
+        FROM Q CROSS JOIN LATERAL (
+            SELECT uniq_id, brand, sales_price, similarity_score FROM (
+                SELECT uniq_id, brand, sales_price, {filter_columns}, (embedding <-> Q.v) AS similarity_score
                 FROM products
-                ORDER BY embedding <-> %s
+                ORDER BY embedding <=> Q.v -- 與 idx_embedding_hnsw 的 vector_cosine_ops 一致
                 LIMIT {limit_k}
-            )
-            SELECT * FROM VectorCandidates
+            ) VectorCandidates
             WHERE {sql_filter}
             ORDER BY similarity_score ASC
-            LIMIT {limit_n};
-        """).format(
-            limit_k=sql.Literal(k_candidates),
-            sql_filter=sql.SQL(sql_filter_string),
-            limit_n=sql.Literal(limit_n)
-        )
-        
-        v_str = str(v_query)
-        cursor.execute(query_b, (v_str, v_str))
-        results = cursor.fetchall()
-        return [dict(row) for row in results]
+            LIMIT {limit_n}
+        ) r)
+    """).format(queries=sql.SQL(queries), filter_columns=CANDIDATE_FILTER_COLUMNS, limit_k=sql.Literal(k_candidates),
+                sql_filter=filter_sql(sql_filter_string), limit_n=sql.Literal(limit_n))
+
+def execute_batch(requests, limit_n=N_RESULTS):
+    """
+    批次執行多個查詢：requests 為 [(查詢向量, 篩選字串), ...]。
+    每個「不同的篩選」只做一次 CBO 決策，依 (篩選, 計畫) 分組；
+    所有 SQL 群組以 UNION ALL 組成一個陳述式 (連同 SET LOCAL hnsw.ef_search) 一次送出。
+    回傳與 requests 順序相同的 [{"plan": ..., "results": [...], "cache_hit": False}, ...]。
+    說明：批次耗時是多個查詢分攤後的成本，不回饋給 cost_model (會低估單一查詢的成本)；
+          計畫 A 的實際篩選筆數仍回饋給 selectivity_feedback。
+    """
+    outcomes = [None] * len(requests)
+    estimates = {}
+    groups = {}     # {(篩選, 計畫): [序號, ...]}
+    with tracing.stage("cbo_decision"):
+        for i, (v_query, sql_filter_string) in enumerate(requests):
+            sql_filter_string = sql_filter_string or "1 = 1"
+            if sql_filter_string not in estimates:
+                estimates[sql_filter_string] = get_cbo_estimate(sql_filter_string, limit_n)
+            plan = estimates[sql_filter_string]["plan"]
+            groups.setdefault((sql_filter_string, plan), []).append(i)
+
+    sql_groups = []
+    for (sql_filter_string, plan), indices in groups.items():
+        estimate = estimates[sql_filter_string]
+        pending = []
+        for i in indices:
+            # 程序內的後端 (IVF / NumPy) 沒有網路往返，逐一執行
+            rows = None
+            if plan == "PLAN_IVF":
+                rows = execute_plan_ivf(sql_filter_string, requests[i][0], limit_n, estimate["n_filtered"])
+            elif plan == "PLAN_A" and PLAN_A_BACKEND == "numpy" and current_shard() is None:
+                rows = _execute_plan_a_numpy(sql_filter_string, requests[i][0], limit_n, None)
+            if rows is None:
+                pending.append(i)
+            else:
+                outcomes[i] = {"plan": plan, "results": rows, "cache_hit": False}
+        if pending:
+            sql_groups.append((sql_filter_string, plan, estimate, pending))
 
+    for start in range(0, sum(len(g[3]) for g in sql_groups), BATCH_MAX_QUERIES):
+        chunk, offset = [], 0
+        for sql_filter_string, plan, estimate, indices in sql_groups:
+            selected = indices[max(0, start - offset):max(0, start + BATCH_MAX_QUERIES - offset)]
+            offset += len(indices)
+            if selected:
+                chunk.append((sql_filter_string, plan, estimate, selected))
+        for i, rows in _execute_batch_chunk(requests, chunk, limit_n).items():
+            outcomes[i] = {"plan": estimates[requests[i][1] or "1 = 1"]["plan"], "results": rows,
+                           "cache_hit": False}
+
+    for i, outcome in enumerate(outcomes):
+        if outcome is None:
+            outcomes[i] = {"plan": estimates[requests[i][1] or "1 = 1"]["plan"], "results": [], "cache_hit": False}
+    return outcomes
+
+def _build_batch_statement(cursor, requests, chunk, limit_n):
+    """
+    組出批次陳述式 (SET LOCAL hnsw.ef_search + 各群組的 UNION ALL) 與參數。
+    ef_search 取各計畫 B 群組所需 K 的最大值，但不超過 pgvector 的上限；
+    K 超過上限時與 execute_plan_b 相同：支援 iterative scan 就開啟，否則 K 降為上限。
+    """
+    parts, params = [], []
+    ef_search = HNSW_EF_SEARCH
+    iterative = False
+    for sql_filter_string, plan, estimate, indices in chunk:
+        k_candidates = estimate["k_needed"]
+        if plan == "PLAN_B":
+            if k_candidates > HNSW_EF_SEARCH_MAX and not supports_iterative_scan(cursor):
+                k_candidates = HNSW_EF_SEARCH_MAX
+            iterative = iterative or k_candidates > HNSW_EF_SEARCH_MAX
+            ef_search = max(ef_search, min(k_candidates, HNSW_EF_SEARCH_MAX))
+        parts.append(build_batch_group_query(plan, sql_filter_string, k_candidates, limit_n))
+        params.append([str(requests[i][0]) for i in indices])
+        params.append(indices)
+    settings = sql.SQL("SET LOCAL hnsw.ef_search = {};").format(sql.Literal(ef_search))
+    if iterative:
+        settings += sql.SQL(" SET LOCAL hnsw.iterative_scan = relaxed_order;")
+    query = settings + sql.SQL(" UNION ALL ").join(parts) + sql.SQL(" ORDER BY query_index, similarity_score;")
+    return query, params
+
+def _execute_batch_chunk(requests, chunk, limit_n):
+    """
+    執行一個批次陳述式，回傳 {請求序號: 結果 list}。
+    陳述式失敗時，若有多個群組就逐群組重試 (一個群組的錯誤不會讓整批的其他查詢都拿到空結果)；
+    單一群組仍失敗時回傳空 dict (呼叫端填入空結果)。
+    """
+    logger.info("--- [批次執行：%s 個查詢，%s 個群組] ---", sum(len(g[3]) for g in chunk), len(chunk))
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            query, params = _build_batch_statement(cursor, requests, chunk, limit_n)
+            with tracing.stage("plan_execute"):
+                cursor.execute(query, params)
+            with tracing.stage("fetch"):
+                results = cursor.fetchall()
     except Exception as e:
-        print(f"執行計畫 B 時發生錯誤：{e}")
-        return []
-    finally:
-        if conn:
-            conn.close()
+        if len(chunk) > 1:
+            logger.warning("批次執行時發生錯誤，改為逐群組執行：%s", e)
+            grouped = {}
+            for group in chunk:
+                grouped.update(_execute_batch_chunk(requests, [group], limit_n))
+            return grouped
+        logger.error("批次執行時發生錯誤 (篩選 %s, %s)：%s", chunk[0][0], chunk[0][1], e)
+        return {}
+
+    grouped = {i: [] for _, _, _, indices in chunk for i in indices}
+    filtered_totals = {}
+    for row in results:
+        row = dict(row)
+        i = row.pop("query_index")
+        total = row.pop("filtered_total")
+        if total is not None:
+            filtered_totals[requests[i][1] or "1 = 1"] = total
+        grouped[i].append(row)
+
+    if ENABLE_SELECTIVITY_FEEDBACK and current_shard() is None:
+        for sql_filter_string, plan, _, _ in chunk:
+            if plan == "PLAN_A":
+                # 篩選結果為空時沒有任何資料列帶回筆數，實際筆數就是 0
+                selectivity_feedback.record_actual(sql_filter_string, filtered_totals.get(sql_filter_string, 0))
+    return grouped
+
+# --- 7.2 分頁：keyset 游標與串流 ---
+# 游標 = 上一頁最後一筆的 (L2 距離, uniq_id)。下一頁只取 (距離, uniq_id) 大於游標的資料，
+# 不必以更大的 LIMIT 重跑再丟掉前面的結果。距離相同時以 uniq_id 決定順序，分頁之間不會重複或遺漏。
+# 計畫 B 需要 pgvector >= 0.8 的 hnsw.iterative_scan：索引掃描在篩選掉的資料之後繼續往下走，
+# 不受 ef_search 的候選數限制；不支援時分頁一律使用計畫 A (精確)。
+# 向量皆為單位向量，<=> (索引順序) 與 <-> (游標的距離) 的排序一致。
+_iterative_scan_supported = None
+
+def encode_cursor(row):
+    payload = json.dumps({"d": float(row["similarity_score"]), "id": row["uniq_id"]})
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+def decode_cursor(token):
+    """回傳 (距離, uniq_id)；格式錯誤時丟出 ValueError。"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        return float(payload["d"]), str(payload["id"])
+    except Exception as e:
+        raise ValueError(f"無效的分頁游標：{e}")
+
+def supports_iterative_scan(cursor):
+    """檢查 pgvector 是否支援 hnsw.iterative_scan (結果快取在模組層級)。"""
+    global _iterative_scan_supported
+    if _iterative_scan_supported is None:
+        # 先用一次 vector 型別，確保 pgvector 已載入、設定參數已註冊
+        cursor.execute("SELECT '[1]'::vector, current_setting('hnsw.iterative_scan', true);")
+        _iterative_scan_supported = cursor.fetchone()[1] is not None
+        if not _iterative_scan_supported:
+            logger.warning("pgvector 不支援 hnsw.iterative_scan (需要 0.8 以上)，分頁一律使用計畫 A")
+    return _iterative_scan_supported
+
+def build_page_query(plan, sql_filter_string, after=None, limit_n=None):
+    """
+    分頁查詢。參數：(查詢向量, [游標距離, 游標 uniq_id,] [查詢向量])
+    limit_n 為 None 時不加 LIMIT (iter_search 的 server-side cursor 使用)。
+    """
+    keyset = sql.SQL("AND ((embedding <-> %s), uniq_id) > (%s, %s)") if after is not None else sql.SQL("")
+    if plan == "PLAN_B":
+        order_by = sql.SQL("embedding <=> %s") # 必須與 idx_embedding_hnsw 一致才會走索引
+    else:
+        order_by = sql.SQL("similarity_score ASC, uniq_id ASC")
+    return sql.SQL("""
+        SELECT uniq_id, brand, sales_price, (embedding <-> %s) AS similarity_score
+        FROM products
+        WHERE ({sql_filter}) {keyset}
+        ORDER BY {order_by}
+        {limit};
+    """).format(
+        sql_filter=filter_sql(sql_filter_string), keyset=keyset, order_by=order_by,
+        limit=sql.SQL("LIMIT {}").format(sql.Literal(limit_n)) if limit_n is not None else sql.SQL(""),
+    )
+
+def _page_params(plan, v_str, after):
+    params = [v_str]
+    if after is not None:
+        params += [v_str, after[0], after[1]]
+    if plan == "PLAN_B":
+        params.append(v_str)
+    return params
+
+def _pagination_plan(cursor, cbo_plan, limit_n):
+    """
+    分頁使用的計畫：CBO 選 B (cbo_plan) 且支援 iterative scan 時用 B，其餘 (含 IVF) 用計畫 A 的 SQL。
+    cbo_plan 必須在借出 cursor 的連線「之前」以 get_cbo_estimate 取得：估計本身會再向連線池借連線
+    (EXPLAIN、關鍵字計數、bitmap 重建、catalog_version)，同時握著一條再去等另一條，連線池滿載時會互相卡死。
+    """
+    if cbo_plan == "PLAN_B" and supports_iterative_scan(cursor):
+        # strict_order：過濾後的結果仍依距離嚴格排序 (keyset 需要)
+        cursor.execute("SET LOCAL hnsw.iterative_scan = strict_order;")
+        cursor.execute("SET LOCAL hnsw.ef_search = %s;", (min(max(HNSW_EF_SEARCH, limit_n), HNSW_EF_SEARCH_MAX),))
+        return "PLAN_B"
+    return "PLAN_A"
+
+def search_page(v_query, sql_filter_string, limit_n=N_RESULTS, cursor_token=None):
+    """
+    回傳一頁結果：{"plan": ..., "results": [...], "next_cursor": 下一頁的游標 (沒有下一頁時為 None)}。
+    每一頁是獨立的請求 (HTTP 服務使用)：計畫 A 只對篩選結果取游標之後的 Top-N；
+    計畫 B 的索引掃描會從頭走到游標的位置，但不需要傳回、排序前面的資料。
+    """
+    after = decode_cursor(cursor_token) if cursor_token else None
+    try:
+        with tracing.stage("cbo_decision"):
+            cbo_plan = get_cbo_estimate(sql_filter_string, limit_n)["plan"]
+        with db_connection() as conn:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            plan = _pagination_plan(cursor, cbo_plan, limit_n)
+            tracing.set_plan(plan)
+            v_str = str(v_query)
+            # 多取一筆判斷是否還有下一頁
+            with tracing.stage("plan_execute"):
+                cursor.execute(build_page_query(plan, sql_filter_string, after, limit_n + 1),
+                               _page_params(plan, v_str, after))
+            with tracing.stage("fetch"):
+                rows = [dict(row) for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error("分頁查詢時發生錯誤：%s", e)
+        return {"plan": None, "results": [], "next_cursor": None}
+
+    has_more = len(rows) > limit_n
+    rows = rows[:limit_n]
+    return {"plan": plan, "results": rows, "next_cursor": encode_cursor(rows[-1]) if has_more and rows else None}
+
+def iter_search(v_query, sql_filter_string, page_size=N_RESULTS, cursor_token=None):
+    """
+    以 server-side cursor 串流結果，每次 yield 一頁 (list)。同一個掃描一路往下讀，不會重新開始；
+    產生器存在期間佔用一條連線 (與一個交易)，讀完或 close() 時歸還。適合批次工作或長連線的串流回應。
+    """
+    after = decode_cursor(cursor_token) if cursor_token else None
+    cbo_plan = get_cbo_estimate(sql_filter_string, page_size)["plan"]
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        plan = _pagination_plan(cursor, cbo_plan, page_size)
+        logger.info("--- [串流搜尋：%s，每頁 %s 筆] ---", plan, page_size)
+        stream = conn.cursor(name="cbo_iter_search", cursor_factory=psycopg2.extras.DictCursor)
+        stream.itersize = page_size
+        stream.execute(build_page_query(plan, sql_filter_string, after),
+                       _page_params(plan, str(v_query), after))
+        try:
+            while True:
+                rows = stream.fetchmany(page_size)
+                if not rows:
+                    return
+                yield [dict(row) for row in rows]
+        finally:
+            stream.close()
+
+# --- 7.3 屬性重排 (顏色 / 長度 / 風格 / 細節) ---
+# 查詢文字中出現 query_parser 列舉的屬性詞時，以 CLIP 文字向量 (原型) 與候選商品的向量做一次矩陣乘法，
+# 把「符合屬性的程度」加進排序。原型向量依詞快取，同一個詞只編碼一次；候選的向量由執行器一併取回。
+ATTRIBUTE_WORD_LISTS = {
+    "color": query_parser.COLOR_WORDS,
+    "length": query_parser.LENGTH_WORDS,
+    "style": query_parser.STYLE_WORDS,
+    "detail": query_parser.DETAIL_WORDS,
+}
+# 排序鍵 = similarity_score (L2 距離) - RERANK_WEIGHT × 屬性分數 (與原型的平均餘弦相似度)
+RERANK_WEIGHT = 0.5
+PROTOTYPE_TEMPLATE = "a photo of {} clothing"
+
+_prototype_cache = {}
+_prototype_lock = threading.Lock()
+
+def detect_attribute_terms(user_text, categories=tuple(ATTRIBUTE_WORD_LISTS)):
+    """回傳查詢文字中出現的屬性詞 (依 ATTRIBUTE_WORD_LISTS 的順序，不重複)。"""
+    text = (user_text or "").lower()
+    return [word for category in categories for word in ATTRIBUTE_WORD_LISTS[category] if _contains_word(text, word)]
+
+def _contains_word(text, word):
+    # 英文詞要求完整單字 ("red" 不應該符合 "ordered")；中文沒有空白分詞，直接比對子字串
+    if word.isascii():
+        return re.search(rf"(?<![a-z]){re.escape(word)}(?![a-z])", text) is not None
+    return word in text
+
+def prototype_embeddings(terms):
+    """回傳 (詞數, 768) 的原型向量矩陣；沒有快取的詞一次批次編碼。"""
+    with _prototype_lock:
+        missing = [term for term in terms if term not in _prototype_cache]
+        if missing:
+            encoded = query_parser.model.encode([PROTOTYPE_TEMPLATE.format(term) for term in missing],
+                                                normalize_embeddings=True)
+            for term, vec in zip(missing, encoded):
+                _prototype_cache[term] = np.asarray(vec, dtype=np.float32)
+        return np.vstack([_prototype_cache[term] for term in terms])
+
+def fetch_embeddings(uniq_ids):
+    """一次查詢取回多個商品的向量 (執行器沒有帶 embedding 時使用)。"""
+    with db_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT uniq_id, vector_send(embedding) FROM products WHERE uniq_id = ANY(%s);",
+                       (list(uniq_ids),))
+        return {uniq_id: embedding_store.decode_vector(buf) for uniq_id, buf in cursor.fetchall() if buf is not None}
+
+def rerank_by_attributes(results, user_text, weight=RERANK_WEIGHT, categories=tuple(ATTRIBUTE_WORD_LISTS)):
+    """
+    依查詢文字中的屬性詞重排結果 (回傳新的 list，並移除 "embedding" 欄位)。
+    每筆結果加上 "attribute_score"；查詢文字沒有屬性詞或模型未載入時，原順序回傳。
+    """
+    results = [dict(row) for row in results]
+    terms = detect_attribute_terms(user_text, categories)
+    if not results or not terms or query_parser.model is None:
+        for row in results:
+            row.pop("embedding", None)
+        return results
+
+    with tracing.stage("attribute_rerank"):
+        missing = [row["uniq_id"] for row in results if row.get("embedding") is None]
+        fetched = fetch_embeddings(missing) if missing else {}
+        embeddings = np.vstack([
+            row["embedding"] if row.get("embedding") is not None
+            else fetched.get(row["uniq_id"], np.zeros(embedding_store.EMBEDDING_DIM, dtype=np.float32))
+            for row in results
+        ]).astype(np.float32)
+        prototypes = prototype_embeddings(terms)
+        # (候選數, 768) @ (768, 詞數) -> 每個候選對每個屬性詞的餘弦相似度，取平均
+        attribute_scores = (embeddings @ prototypes.T).mean(axis=1)
+
+    for row, score in zip(results, attribute_scores):
+        row.pop("embedding", None)
+        row["attribute_score"] = float(score)
+    logger.info("屬性重排：%s (權重 %.2f)", terms, weight)
+    return sorted(results, key=lambda row: float(row["similarity_score"]) - weight * row["attribute_score"])
+
+def rerank_by_color(results, user_text, weight=RERANK_WEIGHT):
+    """experiment_1_accuracy.py 使用的名稱：依全部屬性詞 (不只顏色) 重排。"""
+    return rerank_by_attributes(results, user_text, weight)
 
 # --- 新增功能：儲存圖片 ---
 # [重要] 這個函式必須在主程式區塊之外，且縮排不能錯
@@ -0,0 +1,287 @@
+# ---
+# 檔名：cbo_regret.py
+# 目的：(Phase 6) CBO 決策後悔值 (regret) 分析與交叉點 (crossover) 搜尋
+# 功能：
+#   1. 產生一組選擇率由極稀有到很寬鬆的價格篩選 (並以 COUNT(*) 取得實際筆數)
+#   2. 對每個篩選 × 查詢向量，同時以 EXPLAIN ANALYZE 量測計畫 A 與計畫 B (使用 CBO 算出的 K) 的實際耗時，
+#      並記下 CBO (get_cbo_estimate) 當下會選哪一個
+#   3. 報告：
+#        - 實際交叉點選擇率 (計畫 A 與 B 的中位數耗時相等之處) vs 成本模型預測的交叉點
+#        - 決策錯誤率與總延遲後悔值 (選錯時多花的時間)
+#        - 以本次量測重新擬合的成本係數建議值，以及改用建議值後的錯誤率
+# 說明：
+#   計畫 B 的候選不足 (後篩選後湊不滿 N 筆) 時，它的結果是不完整的，這種情況一律視為計畫 A 較佳。
+# 執行方式：
+#   python cbo_regret.py --queries 5 [--save]     # --save 會把建議係數寫入 cost_model.json
+# ---
+
+import argparse
+import math
+import os
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2 import sql
+
+import cbo_proxy
+import cost_model
+
+load_dotenv()
+DB_SETTINGS = {
+    "host": os.environ.get("DB_HOST"),
+    "port": os.environ.get("DB_PORT"),
+    "user": os.environ.get("DB_USER"),
+    "password": os.environ.get("DB_PASSWORD"),
+    "database": os.environ.get("DB_NAME")
+}
+
+SELECTIVITIES = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5]
+N_QUERIES = 5
+LIMIT_N = cbo_proxy.N_RESULTS
+
+
+# --- 1. 篩選條件與查詢向量 ---
+def build_filters(cursor, selectivities=SELECTIVITIES):
+    """
+    以價格分位數產生目標選擇率的 BETWEEN 區間 (從中位數附近往外擴)，並以 COUNT(*) 取得實際筆數。
+    回傳 [{"target": 目標選擇率, "filter": SQL, "n_actual": 實際筆數}]。
+    """
+    filters = []
+    for target in selectivities:
+        lo_q, hi_q = max(0.0, 0.5 - target / 2), min(1.0, 0.5 + target / 2)
+        cursor.execute(
+            "SELECT percentile_cont(%s) WITHIN GROUP (ORDER BY sales_price), "
+            "       percentile_cont(%s) WITHIN GROUP (ORDER BY sales_price) "
+            "FROM products WHERE sales_price IS NOT NULL;",
+            (lo_q, hi_q)
+        )
+        lo, hi = cursor.fetchone()
+        sql_filter = f"sales_price BETWEEN {float(lo):.2f} AND {float(hi):.2f}"
+        cursor.execute(sql.SQL("SELECT COUNT(*) FROM products WHERE {f};").format(f=sql.SQL(sql_filter)))
+        filters.append({"target": target, "filter": sql_filter, "n_actual": cursor.fetchone()[0]})
+    return filters
+
+
+def sample_query_vectors(cursor, n):
+    cursor.execute(
+        "SELECT embedding::text FROM products TABLESAMPLE SYSTEM (1) WHERE embedding IS NOT NULL LIMIT %s;",
+        (n,)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+# --- 2. EXPLAIN ANALYZE 量測 ---
+def explain_analyze(cursor, query, params):
+    """回傳 (執行時間 ms, 實際回傳筆數)。"""
+    cursor.execute(sql.SQL("EXPLAIN (ANALYZE, FORMAT JSON) ") + query, params)
+    plan = cursor.fetchone()[0]
+    plan = plan[0] if isinstance(plan, list) else plan
+    return plan["Execution Time"], plan["Plan"]["Actual Rows"]
+
+
+def _hnsw_settings(cursor, k_needed):
+    """
+    設定計畫 B 的 hnsw.ef_search (不超過 pgvector 的上限)，回傳 (實際使用的 K, ef_search)，與 cbo_proxy.execute_plan_b 相同：
+    K 超過上限時改用 iterative scan，不支援時 K 降為 ef_search。連線是 autocommit，所以用 SET 而不是 SET LOCAL。
+    """
+    ef_search = min(max(cbo_proxy.HNSW_EF_SEARCH, k_needed), cbo_proxy.HNSW_EF_SEARCH_MAX)
+    cursor.execute("SET hnsw.ef_search = %s;", (ef_search,))
+    if cbo_proxy.supports_iterative_scan(cursor):
+        mode = "relaxed_order" if k_needed > ef_search else "off"
+        cursor.execute(sql.SQL("SET hnsw.iterative_scan = {};").format(sql.SQL(mode)))
+        return k_needed, ef_search
+    return min(k_needed, ef_search), ef_search
+
+
+def measure(cursor, filters, query_vectors, total_rows, limit_n=LIMIT_N):
+    samples = []
+    for f in filters:
+        estimate = cbo_proxy.get_cbo_estimate(f["filter"], limit_n)
+        try:
+            k_needed, ef_search = _hnsw_settings(cursor, estimate["k_needed"])
+        except psycopg2.Error as e:
+            print(f"  ❌ 篩選 {f['filter']} 無法設定 HNSW 參數，略過：{e}")
+            continue
+        query_a = cbo_proxy.build_plan_a_query(f["filter"], limit_n)
+        query_b = cbo_proxy.build_plan_b_query(f["filter"], k_needed, limit_n)
+
+        measured, failed = [], 0
+        for i, v_str in enumerate(query_vectors):
+            # 交替執行順序，避免「後執行的那個總是吃到熱快取」
+            try:
+                if i % 2 == 0:
+                    ms_a, _ = explain_analyze(cursor, query_a, (v_str,))
+                    ms_b, rows_b = explain_analyze(cursor, query_b, (v_str, v_str))
+                else:
+                    ms_b, rows_b = explain_analyze(cursor, query_b, (v_str, v_str))
+                    ms_a, _ = explain_analyze(cursor, query_a, (v_str,))
+            except psycopg2.Error as e:
+                # 單一量測失敗只略過這一點，不中斷整份報告 (連線是 autocommit，不會卡在失敗的交易中)
+                failed += 1
+                print(f"  ❌ 量測失敗 ({f['filter']})：{e}")
+                continue
+            measured.append({
+                **f,
+                "n_estimated": estimate["n_filtered"],
+                "k_needed": k_needed, "ef_search": ef_search,
+                "ms_a": ms_a, "ms_b": ms_b,
+                "b_complete": rows_b >= min(limit_n, f["n_actual"]),
+                "cbo_plan": estimate["plan"],
+            })
+        samples.extend(measured)
+        if not measured:
+            continue
+        print(f"  選擇率 {f['n_actual'] / max(1, total_rows):.4%} ({f['n_actual']} 筆)："
+              f"A={np.median([s['ms_a'] for s in measured]):.2f}ms, "
+              f"B={np.median([s['ms_b'] for s in measured]):.2f}ms (K={k_needed}), "
+              f"CBO 選 {estimate['plan']}" + (f"，{failed} 次量測失敗" if failed else ""))
+    return samples
+
+
+# --- 3. 分析 ---
+def best_plan(sample):
+    if not sample["b_complete"] or sample["ms_a"] <= sample["ms_b"]:
+        return "PLAN_A"
+    return "PLAN_B"
+
+
+def decide(params, n_estimated, total_rows, limit_n=LIMIT_N):
+    """以指定的成本係數重演 CBO 的決策 (用來評估建議係數)。"""
+    if n_estimated is None:
+        return "PLAN_B"
+    costs = cbo_proxy.estimate_plan_costs(n_estimated, total_rows, limit_n, params=params)
+    return "PLAN_A" if costs["score_a"] < costs["score_b"] else "PLAN_B"
+
+
+def regret_stats(samples, chosen_plans):
+    wrong, regret_ms, incomplete = 0, 0.0, 0
+    for sample, chosen in zip(samples, chosen_plans):
+        best = best_plan(sample)
+        if chosen != best:
+            wrong += 1
+            chosen_ms = sample["ms_a"] if chosen == "PLAN_A" else sample["ms_b"]
+            best_ms = sample["ms_a"] if best == "PLAN_A" else sample["ms_b"]
+            regret_ms += max(0.0, chosen_ms - best_ms)
+        if chosen == "PLAN_B" and not sample["b_complete"]:
+            incomplete += 1
+    return {"wrong_rate": wrong / len(samples) if samples else 0.0,
+            "regret_ms": regret_ms, "incomplete_results": incomplete}
+
+
+def _interpolate_crossover(points):
+    """points: [(選擇率, A 耗時 - B 耗時)]，依選擇率排序；回傳第一次由負轉正的位置 (log 內插)。"""
+    for (s0, d0), (s1, d1) in zip(points, points[1:]):
+        if d0 < 0 <= d1:
+            if s0 <= 0 or d1 == d0 or not math.isfinite(d0):
+                return s1
+            t = -d0 / (d1 - d0)
+            return math.exp(math.log(s0) + t * (math.log(s1) - math.log(s0)))
+    return None
+
+
+def true_crossover(samples, total_rows):
+    by_filter = {}
+    for sample in samples:
+        by_filter.setdefault(sample["filter"], []).append(sample)
+    points = []
+    for group in by_filter.values():
+        selectivity = group[0]["n_actual"] / total_rows
+        ms_a = np.median([s["ms_a"] for s in group])
+        # 計畫 B 多數時候結果不完整時，視為比計畫 A 慢
+        if np.mean([s["b_complete"] for s in group]) < 0.5:
+            ms_b = math.inf
+        else:
+            ms_b = np.median([s["ms_b"] for s in group])
+        points.append((selectivity, ms_a - ms_b))
+    return _interpolate_crossover(sorted(points))
+
+
+def predicted_crossover(params, total_rows, limit_n=LIMIT_N):
+    grid = np.logspace(-5, 0, 200)
+    points = []
+    for selectivity in grid:
+        costs = cbo_proxy.estimate_plan_costs(selectivity * total_rows, total_rows, limit_n, params=params)
+        points.append((float(selectivity), costs["score_a"] - costs["score_b"]))
+    return _interpolate_crossover(points)
+
+
+def suggest_params(samples, current):
+    """以本次量測重新擬合成本係數；樣本不足時保留目前的值。"""
+    suggested = dict(current)
+    fit_a = cost_model.fit_plan_a([{"plan": "PLAN_A", "n_rows": s["n_actual"], "ms": s["ms_a"]} for s in samples])
+    if fit_a:
+        suggested["c_vec_cpu_cost"], suggested["cost_a_fixed"] = max(fit_a[0], 0.0), max(fit_a[1], 0.0)
+    b_samples = [s for s in samples if s["b_complete"]]
+    if b_samples:
+        suggested.update(cost_model.fit_plan_b_samples(
+            [s["k_needed"] for s in b_samples], [s["ef_search"] for s in b_samples],
+            [s["ms_b"] for s in b_samples], current
+        ))
+    return suggested
+
+
+def _fmt_selectivity(value):
+    return "找不到 (範圍內只有一個計畫勝出)" if value is None else f"{value:.4%}"
+
+
+def report(samples, total_rows, save=False):
+    current = cost_model.get_params()
+    suggested = suggest_params(samples, current)
+
+    current_stats = regret_stats(samples, [s["cbo_plan"] for s in samples])
+    suggested_stats = regret_stats(
+        samples, [decide(suggested, s["n_estimated"], total_rows) for s in samples]
+    )
+    oracle_ms = sum(min(s["ms_a"], s["ms_b"]) if s["b_complete"] else s["ms_a"] for s in samples)
+
+    print("\n" + "=" * 70)
+    print(f"📊 CBO 後悔值分析 ({len(samples)} 次量測，共 {total_rows} 筆資料)")
+    print("=" * 70)
+    print(f"實際交叉點選擇率        : {_fmt_selectivity(true_crossover(samples, total_rows))}")
+    print(f"目前模型預測的交叉點    : {_fmt_selectivity(predicted_crossover(current, total_rows))}")
+    print(f"建議係數預測的交叉點    : {_fmt_selectivity(predicted_crossover(suggested, total_rows))}")
+    print("-" * 70)
+    print(f"目前係數：決策錯誤率 {current_stats['wrong_rate']:.1%}，總後悔值 {current_stats['regret_ms']:.1f} ms "
+          f"(最佳總耗時 {oracle_ms:.1f} ms)，計畫 B 結果不完整 {current_stats['incomplete_results']} 次")
+    print(f"建議係數：決策錯誤率 {suggested_stats['wrong_rate']:.1%}，總後悔值 {suggested_stats['regret_ms']:.1f} ms，"
+          f"計畫 B 結果不完整 {suggested_stats['incomplete_results']} 次")
+    print("-" * 70)
+    print(f"{'係數':<16} | {'目前':>12} | {'建議':>12}")
+    for name in ("c_vec_cpu_cost", "cost_a_fixed", "cost_b_fixed", "cost_b_per_k", "cost_b_per_ef"):
+        print(f"{name:<16} | {current[name]:>12.6f} | {suggested[name]:>12.6f}")
+    print("=" * 70)
+
+    if save:
+        cost_model.save_model(suggested, {"cbo_regret": len(samples)})
+        print(f"✅ 已把建議係數寫入 {cost_model.MODEL_FILE}")
+    return {"current": current_stats, "suggested": suggested_stats, "suggested_params": suggested}
+
+
+# --- 主程式區塊 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="量測 CBO 決策的錯誤率與後悔值，並建議成本係數")
+    parser.add_argument("--queries", type=int, default=N_QUERIES, help="每個篩選使用的查詢向量數")
+    parser.add_argument("--selectivities", type=float, nargs="+", default=SELECTIVITIES)
+    parser.add_argument("--save", action="store_true", help="把建議係數寫入 cost_model.json")
+    args = parser.parse_args()
+
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_SETTINGS)
+        conn.autocommit = True
+        cursor = conn.cursor()
+        total_rows = cbo_proxy.get_total_rows(cursor)
+
+        print(f"🚀 產生 {len(args.selectivities)} 個篩選條件...")
+        filters = build_filters(cursor, args.selectivities)
+        query_vectors = sample_query_vectors(cursor, args.queries)
+        print(f"🔎 以 EXPLAIN ANALYZE 量測計畫 A / B ({len(query_vectors)} 個查詢向量)...")
+        samples = measure(cursor, filters, query_vectors, total_rows)
+        if samples:
+            report(samples, total_rows, save=args.save)
+    except Exception as e:
+        print(f"❌ 錯誤: {e}")
+    finally:
+        if conn:
+            conn.close()
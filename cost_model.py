@@ -0,0 +1,306 @@
+# ---
+# 檔名：cost_model.py
+# 目的：(Phase 4 延伸) CBO 成本參數的「線上學習」
+# 功能：
+#   1. 每次執行計畫後，把 (預估筆數, K, ef_search, 實際耗時) 記錄到輕量的 JSONL 觀測檔
+#   2. 背景執行緒 (start_background_refit，由長駐服務啟動) 定期重新擬合成本係數 (有上下限，並做平滑)，寫入 cost_model.json
+#   3. cbo_proxy.get_cbo_decision 每次決策都讀取「目前」的係數，而不是寫死的常數
+# 原理：
+#   - 計畫 A：Time = C_VEC_CPU_COST * N + COST_A_FIXED  (與 calibrate_cost.py 相同的線性模型)
+#   - 計畫 B：Time = COST_B_FIXED + COST_B_PER_K * K + COST_B_PER_EF * ef_search
+#             (K 越大，HNSW 要走的圖越多、回表的 tuple 也越多；由 calibrate_hnsw.py 掃描 K/ef 擬合)
+#   - 計畫 IVF：Time = COST_IVF_FIXED + COST_IVF_PER_ROW * 掃描的 list 資料列數 (ivf_index.py)
+# ---
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# --- 1. 檔案位置 ---
+OBSERVATION_FILE = os.environ.get("CBO_OBSERVATION_FILE", "cost_observations.jsonl")
+MODEL_FILE = os.environ.get("CBO_COST_MODEL_FILE", "cost_model.json")
+
+# --- 2. 擬合設定 ---
+# 沒有模型檔時使用的初始值 (來自 calibrate_cost.py / calibrate_hnsw.py 的一次性校準)
+# (計畫 B 的預設值讓 K=200, ef_search=200 時約為 9.0ms，與舊的 COST_B_FIXED 一致)
+DEFAULT_PARAMS = {
+    "c_vec_cpu_cost": 0.0016,
+    "cost_a_fixed": 0.0,
+    "cost_b_fixed": 1.0,
+    "cost_b_per_k": 0.03,
+    "cost_b_per_ef": 0.01,
+    "cost_ivf_fixed": 0.5,
+    "cost_ivf_per_row": 0.0002,
+}
+
+# 每個係數允許的範圍，避免少數離群觀測把係數拉到不合理的值
+PARAM_BOUNDS = {
+    "c_vec_cpu_cost": (0.00005, 0.05),
+    "cost_a_fixed": (0.0, 100.0),
+    "cost_b_fixed": (0.1, 1000.0),
+    "cost_b_per_k": (0.0, 1.0),
+    "cost_b_per_ef": (0.0, 1.0),
+    "cost_ivf_fixed": (0.0, 100.0),
+    "cost_ivf_per_row": (0.000001, 0.05),
+}
+
+MIN_SAMPLES = 20            # 每個計畫至少要有這麼多筆觀測才重新擬合
+MAX_SAMPLES = 5000          # 只用最近的觀測 (資料與快取狀態會隨時間改變)
+SMOOTHING = 0.3             # 新係數 = 舊係數 * (1 - SMOOTHING) + 擬合值 * SMOOTHING
+REFIT_INTERVAL_S = 60.0     # 背景重新擬合的間隔 (秒)
+
+# --- 3. 模組狀態 ---
+# _lock 只保護記憶體內的係數 (每次 CBO 決策都會取得)；觀測檔的讀寫另外以 _observation_lock 保護，
+# 檔案 I/O (尤其是重新擬合時讀取 / 壓縮整個觀測檔) 不會卡住決策
+_lock = threading.Lock()
+_observation_lock = threading.Lock()
+_params = dict(DEFAULT_PARAMS)
+_refit_thread = None
+_stop_event = threading.Event()
+
+
+def _clamp(name, value):
+    lo, hi = PARAM_BOUNDS[name]
+    return float(min(hi, max(lo, value)))
+
+
+def load_model(defaults=None):
+    """
+    載入 cost_model.json (若存在)，以 defaults 補齊缺少的係數，並套用上下限。
+    """
+    global _params
+    params = dict(DEFAULT_PARAMS)
+    if defaults:
+        params.update(defaults)
+
+    if os.path.exists(MODEL_FILE):
+        try:
+            with open(MODEL_FILE, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            params.update({k: v for k, v in saved.get("params", {}).items() if k in params})
+        except (OSError, ValueError) as e:
+            print(f"[Cost Model] 無法讀取 {MODEL_FILE}，使用預設係數：{e}")
+
+    with _lock:
+        _params = {k: _clamp(k, v) if k in PARAM_BOUNDS else v for k, v in params.items()}
+    return get_params()
+
+
+def get_params():
+    """回傳目前成本係數的副本 (執行緒安全)。"""
+    with _lock:
+        return dict(_params)
+
+
+def save_model(params, n_samples=None):
+    """以「寫入暫存檔再 rename」的方式原子性地寫入模型檔。"""
+    payload = {
+        "params": params,
+        "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "n_samples": n_samples or {},
+    }
+    tmp_path = MODEL_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, indent=2)
+    os.replace(tmp_path, MODEL_FILE)
+
+
+def record_observation(plan, n_rows, k, ef_search, elapsed_ms):
+    """
+    記錄一次計畫執行的觀測值。
+    plan: "PLAN_A" / "PLAN_B" / "PLAN_IVF"；n_rows: 預估 (或實際) 篩選筆數；elapsed_ms: 實際耗時。
+    """
+    record = {
+        "ts": time.time(),
+        "plan": plan,
+        "n_rows": None if n_rows is None else float(n_rows),
+        "k": k,
+        "ef_search": ef_search,
+        "ms": float(elapsed_ms),
+    }
+    line = json.dumps(record) + "\n"
+    try:
+        with _observation_lock:
+            with open(OBSERVATION_FILE, "a", encoding="utf-8") as f:
+                f.write(line)
+    except OSError as e:
+        print(f"[Cost Model] 無法寫入觀測檔：{e}")
+
+
+def load_observations(limit=MAX_SAMPLES):
+    """讀取最近 limit 筆觀測。"""
+    if not os.path.exists(OBSERVATION_FILE):
+        return []
+    with _observation_lock:
+        with open(OBSERVATION_FILE, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+
+    observations = []
+    for line in lines[-limit:]:
+        try:
+            observations.append(json.loads(line))
+        except ValueError:
+            continue  # 忽略寫到一半的行
+    return observations
+
+
+def _compact_observations():
+    """觀測檔超過 2 * MAX_SAMPLES 行時，只保留最近 MAX_SAMPLES 行。"""
+    if not os.path.exists(OBSERVATION_FILE):
+        return
+    with _observation_lock:
+        with open(OBSERVATION_FILE, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        if len(lines) <= 2 * MAX_SAMPLES:
+            return
+        tmp_path = OBSERVATION_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(lines[-MAX_SAMPLES:])
+        os.replace(tmp_path, OBSERVATION_FILE)
+
+
+def _fit_linear(observations, plan):
+    rows = [(o["n_rows"], o["ms"]) for o in observations
+            if o.get("plan") == plan and o.get("n_rows")]
+    if len(rows) < MIN_SAMPLES:
+        return None
+    n = np.array([r[0] for r in rows], dtype=float)
+    ms = np.array([r[1] for r in rows], dtype=float)
+    if np.ptp(n) == 0:
+        return None
+    slope, intercept = np.polyfit(n, ms, 1)
+    return slope, intercept
+
+
+def fit_plan_a(observations):
+    """
+    以最小平方法擬合 Time = a * N + b，回傳 (a, b)；樣本不足或 N 沒有變化時回傳 None。
+    """
+    return _fit_linear(observations, "PLAN_A")
+
+
+def fit_plan_ivf(observations):
+    """擬合 Time = a * 掃描列數 + b (n_rows 記錄的是 IVF 實際掃描的資料列數)。"""
+    return _fit_linear(observations, "PLAN_IVF")
+
+
+def plan_b_cost(params, k, ef_search):
+    """
+    計畫 B 的預測耗時 (ms)。
+    pgvector 的 HNSW 掃描最多只回傳 ef_search 筆，所以實際生效的 ef 是 max(ef_search, K)。
+    """
+    ef_eff = max(ef_search, k)
+    return params["cost_b_fixed"] + params["cost_b_per_k"] * k + params["cost_b_per_ef"] * ef_eff
+
+
+def fit_plan_b_samples(k_values, ef_values, ms_values, current=None):
+    """
+    以最小平方法擬合 Time = b0 + b_k * K + b_ef * ef_eff，回傳 {係數名: 值}。
+    若 K 或 ef 沒有變化 (例如線上觀測都用同一組設定)，該項斜率沿用 current 的值，只擬合其餘項。
+    """
+    current = current or DEFAULT_PARAMS
+    k = np.asarray(k_values, dtype=float)
+    ef = np.maximum(np.asarray(ef_values, dtype=float), k)
+    ms = np.asarray(ms_values, dtype=float)
+
+    columns = [np.ones_like(k)]
+    names = ["cost_b_fixed"]
+    target = ms.copy()
+    for name, x in (("cost_b_per_k", k), ("cost_b_per_ef", ef)):
+        if np.ptp(x) > 0:
+            columns.append(x)
+            names.append(name)
+        else:
+            target -= current[name] * x
+
+    coef, *_ = np.linalg.lstsq(np.column_stack(columns), target, rcond=None)
+    return dict(zip(names, (float(c) for c in coef)))
+
+
+def fit_plan_b(observations, current=None):
+    """從線上觀測擬合計畫 B 的係數；樣本不足時回傳 None。"""
+    rows = [(o["k"], o["ef_search"], o["ms"]) for o in observations
+            if o.get("plan") == "PLAN_B" and o.get("k") and o.get("ef_search")]
+    if len(rows) < MIN_SAMPLES:
+        return None
+    k, ef, ms = zip(*rows)
+    return fit_plan_b_samples(k, ef, ms, current)
+
+
+def refit():
+    """
+    讀取最近的觀測，重新擬合成本係數，並寫入模型檔。
+    回傳更新後的係數。
+    """
+    global _params
+    _compact_observations()
+    observations = load_observations()
+    current = get_params()
+    updated = dict(current)
+
+    fitted = {}
+    fit_a = fit_plan_a(observations)
+    if fit_a is not None:
+        fitted["c_vec_cpu_cost"], fitted["cost_a_fixed"] = fit_a
+    fit_b = fit_plan_b(observations, current)
+    if fit_b is not None:
+        fitted.update(fit_b)
+    fit_ivf = fit_plan_ivf(observations)
+    if fit_ivf is not None:
+        fitted["cost_ivf_per_row"], fitted["cost_ivf_fixed"] = fit_ivf
+
+    if not fitted:
+        return current
+
+    for name, value in fitted.items():
+        blended = current[name] * (1 - SMOOTHING) + value * SMOOTHING
+        updated[name] = _clamp(name, blended)
+
+    with _lock:
+        _params = dict(updated)
+
+    n_samples = {
+        "PLAN_A": sum(1 for o in observations if o.get("plan") == "PLAN_A"),
+        "PLAN_B": sum(1 for o in observations if o.get("plan") == "PLAN_B"),
+        "PLAN_IVF": sum(1 for o in observations if o.get("plan") == "PLAN_IVF"),
+    }
+    try:
+        save_model(updated, n_samples)
+    except OSError as e:
+        print(f"[Cost Model] 無法寫入模型檔：{e}")
+    return dict(updated)
+
+
+def _refit_loop(interval_s):
+    while not _stop_event.wait(interval_s):
+        try:
+            refit()
+        except Exception as e:
+            print(f"[Cost Model] 背景重新擬合失敗：{e}")
+
+
+def start_background_refit(interval_s=REFIT_INTERVAL_S):
+    """啟動背景重新擬合執行緒 (重複呼叫不會啟動第二個)。"""
+    global _refit_thread
+    if _refit_thread is not None and _refit_thread.is_alive():
+        return
+    _stop_event.clear()
+    _refit_thread = threading.Thread(
+        target=_refit_loop, args=(interval_s,), name="cost-model-refit", daemon=True
+    )
+    _refit_thread.start()
+
+
+def stop_background_refit():
+    _stop_event.set()
+
+
+# --- 主程式區塊：手動重新擬合並印出目前係數 ---
+if __name__ == "__main__":
+    load_model()
+    print("目前係數：", json.dumps(get_params(), indent=2))
+    print(f"讀取 {len(load_observations())} 筆觀測，重新擬合中...")
+    print("更新後係數：", json.dumps(refit(), indent=2))
@@ -8,6 +8,7 @@ import psycopg2
 from psycopg2 import sql # 用於安全地組合 SQL 查詢
 import os
 from dotenv import load_dotenv # 用於讀取 .env 檔案
+import stats_maintenance # 篩選欄位的統計目標 (SET STATISTICS)
 
 # --- 1. 載入設定 ---
 
@@ -47,17 +48,17 @@ def create_database_schema():
         # 建立一個「遊標 (cursor)」，用來傳送 SQL 指令
         cursor = conn.cursor()
         
-        # --- 4. 步驟 1/3：啟用 pg_vector 擴充 (「矛」的基礎) ---
+        # --- 4. 步驟 1/5：啟用 pg_vector 擴充 (「矛」的基礎) ---
         # 這是我們「AI 矛」的「必要基礎」。
         # 只有執行了這一步，PostgreSQL 才「認得」 VECTOR(768) 這種欄位類型。
         # IF NOT EXISTS 確保我們重複執行此腳本時不會報錯。
-        print("步驟 1/3：啟用 'vector' 擴充 (CREATE EXTENSION IF NOT EXISTS vector)...")
+        print("步驟 1/5：啟用 'vector' 擴充 (CREATE EXTENSION IF NOT EXISTS vector)...")
         cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
         
-        # --- 5. 步驟 2/3：建立 'products' 資料表 (「矛」與「盾」的家) ---
+        # --- 5. 步驟 2/5：建立 'products' 資料表 (「矛」與「盾」的家) ---
         # 這是我們專案「唯一」的主資料表。
         # 我們「刻意」選擇了這些欄位，以同時滿足「矛」和「盾」的需求。
-        print(f"步驟 2/3：建立 'products' 資料表 (向量維度 {EMBEDDING_DIM})...")
+        print(f"步驟 2/5：建立 'products' 資料表 (向量維度 {EMBEDDING_DIM})...")
         
         # [注意] PostgreSQL 會自動將未加引號的 'Products' 轉為 'products' (小寫)
         # 我們在這裡統一使用小寫，以避免混淆。
@@ -83,22 +84,55 @@ def create_database_schema():
         # 執行建立表格的 SQL 指令
         cursor.execute(create_table_query)
         
-        # --- 6. 步驟 3/3：建立 B-Tree 索引 (「盾」的武器) ---
+        # --- 6. 步驟 3/5：建立 B-Tree 索引 (「盾」的武器) ---
         # 這是「DB 盾 (CBO)」的「關鍵準備」。
         # 這是為了「武裝」我們的 CBO「計畫 A (SQL-First)」。
         # 有了這些索引，`WHERE brand = 'Gucci'` 才能在毫秒級完成。
-        print("步驟 3/3：建立 'B-Tree' 索引 (為了 CBO)...")
+        print("步驟 3/5：建立 'B-Tree' 索引 (為了 CBO)...")
         
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_brand ON products USING btree(brand);")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_price ON products USING btree(sales_price);")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_rating ON products USING btree(rating);")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_amazon_prime ON products USING btree(amazon_prime_y_or_n);")
 
+        # --- 6.1 步驟 4/5：建立 trigram GIN 索引 (關鍵字篩選) ---
+        # `product_name ILIKE '%black%'` 這種前後都有萬用字元的條件，B-Tree 幫不上忙，只能循序掃描。
+        # pg_trgm 的 GIN 索引把字串拆成三字元組，ILIKE '%...%' 可以走 Bitmap Index Scan。
+        print("步驟 4/5：建立 'pg_trgm' GIN 索引 (為了 product_name 關鍵字篩選)...")
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_name_trgm ON products USING gin(product_name gin_trgm_ops);")
+
+        # --- 6.2 步驟 5/5：建立 'catalog_version' 版本表 (結果快取的失效依據) ---
+        # 每次匯入資料寫入 products 時，input_to_db.py 會把 products 的 version + 1，
+        # 搜尋服務 (result_cache.py) 發現版本改變就清空快取。
+        # rows_since_analyze / stats_version 供 stats_maintenance.py 判斷何時需要重新 ANALYZE。
+        print("步驟 5/5：建立 'catalog_version' 版本表 (為了結果快取失效)...")
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            table_name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            rows_since_analyze BIGINT NOT NULL DEFAULT 0,
+            stats_version BIGINT NOT NULL DEFAULT 0,
+            analyzed_at TIMESTAMPTZ
+        );
+        """)
+        cursor.execute("""
+        INSERT INTO catalog_version (table_name, version) VALUES ('products', 0)
+        ON CONFLICT (table_name) DO NOTHING;
+        """)
+
+        # sales_price / brand 的統計目標調高，ANALYZE 後直方圖與常見值清單更細 (CBO 預估更準)
+        stats_maintenance.apply_statistics_targets(cursor)
+
         print("\n" + "="*40)
         print("【成功！】資料庫結構建立完畢！")
         print(f" - 已在 '{DB_SETTINGS['database']}' 中啟用 'vector'")
         print(f" - 已建立 'products' 表格")
         print(f" - 已建立 4 個 B-Tree 索引 (用於 CBO)")
+        print(f" - 已建立 product_name 的 trigram GIN 索引 (用於關鍵字篩選)")
+        print(f" - 已建立 'catalog_version' 版本表 (用於結果快取失效)")
+        print(f" - 已設定統計目標：" + ", ".join(f"{col}={target}" for col, target in stats_maintenance.STATISTICS_TARGETS.items()))
         print("="*40)
         print("\n下一步：請執行 'offline_vectorize_and_insert.py'")
 
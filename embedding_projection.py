@@ -0,0 +1,350 @@
+# ---
+# 檔名：embedding_projection.py
+# 目的：(Phase 6) 整個目錄的向量投影 (2D / 3D 座標)，存成可重複使用的檔案，供 test.ipynb 的視覺化使用
+# 功能：
+#   1. fit   ：以 server-side cursor 分批讀取全部向量 (vector_send 二進位)，
+#              第一輪以 IncrementalPCA.partial_fit 逐塊擬合 (768 -> 50 維)，第二輪逐塊投影；
+#              layout="pca" 時直接取前 2 / 3 個主成分當座標；
+#              layout="umap" 時以 UMAP (近似最近鄰圖，適合大量資料) 在 50 維空間上排版，
+#              資料很多時只以 LAYOUT_FIT_ROWS 筆擬合，其餘以 transform 放上去
+#   2. update：catalog 版本改變時只處理差異：刪除已不存在的資料列，新資料列
+#              layout="pca" 以同一個投影精確計算；layout="umap" 以資料庫的 HNSW 索引找出最近的既有商品，
+#              取它們座標的平均 (不需要重新排版)
+#   3. 投影、座標、uniq_id / brand / sales_price 與 catalog 版本一起存成 embedding_projection.npz
+# 說明：
+#   test.ipynb 原本每次執行都重新抽樣 5000 筆並重跑 PCA + t-SNE (O(N^2)，要好幾分鐘)；
+#   改用 get_projection() 之後，版本沒變就直接讀檔，整個目錄的圖幾秒內就能畫出來。
+# 執行方式：
+#   python embedding_projection.py fit --layout pca
+#   python embedding_projection.py fit --layout umap      (需要 pip install umap-learn)
+#   python embedding_projection.py update
+#   python embedding_projection.py status
+# ---
+
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+from sklearn.decomposition import IncrementalPCA
+
+import embedding_store
+import result_cache
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+DB_SETTINGS = {
+    "host": os.environ.get("DB_HOST"),
+    "port": os.environ.get("DB_PORT"),
+    "user": os.environ.get("DB_USER"),
+    "password": os.environ.get("DB_PASSWORD"),
+    "database": os.environ.get("DB_NAME")
+}
+
+PROJECTION_PATH = os.environ.get("CBO_PROJECTION", "embedding_projection.npz")
+PCA_COMPONENTS = 50         # 中間的 PCA 維度 (UMAP 在這個空間上排版)
+CHUNK_SIZE = 20000          # 每塊的資料列數 (必須 >= PCA_COMPONENTS)
+LAYOUTS = ("pca", "umap")
+
+# UMAP 擬合時最多使用的資料列數；超過的部分以 transform 投影
+LAYOUT_FIT_ROWS = 200000
+UMAP_NEIGHBORS = 15
+
+# 增量更新時，每一筆新資料以 HNSW 找出幾個最近的既有商品
+UPDATE_NEIGHBORS = 10
+
+
+# --- 1. 分塊讀取 ---
+def iter_chunks(conn, uniq_ids=None, chunk_size=CHUNK_SIZE):
+    """
+    以 server-side cursor 分批讀取 (uniq_id, brand, sales_price, 向量矩陣)。
+    uniq_ids 不為 None 時只讀取這些資料列。
+    """
+    select_sql = """
+        SELECT uniq_id, brand, sales_price, vector_send(embedding)
+        FROM products
+        WHERE embedding IS NOT NULL {where};
+    """.format(where="" if uniq_ids is None else "AND uniq_id = ANY(%s)")
+    params = None if uniq_ids is None else (list(uniq_ids),)
+    for rows in embedding_store.iter_rows(conn, select_sql, params, chunk_size, cursor_name="projection_stream"):
+        ids = [row[0] for row in rows]
+        brands = ["" if row[1] is None else row[1] for row in rows]
+        prices = np.array([np.nan if row[2] is None else float(row[2]) for row in rows], dtype=np.float32)
+        vectors = np.vstack([embedding_store.decode_vector(row[3]) for row in rows])
+        yield ids, brands, prices, vectors
+
+
+def fetch_uniq_ids(conn, chunk_size=CHUNK_SIZE):
+    """只讀取有向量的 uniq_id (不讀取向量本身)，用來比對新增 / 刪除的資料列。"""
+    ids = []
+    select_sql = "SELECT uniq_id FROM products WHERE embedding IS NOT NULL;"
+    for rows in embedding_store.iter_rows(conn, select_sql, chunk_size=chunk_size, cursor_name="projection_ids"):
+        ids.extend(row[0] for row in rows)
+    return np.array(ids, dtype=str)
+
+
+def fetch_catalog_version(conn):
+    with conn.cursor() as cursor:
+        version = result_cache.get_catalog_version(cursor)
+    conn.commit()
+    return version
+
+
+# --- 2. 擬合 ---
+def fit_pca(conn, n_components=PCA_COMPONENTS, chunk_size=CHUNK_SIZE):
+    """
+    第一輪：逐塊 partial_fit。IncrementalPCA 每一塊至少要 n_components 筆，
+    所以每一塊延後到下一塊讀到之後才擬合，不足的尾塊併入前一塊。
+    """
+    ipca = IncrementalPCA(n_components=n_components)
+    previous = None
+    for _, _, _, vectors in iter_chunks(conn, chunk_size=chunk_size):
+        if previous is not None and len(previous) >= n_components and len(vectors) >= n_components:
+            ipca.partial_fit(previous)
+            previous = vectors
+        else:
+            previous = vectors if previous is None else np.vstack([previous, vectors])
+    conn.commit()
+    if previous is None or len(previous) < n_components:
+        raise ValueError(f"有向量的資料列少於 PCA 維度 ({n_components})")
+    ipca.partial_fit(previous)
+    return ipca
+
+
+def _fit_umap(reduced, n_components, fit_rows=LAYOUT_FIT_ROWS, seed=42):
+    """以 UMAP 排版 (需要 umap-learn)；資料超過 fit_rows 時只抽樣擬合，其餘以 transform 放上去。"""
+    import umap  # 選用套件：只有 layout="umap" 才需要
+
+    reducer = umap.UMAP(n_components=n_components, n_neighbors=UMAP_NEIGHBORS, random_state=seed)
+    if len(reduced) <= fit_rows:
+        return reducer.fit_transform(reduced).astype(np.float32)
+    rng = np.random.default_rng(seed)
+    fit_idx = rng.choice(len(reduced), fit_rows, replace=False)
+    reducer.fit(reduced[fit_idx])
+    coords = np.empty((len(reduced), n_components), dtype=np.float32)
+    for start in range(0, len(reduced), CHUNK_SIZE):
+        coords[start:start + CHUNK_SIZE] = reducer.transform(reduced[start:start + CHUNK_SIZE])
+    return coords
+
+
+def fit_projection(conn, layout="pca", n_components=PCA_COMPONENTS, chunk_size=CHUNK_SIZE):
+    """擬合投影並計算整個目錄的 2D / 3D 座標，回傳 projection dict (可交給 save_projection)。"""
+    if layout not in LAYOUTS:
+        raise ValueError(f"不支援的 layout：{layout}")
+    catalog_version = fetch_catalog_version(conn)
+
+    start = time.time()
+    ipca = fit_pca(conn, n_components, chunk_size)
+    logger.info("IncrementalPCA 擬合完成 (%.1f 秒，解釋變異 %.1f%%)",
+                time.time() - start, 100 * ipca.explained_variance_ratio_.sum())
+
+    # 第二輪：逐塊投影
+    ids, brands, prices, reduced = [], [], [], []
+    for chunk_ids, chunk_brands, chunk_prices, vectors in iter_chunks(conn, chunk_size=chunk_size):
+        ids.extend(chunk_ids)
+        brands.extend(chunk_brands)
+        prices.append(chunk_prices)
+        reduced.append(ipca.transform(vectors).astype(np.float32))
+    conn.commit()
+    reduced = np.vstack(reduced)
+
+    if layout == "pca":
+        coords_2d, coords_3d = reduced[:, :2].copy(), reduced[:, :3].copy()
+    else:
+        start = time.time()
+        coords_2d, coords_3d = _fit_umap(reduced, 2), _fit_umap(reduced, 3)
+        logger.info("UMAP 排版完成 (%.1f 秒)", time.time() - start)
+
+    return {
+        "layout": layout,
+        "catalog_version": catalog_version,
+        "mean": ipca.mean_.astype(np.float32),
+        "components": ipca.components_.astype(np.float32),
+        "explained": ipca.explained_variance_ratio_.astype(np.float32),
+        "uniq_ids": np.array(ids, dtype=str),
+        "brand": np.array(brands, dtype=str),
+        "sales_price": np.concatenate(prices),
+        "coords_2d": coords_2d,
+        "coords_3d": coords_3d,
+    }
+
+
+def project(projection, vectors):
+    """以存下來的 PCA 投影 (n, 768) -> (n, PCA_COMPONENTS)。"""
+    return (np.asarray(vectors, dtype=np.float32) - projection["mean"]) @ projection["components"].T
+
+
+# --- 3. 增量更新 ---
+def _neighbor_layout(conn, projection, new_ids, k=UPDATE_NEIGHBORS):
+    """
+    layout="umap" 時新資料列的座標：以 idx_embedding_hnsw 找出 k 個最近的既有商品，取它們座標的平均。
+    整個查詢在資料庫內完成，不需要把向量傳回來。找不到既有鄰居時放在所有座標的中心。
+    """
+    position = {uid: i for i, uid in enumerate(projection["uniq_ids"])}
+    neighbors = {uid: [] for uid in new_ids}
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT n.uniq_id, nb.uniq_id
+            FROM products n
+            CROSS JOIN LATERAL (
+                SELECT p.uniq_id FROM products p
+                WHERE p.uniq_id <> n.uniq_id
+                ORDER BY p.embedding <=> n.embedding
+                LIMIT %s
+            ) nb
+            WHERE n.uniq_id = ANY(%s);
+        """, (k, list(new_ids)))
+        for uid, neighbor_id in cursor.fetchall():
+            if neighbor_id in position:
+                neighbors[uid].append(position[neighbor_id])
+    conn.commit()
+
+    center_2d, center_3d = projection["coords_2d"].mean(axis=0), projection["coords_3d"].mean(axis=0)
+    coords_2d = np.empty((len(new_ids), 2), dtype=np.float32)
+    coords_3d = np.empty((len(new_ids), 3), dtype=np.float32)
+    for i, uid in enumerate(new_ids):
+        rows = neighbors[uid]
+        coords_2d[i] = projection["coords_2d"][rows].mean(axis=0) if rows else center_2d
+        coords_3d[i] = projection["coords_3d"][rows].mean(axis=0) if rows else center_3d
+    return coords_2d, coords_3d
+
+
+def update_projection(conn, projection, chunk_size=CHUNK_SIZE):
+    """
+    catalog 版本改變時，刪除已不存在的資料列並投影新資料列；投影本身 (PCA / 排版) 不重新擬合。
+    回傳 (新的 projection, 新增筆數, 刪除筆數)。
+    """
+    catalog_version = fetch_catalog_version(conn)
+    if catalog_version == projection["catalog_version"]:
+        return projection, 0, 0
+
+    current_ids = fetch_uniq_ids(conn, chunk_size)
+    conn.commit()
+    keep = np.isin(projection["uniq_ids"], current_ids)
+    new_ids = current_ids[~np.isin(current_ids, projection["uniq_ids"])]
+    n_removed = int((~keep).sum())
+
+    updated = dict(projection)
+    for key in ("uniq_ids", "brand", "sales_price", "coords_2d", "coords_3d"):
+        updated[key] = projection[key][keep]
+
+    if len(new_ids):
+        ids, brands, prices, coords_2d, coords_3d = [], [], [], [], []
+        for chunk_ids, chunk_brands, chunk_prices, vectors in iter_chunks(conn, new_ids, chunk_size):
+            ids.extend(chunk_ids)
+            brands.extend(chunk_brands)
+            prices.append(chunk_prices)
+            if projection["layout"] == "pca":
+                reduced = project(projection, vectors)
+                coords_2d.append(reduced[:, :2])
+                coords_3d.append(reduced[:, :3])
+        conn.commit()
+        if projection["layout"] == "pca":
+            coords_2d, coords_3d = np.vstack(coords_2d), np.vstack(coords_3d)
+        else:
+            coords_2d, coords_3d = _neighbor_layout(conn, updated, ids)
+        updated["uniq_ids"] = np.concatenate([updated["uniq_ids"], np.array(ids, dtype=str)])
+        updated["brand"] = np.concatenate([updated["brand"], np.array(brands, dtype=str)])
+        updated["sales_price"] = np.concatenate([updated["sales_price"]] + prices)
+        updated["coords_2d"] = np.vstack([updated["coords_2d"], coords_2d]).astype(np.float32)
+        updated["coords_3d"] = np.vstack([updated["coords_3d"], coords_3d]).astype(np.float32)
+
+    updated["catalog_version"] = catalog_version
+    return updated, len(new_ids), n_removed
+
+
+# --- 4. 存檔 / 讀檔 ---
+def save_projection(projection, path=PROJECTION_PATH):
+    data = dict(projection)
+    data["layout"] = np.array(projection["layout"])
+    data["catalog_version"] = np.int64(-1 if projection["catalog_version"] is None else projection["catalog_version"])
+    np.savez(path, **data)
+
+
+def load_projection(path=PROJECTION_PATH):
+    with np.load(path) as data:
+        projection = {key: data[key] for key in data.files}
+    projection["layout"] = str(projection["layout"])
+    version = int(projection["catalog_version"])
+    projection["catalog_version"] = None if version < 0 else version
+    return projection
+
+
+def get_projection(path=PROJECTION_PATH, layout="pca", db_settings=None):
+    """
+    給 notebook 使用：檔案存在且 catalog 版本相同時直接回傳；版本不同時增量更新後存檔；
+    檔案不存在 (或 layout 不同) 時重新擬合。
+    """
+    conn = psycopg2.connect(**(db_settings or DB_SETTINGS))
+    try:
+        if os.path.exists(path):
+            projection = load_projection(path)
+            if projection["layout"] == layout:
+                projection, n_added, n_removed = update_projection(conn, projection)
+                if n_added or n_removed:
+                    save_projection(projection, path)
+                    logger.info("投影已更新：新增 %s 筆，刪除 %s 筆", n_added, n_removed)
+                return projection
+        projection = fit_projection(conn, layout)
+        save_projection(projection, path)
+        return projection
+    finally:
+        conn.close()
+
+
+def print_status(path=PROJECTION_PATH):
+    if not os.path.exists(path):
+        print(f"⚠️ 找不到 {path}，請先執行 fit")
+        return
+    projection = load_projection(path)
+    conn = psycopg2.connect(**DB_SETTINGS)
+    try:
+        current = fetch_catalog_version(conn)
+    finally:
+        conn.close()
+    state = "最新" if current == projection["catalog_version"] else f"已過期 (資料庫版本 {current})"
+    print(f"📊 {path}：layout={projection['layout']}，{len(projection['uniq_ids'])} 筆，"
+          f"PCA {projection['components'].shape[1]} -> {projection['components'].shape[0]} 維 "
+          f"(解釋變異 {projection['explained'].sum():.1%})，catalog 版本 {projection['catalog_version']}，{state}")
+
+
+# --- 主程式區塊 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="整個目錄的向量投影 (2D / 3D 座標)")
+    parser.add_argument("--path", default=PROJECTION_PATH)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_fit = sub.add_parser("fit", help="重新擬合投影並計算所有座標")
+    p_fit.add_argument("--layout", choices=LAYOUTS, default="pca")
+    p_fit.add_argument("--components", type=int, default=PCA_COMPONENTS)
+    sub.add_parser("update", help="只投影新增的資料列 (catalog 版本改變時)")
+    sub.add_parser("status", help="顯示投影檔案的狀態")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "status":
+        print_status(args.path)
+    else:
+        conn = None
+        try:
+            conn = psycopg2.connect(**DB_SETTINGS)
+            start = time.time()
+            if args.command == "fit":
+                projection = fit_projection(conn, args.layout, args.components)
+                print(f"✅ 已投影 {len(projection['uniq_ids'])} 筆 (layout={args.layout}，{time.time() - start:.1f} 秒)")
+            else:
+                projection, n_added, n_removed = update_projection(conn, load_projection(args.path))
+                print(f"✅ 新增 {n_added} 筆，刪除 {n_removed} 筆 ({time.time() - start:.1f} 秒)")
+            save_projection(projection, args.path)
+            print(f"✅ 已寫入 {args.path} (catalog 版本 {projection['catalog_version']})")
+        except ImportError as e:
+            print(f"❌ 缺少選用套件：{e} (layout=umap 需要 pip install umap-learn)")
+        except Exception as e:
+            print(f"❌ 錯誤: {e}")
+        finally:
+            if conn:
+                conn.close()
@@ -0,0 +1,285 @@
+# ---
+# 檔名：embedding_store.py
+# 目的：(Phase 6) 把 products 的向量與篩選欄位匯出成 NumPy 檔案，供離線評估與 in-process 搜尋使用
+# 功能：
+#   1. export_store：以 server-side cursor 分批讀取 (embedding 以 vector_send 的二進位格式傳輸)，
+#      直接寫進 memmap 的 embeddings.npy，不需要把整張表放進記憶體
+#   2. load_store：以 memmap 載入向量矩陣與欄位陣列 (price / rating / prime 代碼 / brand 代碼)
+#   3. parse_sql_filter / filter_mask：把 query_parser.get_sql_filter 產生的 SQL 條件
+#      轉成 NumPy 布林遮罩，讓 NumPy 端與資料庫端使用「同一個」篩選語意
+# 檔案結構 (STORE_DIR)：
+#   embeddings.npy   (N, 768) float32 或 float16
+#   attributes.npz   uniq_id / sales_price / rating / prime_code / prime_vocab / brand_code / brand_vocab
+#   meta.json        筆數、維度、dtype、匯出時的 catalog 版本
+# ---
+
+import json
+import os
+import re
+import time
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+DB_SETTINGS = {
+    "host": os.environ.get("DB_HOST"),
+    "port": os.environ.get("DB_PORT"),
+    "user": os.environ.get("DB_USER"),
+    "password": os.environ.get("DB_PASSWORD"),
+    "database": os.environ.get("DB_NAME")
+}
+
+STORE_DIR = os.environ.get("CBO_EMBEDDING_STORE", "embedding_store")
+EMBEDDING_DIM = 768
+CHUNK_SIZE = 5000
+
+# 可以在 NumPy 端評估的欄位
+NUMERIC_COLUMNS = ("sales_price", "rating")
+SUPPORTED_COLUMNS = NUMERIC_COLUMNS + ("brand", "amazon_prime_y_or_n")
+
+
+# --- 1. 二進位向量解碼 ---
+def decode_vector(buf, dtype=np.float32):
+    """
+    解碼 pgvector 的二進位格式 (vector_send 的輸出)：
+    int16 維度 + int16 保留欄位 + 維度個 big-endian float4。
+    比解析 '[0.1, 0.2, ...]' 文字快得多，傳輸量也小。
+    """
+    dim = int.from_bytes(bytes(buf[:2]), "big")
+    return np.frombuffer(buf, dtype=">f4", count=dim, offset=4).astype(dtype)
+
+
+def iter_rows(conn, select_sql, params=None, chunk_size=CHUNK_SIZE, cursor_name="embedding_stream"):
+    """
+    以 server-side (named) cursor 分批讀取查詢結果，每次產出一批 rows。
+    客戶端記憶體只需要容納 chunk_size 筆。
+    """
+    with conn.cursor(name=cursor_name) as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(select_sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+
+# --- 2. 匯出與載入 ---
+def export_store(store_dir=STORE_DIR, dtype="float32"):
+    """
+    把 products 的向量與篩選欄位匯出到 store_dir。
+    使用 REPEATABLE READ 交易，筆數統計與資料讀取看到的是同一個快照。
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    start = time.time()
+    conn = psycopg2.connect(**DB_SETTINGS)
+    try:
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM products WHERE embedding IS NOT NULL;")
+        n_rows = cursor.fetchone()[0]
+        catalog_version = None
+        cursor.execute("SELECT to_regclass('catalog_version') IS NOT NULL;")
+        if cursor.fetchone()[0]:
+            cursor.execute("SELECT version FROM catalog_version WHERE table_name = 'products';")
+            row = cursor.fetchone()
+            catalog_version = row[0] if row else 0
+
+        print(f"[Embedding Store] 匯出 {n_rows} 筆向量到 {store_dir}/ ...")
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(store_dir, "embeddings.npy"), mode="w+", dtype=dtype, shape=(n_rows, EMBEDDING_DIM)
+        )
+        uniq_ids = []
+        prices = np.full(n_rows, np.nan, dtype=np.float64)
+        ratings = np.full(n_rows, np.nan, dtype=np.float64)
+        # amazon_prime_y_or_n 與品牌一樣存成「代碼 + 字彙表」(-1 為 NULL)，保留原始值：
+        # SQL 的比較區分大小寫，NULL 在 = 與 <> 下都不成立，不能轉成 Y / N 的布林值
+        prime_codes = np.full(n_rows, -1, dtype=np.int8)
+        prime_vocab = {}
+        brand_codes = np.full(n_rows, -1, dtype=np.int32)
+        brand_vocab = {}
+
+        offset = 0
+        select_sql = """
+            SELECT uniq_id, brand, sales_price, rating, amazon_prime_y_or_n, vector_send(embedding)
+            FROM products
+            WHERE embedding IS NOT NULL
+            ORDER BY uniq_id;
+        """
+        for rows in iter_rows(conn, select_sql):
+            for uniq_id, brand, price, rating, prime_flag, vec_buf in rows:
+                if offset >= n_rows:
+                    break
+                embeddings[offset] = decode_vector(vec_buf, dtype)
+                uniq_ids.append(uniq_id)
+                if price is not None:
+                    prices[offset] = float(price)
+                if rating is not None:
+                    ratings[offset] = float(rating)
+                if prime_flag is not None:
+                    prime_codes[offset] = prime_vocab.setdefault(prime_flag, len(prime_vocab))
+                if brand is not None:
+                    brand_codes[offset] = brand_vocab.setdefault(brand, len(brand_vocab))
+                offset += 1
+            print(f"  進度：{offset}/{n_rows}")
+        embeddings.flush()
+        del embeddings
+    finally:
+        conn.close()
+
+    vocab = np.array(sorted(brand_vocab, key=brand_vocab.get), dtype=object)
+    np.savez(
+        os.path.join(store_dir, "attributes.npz"),
+        uniq_id=np.array(uniq_ids, dtype=object),
+        sales_price=prices, rating=ratings,
+        prime_code=prime_codes, prime_vocab=np.array(sorted(prime_vocab, key=prime_vocab.get), dtype=object),
+        brand_code=brand_codes, brand_vocab=vocab,
+    )
+    meta = {
+        "n_rows": n_rows, "dim": EMBEDDING_DIM, "dtype": dtype,
+        "catalog_version": catalog_version, "exported_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with open(os.path.join(store_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    print(f"[Embedding Store] 匯出完成，花費 {time.time() - start:.1f} 秒。")
+    return meta
+
+
+class EmbeddingStore:
+    """匯出後的向量矩陣 (memmap) 與欄位陣列。"""
+
+    def __init__(self, store_dir=STORE_DIR, mmap=True):
+        mode = "r" if mmap else None
+        self.store_dir = store_dir
+        self.embeddings = np.load(os.path.join(store_dir, "embeddings.npy"), mmap_mode=mode)
+        attrs = np.load(os.path.join(store_dir, "attributes.npz"), allow_pickle=True)
+        if "prime_code" not in attrs:
+            # 舊格式把 amazon_prime_y_or_n 存成布林值 (NULL 當成 N)，無法得到與 SQL 相同的篩選結果
+            raise ValueError(f"{store_dir} 是舊格式的匯出 (沒有 prime_code)，請重新執行 embedding_store.py")
+        self.uniq_ids = attrs["uniq_id"]
+        self.sales_price = attrs["sales_price"]
+        self.rating = attrs["rating"]
+        self.prime_code = attrs["prime_code"]
+        self.prime_vocab = attrs["prime_vocab"]
+        self.prime_index = {flag: i for i, flag in enumerate(self.prime_vocab)}
+        self.brand_code = attrs["brand_code"]
+        self.brand_vocab = attrs["brand_vocab"]
+        self.brand_index = {brand: i for i, brand in enumerate(self.brand_vocab)}
+        with open(os.path.join(store_dir, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return len(self.uniq_ids)
+
+
+def load_store(store_dir=STORE_DIR, mmap=True):
+    return EmbeddingStore(store_dir, mmap=mmap)
+
+
+# --- 3. SQL 篩選 -> NumPy 遮罩 ---
+_NUMBER = r"-?\d+(?:\.\d+)?"
+_STRING = r"'(?:[^']|'')*'"
+_PREDICATE_RE = re.compile(
+    rf"\s*(?:"
+    rf"(?P<true>1\s*=\s*1)"
+    rf"|(?P<bcol>\w+)\s+BETWEEN\s+(?P<lo>{_NUMBER})\s+AND\s+(?P<hi>{_NUMBER})"
+    rf"|(?P<col>\w+)\s*(?P<op><=|>=|<>|!=|<|>|=)\s*(?P<val>{_NUMBER}|{_STRING})"
+    rf")\s*",
+    re.IGNORECASE,
+)
+_AND_RE = re.compile(r"AND\b", re.IGNORECASE)
+
+
+def parse_sql_filter(sql_filter_string):
+    """
+    把 "sales_price BETWEEN 260 AND 1300 AND brand = 'Nike'" 解析成
+    [("sales_price", "between", (260.0, 1300.0)), ("brand", "=", "Nike")]。
+    只支援 query_parser 會產生的形式 (AND 連接的比較 / BETWEEN)；
+    遇到不支援的語法 (OR、ILIKE、函式...) 回傳 None，呼叫端應退回資料庫執行。
+    """
+    text = (sql_filter_string or "").strip().rstrip(";")
+    if not text:
+        return []
+    predicates = []
+    pos = 0
+    while True:
+        match = _PREDICATE_RE.match(text, pos)
+        if not match:
+            return None
+        if match.group("bcol"):
+            column = match.group("bcol").lower()
+            if column not in NUMERIC_COLUMNS:
+                return None
+            predicates.append((column, "between", (float(match.group("lo")), float(match.group("hi")))))
+        elif match.group("col"):
+            column = match.group("col").lower()
+            if column not in SUPPORTED_COLUMNS:
+                return None
+            op = "<>" if match.group("op") == "!=" else match.group("op")
+            raw = match.group("val")
+            if raw.startswith("'"):
+                value = raw[1:-1].replace("''", "'")
+                if column in NUMERIC_COLUMNS:
+                    return None
+            else:
+                if column not in NUMERIC_COLUMNS:
+                    return None
+                value = float(raw)
+            if column in ("brand", "amazon_prime_y_or_n") and op not in ("=", "<>"):
+                return None
+            predicates.append((column, op, value))
+        pos = match.end()
+        if pos >= len(text):
+            return predicates
+        and_match = _AND_RE.match(text, pos)
+        if not and_match:
+            return None
+        pos = and_match.end()
+
+
+_COMPARE = {
+    "<": np.less, "<=": np.less_equal, ">": np.greater, ">=": np.greater_equal,
+    "=": np.equal, "<>": np.not_equal,
+}
+
+
+def _category_mask(codes, index, op, value):
+    """代碼欄位 (品牌 / prime，-1 為 NULL) 的 = / <>：區分大小寫，NULL 在兩種比較下都是 False。"""
+    code = index.get(value, -2)
+    if op == "=":
+        return codes == code
+    return (codes >= 0) & (codes != code)
+
+
+def filter_mask(store, predicates):
+    """
+    以向量化運算計算篩選遮罩。NULL 的語意與 SQL 相同：NaN / NULL 的品牌或 prime 在任何比較下都是 False。
+    """
+    mask = np.ones(len(store), dtype=bool)
+    for column, op, value in predicates:
+        if column in NUMERIC_COLUMNS:
+            values = getattr(store, column)
+            if op == "between":
+                lo, hi = value
+                mask &= (values >= lo) & (values <= hi)
+            else:
+                # NaN <> x 在 NumPy 中是 True，但 SQL 的 NULL <> x 不成立
+                mask &= _COMPARE[op](values, value) & ~np.isnan(values)
+        elif column == "brand":
+            mask &= _category_mask(store.brand_code, store.brand_index, op, value)
+        elif column == "amazon_prime_y_or_n":
+            mask &= _category_mask(store.prime_code, store.prime_index, op, value)
+    return mask
+
+
+# --- 主程式區塊：匯出 ---
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="匯出 products 向量與篩選欄位")
+    parser.add_argument("--out", default=STORE_DIR)
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    args = parser.parse_args()
+    export_store(args.out, args.dtype)
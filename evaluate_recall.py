@@ -0,0 +1,260 @@
+# ---
+# 檔名：evaluate_recall.py
+# 目的：(Phase 6) 以「精確」的 Ground Truth 大規模評估 recall@k
+# 功能：
+#   1. 向量只從資料庫匯出一次 (embedding_store.py)，之後以 memmap 讀取
+#   2. 對數百個查詢向量，以 NumPy 矩陣乘法 (分塊) 計算「篩選後」的精確 Top-k，作為 Ground Truth
+#   3. 對每個篩選選擇率，分別量測：
+#        - 計畫 A (SQL-First)
+#        - 計畫 B (Vector-First) 在不同 K × hnsw.ef_search 下
+#        - CBO 實際選擇的計畫 (hybrid_search)
+#      的 recall@k 與延遲，輸出「延遲 vs 召回率」的對照表與 JSON
+# 說明：
+#   評估期間關閉成本模型的線上學習 (評估的查詢分佈與正式流量不同，不應改動 CBO 的係數)；
+#   執行器發生錯誤 (例如 SQL 失敗) 的樣本記為「失敗」，不當成 recall 0 計入平均。
+#   run_final_comprehensive.py 的 calculate_recall 只比較單一查詢、且以計畫 A 當作標準答案；
+#   這裡的標準答案與資料庫無關，計畫 A 本身的 recall 也能被檢查。
+#   距離與計畫 A 相同使用 L2 (<->)：||e||^2 - 2 q·e (||q||^2 對排序沒有影響)。
+# 執行方式：
+#   python embedding_store.py                       # 先匯出一次
+#   python evaluate_recall.py --queries 200 --k 20 --out recall_report.json
+# ---
+
+import argparse
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+
+import numpy as np
+
+import cbo_proxy
+import embedding_store
+
+# --- 1. 評估設定 ---
+SELECTIVITIES = [0.001, 0.01, 0.05, 0.2, 0.5, 1.0]
+K_VALUES = [20, 100, 500, 1000]   # hnsw.ef_search 上限為 1000，K 不超過 1000
+EF_SEARCH_VALUES = [40, 100, 200]
+TOP_K = 20
+
+# 每一塊參與矩陣乘法的資料列數 (控制記憶體：查詢數 × BLOCK_ROWS 個 float32)
+BLOCK_ROWS = 100000
+
+# 查詢向量加上的高斯雜訊標準差 (0 代表直接以商品本身的向量查詢，必定命中自己)
+QUERY_NOISE = 0.02
+
+
+# --- 2. 查詢向量與篩選條件 ---
+def sample_queries(store, n_queries, noise=QUERY_NOISE, seed=0):
+    """從匯出的向量中抽樣查詢向量，加上雜訊後重新正規化 (模擬「相似但不在庫內」的查詢)。"""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(store), size=min(n_queries, len(store)), replace=False)
+    queries = np.asarray(store.embeddings[np.sort(rows)], dtype=np.float32)
+    if noise > 0:
+        queries = queries + rng.normal(0, noise, size=queries.shape).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries
+
+
+def build_filters(store, selectivities=SELECTIVITIES, seed=0):
+    """
+    依價格分位數產生目標選擇率的 BETWEEN 區間 (隨機放在分佈中的某個位置)。
+    回傳 [(目標選擇率, SQL 字串, 遮罩)]；遮罩以 embedding_store 解析同一個 SQL 字串計算，
+    確保 Ground Truth 與資料庫使用同一個篩選語意。
+    """
+    rng = np.random.default_rng(seed)
+    prices = np.sort(store.sales_price[~np.isnan(store.sales_price)])
+    filters = []
+    for target in selectivities:
+        if target >= 1.0 or len(prices) == 0:
+            sql_filter = "1 = 1"
+        else:
+            width = max(1, int(len(prices) * target))
+            start = int(rng.integers(0, max(1, len(prices) - width)))
+            lo, hi = prices[start], prices[min(len(prices) - 1, start + width - 1)]
+            sql_filter = f"sales_price BETWEEN {lo:.2f} AND {hi:.2f}"
+        predicates = embedding_store.parse_sql_filter(sql_filter)
+        filters.append((target, sql_filter, embedding_store.filter_mask(store, predicates)))
+    return filters
+
+
+# --- 3. 精確 Ground Truth ---
+def exact_top_k(store, queries, mask, k=TOP_K, block_rows=BLOCK_ROWS):
+    """
+    以分塊矩陣乘法計算每個查詢在「篩選後」資料中的精確 Top-k (L2 距離)。
+    回傳 (n_queries, <=k) 的 uniq_id list。
+    """
+    candidate_rows = np.flatnonzero(mask)
+    n_queries = len(queries)
+    best_dist = np.full((n_queries, 0), np.inf, dtype=np.float32)
+    best_rows = np.zeros((n_queries, 0), dtype=np.int64)
+
+    for start in range(0, len(candidate_rows), block_rows):
+        rows = candidate_rows[start:start + block_rows]
+        block = np.asarray(store.embeddings[rows], dtype=np.float32)
+        sq_norms = np.einsum("ij,ij->i", block, block)
+        dist = sq_norms[None, :] - 2.0 * (queries @ block.T)
+
+        # 與目前的 Top-k 合併後再取一次 Top-k
+        dist = np.concatenate([best_dist, dist], axis=1)
+        merged_rows = np.concatenate([best_rows, np.broadcast_to(rows, (n_queries, len(rows)))], axis=1)
+        keep = min(k, dist.shape[1])
+        part = np.argpartition(dist, keep - 1, axis=1)[:, :keep]
+        best_dist = np.take_along_axis(dist, part, axis=1)
+        best_rows = np.take_along_axis(merged_rows, part, axis=1)
+
+    order = np.argsort(best_dist, axis=1)
+    best_rows = np.take_along_axis(best_rows, order, axis=1)
+    return [[store.uniq_ids[row] for row in query_rows] for query_rows in best_rows]
+
+
+def recall_at_k(truth_ids, result_rows, k=TOP_K):
+    """recall@k = |Top-k 標準答案 ∩ 回傳的 Top-k| / min(k, 標準答案筆數)；標準答案為空時回傳 None。"""
+    truth = set(truth_ids[:k])
+    if not truth:
+        return None
+    returned = {row["uniq_id"] for row in result_rows[:k]}
+    return len(truth & returned) / len(truth)
+
+
+# --- 4. 評估主流程 ---
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    results = fn(*args, **kwargs)
+    return results, (time.perf_counter() - start) * 1000
+
+
+def evaluate(store, n_queries, k=TOP_K, k_values=K_VALUES, ef_values=EF_SEARCH_VALUES,
+             selectivities=SELECTIVITIES, noise=QUERY_NOISE):
+    queries = sample_queries(store, n_queries, noise)
+    filters = build_filters(store, selectivities)
+    # {(目標選擇率, 設定名稱): {"recall": [...], "latency_ms": [...]}}
+    samples = defaultdict(lambda: {"recall": [], "latency_ms": [], "failed": 0})
+    filter_info = []
+    plan_choices = defaultdict(lambda: defaultdict(int))
+
+    for target, sql_filter, mask in filters:
+        actual = float(mask.mean()) if len(mask) else 0.0
+        filter_info.append({"target_selectivity": target, "actual_selectivity": actual,
+                            "n_filtered": int(mask.sum()), "filter": sql_filter})
+        print(f"\n[篩選] 目標選擇率 {target:.2%} (實際 {actual:.3%}, {int(mask.sum())} 筆)：{sql_filter}")
+
+        start = time.perf_counter()
+        truth = exact_top_k(store, queries, mask, k)
+        print(f"  Ground Truth：{len(queries)} 個查詢，{(time.perf_counter() - start):.2f} 秒")
+
+        for query_vec, truth_ids in zip(queries, truth):
+            if not truth_ids:
+                continue
+            v_query = query_vec.tolist()
+
+            def _add(config, results, latency_ms, errors_before):
+                # 執行器出錯時只回傳空結果，以錯誤計數分辨失敗與真正的 recall 0
+                if cbo_proxy.execution_error_count() != errors_before:
+                    samples[(target, config)]["failed"] += 1
+                    return
+                recall = recall_at_k(truth_ids, results, k)
+                samples[(target, config)]["recall"].append(recall)
+                samples[(target, config)]["latency_ms"].append(latency_ms)
+
+            errors = cbo_proxy.execution_error_count()
+            results, ms = _timed(cbo_proxy.execute_plan_a, sql_filter, v_query, limit_n=k)
+            _add("PLAN_A", results, ms, errors)
+
+            for ef_search in ef_values:
+                for k_candidates in k_values:
+                    if k_candidates < k:
+                        continue
+                    errors = cbo_proxy.execution_error_count()
+                    results, ms = _timed(cbo_proxy.execute_plan_b, sql_filter, v_query,
+                                         k_candidates=k_candidates, limit_n=k, ef_search=ef_search)
+                    ef_eff = min(max(ef_search, k_candidates), cbo_proxy.HNSW_EF_SEARCH_MAX)
+                    _add(f"PLAN_B K={k_candidates} ef={ef_eff}", results, ms, errors)
+
+            errors = cbo_proxy.execution_error_count()
+            outcome, ms = _timed(cbo_proxy.hybrid_search, v_query, sql_filter, limit_n=k, use_cache=False)
+            _add("CBO", outcome["results"], ms, errors)
+            plan_choices[target][outcome["plan"]] += 1
+
+    return summarize(samples, filter_info, plan_choices, n_queries, k)
+
+
+def summarize(samples, filter_info, plan_choices, n_queries, k):
+    rows = []
+    for (target, config), values in sorted(samples.items(), key=lambda item: (item[0][0], item[0][1])):
+        recalls = np.array(values["recall"], dtype=float)
+        latencies = np.array(values["latency_ms"], dtype=float)
+        measured = len(recalls) > 0
+        rows.append({
+            "target_selectivity": target,
+            "config": config,
+            "n": len(recalls),
+            "n_failed": values["failed"],
+            "mean_recall": float(recalls.mean()) if measured else None,
+            "p10_recall": float(np.percentile(recalls, 10)) if measured else None,
+            "p50_latency_ms": float(np.percentile(latencies, 50)) if measured else None,
+            "p95_latency_ms": float(np.percentile(latencies, 95)) if measured else None,
+        })
+    return {
+        "k": k,
+        "n_queries": n_queries,
+        "filters": filter_info,
+        "cbo_plan_choices": {str(t): dict(c) for t, c in plan_choices.items()},
+        "results": rows,
+    }
+
+
+def print_report(report):
+    print("\n" + "=" * 100)
+    print(f"📊 recall@{report['k']} 評估結果 ({report['n_queries']} 個查詢)")
+    print("=" * 100)
+    print(f"{'選擇率':<10} | {'設定':<26} | {'平均 recall':>11} | {'P10 recall':>10} | "
+          f"{'P50 (ms)':>9} | {'P95 (ms)':>9} | {'失敗':>5}")
+    print("-" * 100)
+    last_target = None
+    for row in report["results"]:
+        if last_target is not None and row["target_selectivity"] != last_target:
+            print("-" * 100)
+        last_target = row["target_selectivity"]
+        if row["n"] == 0:
+            print(f"{row['target_selectivity']:<10.2%} | {row['config']:<26} | {'(全部失敗)':>11} | "
+                  f"{'-':>10} | {'-':>9} | {'-':>9} | {row['n_failed']:>5}")
+            continue
+        print(f"{row['target_selectivity']:<10.2%} | {row['config']:<26} | {row['mean_recall']:>11.3f} | "
+              f"{row['p10_recall']:>10.3f} | {row['p50_latency_ms']:>9.2f} | {row['p95_latency_ms']:>9.2f} | "
+              f"{row['n_failed']:>5}")
+    print("=" * 100)
+    for target, choices in report["cbo_plan_choices"].items():
+        print(f"CBO 選擇 (選擇率 {float(target):.2%})：{choices}")
+
+
+# --- 主程式區塊 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="以精確 Ground Truth 評估計畫 A / B / CBO 的 recall@k")
+    parser.add_argument("--store", default=embedding_store.STORE_DIR)
+    parser.add_argument("--export", action="store_true", help="評估前重新從資料庫匯出向量")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=TOP_K)
+    parser.add_argument("--k-values", type=int, nargs="+", default=K_VALUES)
+    parser.add_argument("--ef-values", type=int, nargs="+", default=EF_SEARCH_VALUES)
+    parser.add_argument("--selectivities", type=float, nargs="+", default=SELECTIVITIES)
+    parser.add_argument("--noise", type=float, default=QUERY_NOISE)
+    parser.add_argument("--out", default=None, help="把結果寫成 JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # 評估查詢不回饋給成本模型 (大量刻意的 K / ef_search 組合會扭曲線上擬合的係數)
+    cbo_proxy.ENABLE_ONLINE_LEARNING = False
+    if args.export or not os.path.exists(os.path.join(args.store, "meta.json")):
+        embedding_store.export_store(args.store)
+    store = embedding_store.load_store(args.store)
+    print(f"[Recall] 載入 {len(store)} 筆向量 (catalog 版本 {store.meta.get('catalog_version')})")
+
+    report = evaluate(store, args.queries, args.k, args.k_values, args.ef_values,
+                      args.selectivities, args.noise)
+    print_report(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"✅ 已寫入 {args.out}")
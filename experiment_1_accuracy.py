@@ -2,6 +2,7 @@ import psycopg2
 from psycopg2 import extras 
 import time
 import os
+import logging
 import shutil
 from dotenv import load_dotenv
 import query_parser
@@ -77,6 +78,16 @@ def show_results(title, results):
     for i, row in enumerate(results[:5]):
         print(f"  {i+1}. [ID:{row['uniq_id'][-10:]}] {row['product_name'][:40]}... | ColorMatch: {'black' in row['product_name'].lower()}")
 
+def attach_product_names(cur, results):
+    """計畫 A / B 的結果不含 product_name，一次查詢補上 (show_results 需要)。"""
+    if not results:
+        return
+    cur.execute("SELECT uniq_id, product_name FROM products WHERE uniq_id = ANY(%s);",
+                ([row['uniq_id'] for row in results],))
+    names = {row['uniq_id']: row['product_name'] for row in cur.fetchall()}
+    for row in results:
+        row['product_name'] = names.get(row['uniq_id']) or ""
+
 def run_experiment_accuracy():
     setup_result_folders()
 
@@ -139,14 +150,16 @@ def run_experiment_accuracy():
     decision = cbo_proxy.get_cbo_decision(cbo_sql_filter)
     
     # [關鍵修改] 呼叫函式時，把 TOP_K 傳進去！
+    # include_embedding=True：候選的向量一併取回，重排時不必再查一次
     if decision == "PLAN_A":
         # 告訴 Plan A 我要幾筆
-        results_c = cbo_proxy.execute_plan_a(cbo_sql_filter, v_query, limit=TOP_K)
+        results_c = cbo_proxy.execute_plan_a(cbo_sql_filter, v_query, limit_n=TOP_K, include_embedding=True)
     else:
         # 告訴 Plan B 我要幾筆
-        results_c = cbo_proxy.execute_plan_b(cbo_sql_filter, v_query, limit=TOP_K)
+        results_c = cbo_proxy.execute_plan_b(cbo_sql_filter, v_query, limit_n=TOP_K, include_embedding=True)
     
     results_c = cbo_proxy.rerank_by_color(results_c, USER_TEXT_INPUT)
+    attach_product_names(cur, results_c)
     
     show_results("Method C 結果", results_c)
     save_images_to_folder("Method C", results_c)
@@ -157,4 +170,6 @@ def run_experiment_accuracy():
     conn.close()
 
 if __name__ == "__main__":
+    # cbo_proxy / query_parser 的決策過程以 logging 輸出，CLI 用 INFO 顯示
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     run_experiment_accuracy()
\ No newline at end of file
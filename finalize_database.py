@@ -3,6 +3,7 @@ import psycopg2
 import time
 import os
 from dotenv import load_dotenv
+import stats_maintenance
 
 load_dotenv()
 DB_SETTINGS = {
@@ -13,6 +14,10 @@ DB_SETTINGS = {
     "database": os.environ.get("DB_NAME") # 應為 "db_project"
 }
 
+# HNSW 建索引參數；可以用 sweep_hnsw_params.py 的建議值覆寫
+HNSW_M = int(os.environ.get("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", "64"))
+
 def finalize_database():
     """
     執行 Phase 1 的最後兩個步驟：
@@ -38,13 +43,14 @@ def finalize_database():
         start_time = time.time()
         
         # 我們使用 HNSW 索引，它是目前 pg_vector 中最快最強的
-        # m = 16, ef_construction = 64 是推薦的預設值
+        # m = 16, ef_construction = 64 是 pgvector 的預設值 (適合本資料的值請用 sweep_hnsw_params.py 量測)
         # <-> (餘弦相似度) 使用 `vector_cosine_ops`
-        cursor.execute("""
+        print(f"參數：m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION}")
+        cursor.execute(f"""
         CREATE INDEX IF NOT EXISTS idx_embedding_hnsw 
         ON products 
         USING HNSW (embedding vector_cosine_ops) 
-        WITH (m = 16, ef_construction = 64);
+        WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION});
         """)
         # 請先找出** 64 個**『可能的』鄰居，然後再從這 64 個中，挑選出最好的 16 個來當作永久連結。」
         end_time = time.time()
@@ -59,6 +65,7 @@ def finalize_database():
         start_time = time.time()
         # [注意] 我們使用小寫的 'products'
         cursor.execute("ANALYZE products;")
+        stats_maintenance.mark_analyzed(cursor) # 歸零變動筆數並遞增 stats_version，CBO 會清掉依賴舊統計的快取
         end_time = time.time()
         
         print(f"資料庫分析 (ANALYZE) 完畢！花費時間：{ (end_time - start_time):.2f} 秒。")
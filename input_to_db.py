@@ -13,6 +13,8 @@ from PIL import Image # Pillow 函式庫，用於開啟圖片
 import numpy as np
 import time
 from dotenv import load_dotenv # 用於讀取 .env 檔案
+import result_cache # 寫入後遞增 catalog 版本號，讓搜尋結果快取失效
+import stats_maintenance # 累計變動筆數，超過門檻時自動 ANALYZE
 
 # --- 1. 載入設定 ---
 load_dotenv() 
@@ -169,11 +171,21 @@ def vectorize_and_insert():
                         ON CONFLICT (uniq_id) DO NOTHING;
                         """
                         execute_batch(cursor, insert_query, data_to_insert)
+                        result_cache.bump_catalog_version(cursor) # 與寫入在同一個交易中
+                        # ON CONFLICT DO NOTHING 略過的資料列也計入 (上限估計，最多只是早一點 ANALYZE)
+                        stats_maintenance.record_modified_rows(cursor, len(data_to_insert))
                         conn.commit() # 提交事務
+                        stats_maintenance.maybe_analyze(conn) # 變動筆數超過門檻時 ANALYZE 篩選欄位
                         insert_count += len(data_to_insert)
                         print(f"進度：已處理 {processed_count} 筆, 已寫入 {insert_count} 筆資料...")
                         data_to_insert = [] # 清空批次
 
+                except psycopg2.Error:
+                    # 資料庫錯誤會讓交易進入 aborted 狀態，之後每一批都會失敗 (什麼都寫不進去)：
+                    # rollback 並停止匯入，不要當成單行錯誤繼續
+                    conn.rollback()
+                    print(f"錯誤：寫入第 {i+1} 行所在的批次時發生資料庫錯誤，停止匯入。")
+                    raise
                 except Exception as e:
                     print(f"錯誤：處理第 {i+1} 行 (ID: {data.get('uniq_id', 'N/A')}) 時發生錯誤：{e}")
             
@@ -185,7 +197,10 @@ def vectorize_and_insert():
                 ON CONFLICT (uniq_id) DO NOTHING;
                 """
                 execute_batch(cursor, insert_query, data_to_insert)
+                result_cache.bump_catalog_version(cursor)
+                stats_maintenance.record_modified_rows(cursor, len(data_to_insert))
                 conn.commit()
+                stats_maintenance.maybe_analyze(conn)
                 insert_count += len(data_to_insert)
                 print(f"處理最後一批資料，共寫入 {insert_count} 筆資料。")
 
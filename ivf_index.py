@@ -0,0 +1,311 @@
+# ---
+# 檔名：ivf_index.py
+# 目的：(Phase 6) 程序內的 IVF / PQ 近似向量索引 (不依賴資料庫做向量運算)，支援「篩選感知」的搜尋
+# 功能：
+#   1. build_index：以 k-means 訓練粗量化器 (n_lists 個中心)，把每個向量分配到最近的 list (倒排表)；
+#      可選擇再對「殘差」訓練乘積量化 (PQ：pq_m 個子空間 × 256 個中心)，每個向量只存 pq_m 個 byte
+#   2. 索引存到 IVF_INDEX_DIR (.npy + meta.json)，向量本體沿用 embedding_store 的匯出檔 (memmap)
+#   3. search：依查詢向量與中心的距離依序掃描 list；掃描時直接以屬性 bitmap (篩選遮罩) 過濾，
+#      PQ 時以非對稱距離表 (ADC) 估算距離，最後對前 limit_n × rerank_factor 個候選以原始向量精確重排
+#   4. 篩選越嚴格，為了湊滿候選會自動多掃描幾個 list (最多 MAX_PROBE_FRACTION 的 list)
+# 使用方式：
+#   python embedding_store.py                            # 匯出向量
+#   python ivf_index.py build --lists 1024 --pq-m 48     # 建索引 (--pq-m 0 代表 IVF-Flat)
+#   CBO_IVF=1 時，cbo_proxy 的 CBO 會把 PLAN_IVF 當作第三個候選計畫
+# ---
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import embedding_store
+
+logger = logging.getLogger(__name__)
+
+# --- 1. 設定 ---
+IVF_INDEX_DIR = os.environ.get("CBO_IVF_INDEX", "ivf_index")
+KMEANS_ITERS = 20
+TRAIN_SAMPLE = 100000       # k-means / PQ 訓練使用的最大樣本數
+PQ_KSUB = 256               # 每個子空間的中心數 (一個 byte)
+BLOCK_ROWS = 65536
+
+DEFAULT_NPROBE = 16         # 至少掃描的 list 數
+RERANK_FACTOR = 10          # 以精確距離重排的候選數 = limit_n × RERANK_FACTOR
+MAX_PROBE_FRACTION = 0.25   # 篩選很嚴格時，最多掃描這個比例的 list
+MASK_CACHE_SIZE = 64        # 快取最近用過的篩選 bitmap
+
+
+# --- 2. 訓練 ---
+def _assign(x, centroids, c_sq):
+    """回傳每一列最近的中心編號 (L2)。"""
+    labels = np.empty(len(x), dtype=np.int32)
+    for start in range(0, len(x), BLOCK_ROWS):
+        block = np.asarray(x[start:start + BLOCK_ROWS], dtype=np.float32)
+        labels[start:start + BLOCK_ROWS] = np.argmin(c_sq[None, :] - 2.0 * (block @ centroids.T), axis=1)
+    return labels
+
+
+def kmeans(x, k, iters=KMEANS_ITERS, rng=None):
+    """Lloyd k-means；空的群集以隨機樣本重新初始化。"""
+    rng = rng or np.random.default_rng(0)
+    x = np.asarray(x, dtype=np.float32)
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        labels = _assign(x, centroids, np.einsum("ij,ij->i", centroids, centroids))
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), size=int(empty.sum()), replace=False)]
+    return centroids
+
+
+def train_pq(residuals, pq_m, rng=None):
+    """在每個子空間各自訓練 PQ_KSUB 個中心，回傳 (pq_m, PQ_KSUB, dsub) 的 codebook。"""
+    dim = residuals.shape[1]
+    dsub = dim // pq_m
+    return np.stack([
+        kmeans(residuals[:, m * dsub:(m + 1) * dsub], PQ_KSUB, rng=rng) for m in range(pq_m)
+    ])
+
+
+def encode_pq(residuals, codebooks):
+    pq_m, _, dsub = codebooks.shape
+    codes = np.empty((len(residuals), pq_m), dtype=np.uint8)
+    for m in range(pq_m):
+        cb = codebooks[m]
+        codes[:, m] = _assign(residuals[:, m * dsub:(m + 1) * dsub], cb, np.einsum("ij,ij->i", cb, cb))
+    return codes
+
+
+def build_index(store_dir=embedding_store.STORE_DIR, index_dir=IVF_INDEX_DIR, n_lists=None, pq_m=0, seed=0):
+    """從 embedding_store 的匯出檔建立 IVF (或 IVF-PQ) 索引並存檔。"""
+    rng = np.random.default_rng(seed)
+    store = embedding_store.load_store(store_dir)
+    n_rows, dim = store.embeddings.shape
+    if pq_m and dim % pq_m:
+        raise ValueError(f"維度 {dim} 無法被 pq_m={pq_m} 整除")
+    n_lists = n_lists or max(1, int(4 * np.sqrt(n_rows)))
+    start = time.time()
+
+    train_rows = np.sort(rng.choice(n_rows, size=min(TRAIN_SAMPLE, n_rows), replace=False))
+    train = np.asarray(store.embeddings[train_rows], dtype=np.float32)
+    print(f"[IVF] 訓練粗量化器：{n_lists} 個 list (樣本 {len(train)} 筆)...")
+    centroids = kmeans(train, n_lists, rng=rng)
+    n_lists = len(centroids)
+    c_sq = np.einsum("ij,ij->i", centroids, centroids)
+
+    print(f"[IVF] 分配 {n_rows} 筆向量...")
+    assignments = _assign(store.embeddings, centroids, c_sq)
+    order = np.argsort(assignments, kind="stable").astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))]).astype(np.int64)
+    sq_norms = np.empty(n_rows, dtype=np.float32)
+    for s in range(0, n_rows, BLOCK_ROWS):
+        block = np.asarray(store.embeddings[s:s + BLOCK_ROWS], dtype=np.float32)
+        sq_norms[s:s + BLOCK_ROWS] = np.einsum("ij,ij->i", block, block)
+
+    os.makedirs(index_dir, exist_ok=True)
+    np.save(os.path.join(index_dir, "centroids.npy"), centroids)
+    np.save(os.path.join(index_dir, "order.npy"), order)
+    np.save(os.path.join(index_dir, "offsets.npy"), offsets)
+    np.save(os.path.join(index_dir, "sq_norms.npy"), sq_norms)
+    index_bytes = centroids.nbytes + order.nbytes + offsets.nbytes + sq_norms.nbytes
+
+    if pq_m:
+        print(f"[IVF] 訓練 PQ：{pq_m} 個子空間 × {PQ_KSUB} 個中心...")
+        codebooks = train_pq(train - centroids[assignments[train_rows]], pq_m, rng=rng)
+        codes = np.empty((n_rows, pq_m), dtype=np.uint8)
+        for s in range(0, n_rows, BLOCK_ROWS):
+            block = np.asarray(store.embeddings[s:s + BLOCK_ROWS], dtype=np.float32)
+            codes[s:s + BLOCK_ROWS] = encode_pq(block - centroids[assignments[s:s + BLOCK_ROWS]], codebooks)
+        np.save(os.path.join(index_dir, "pq_codebooks.npy"), codebooks)
+        np.save(os.path.join(index_dir, "pq_codes.npy"), codes)
+        index_bytes += codebooks.nbytes + codes.nbytes
+
+    meta = {
+        "n_rows": int(n_rows), "dim": int(dim), "n_lists": int(n_lists), "pq_m": int(pq_m),
+        "store_dir": store_dir, "catalog_version": store.meta.get("catalog_version"),
+        "index_bytes": int(index_bytes), "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with open(os.path.join(index_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    print(f"✅ IVF 索引建立完成：{time.time() - start:.1f} 秒，索引本身 {index_bytes / 1024 / 1024:.1f} MB "
+          f"(原始向量 {store.embeddings.nbytes / 1024 / 1024:.1f} MB 以 memmap 讀取，只在重排時使用)")
+    return meta
+
+
+# --- 3. 搜尋 ---
+class IVFIndex:
+    def __init__(self, index_dir=IVF_INDEX_DIR):
+        with open(os.path.join(index_dir, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.store = embedding_store.load_store(self.meta["store_dir"])
+        self.catalog_version = self.meta.get("catalog_version")
+        self.centroids = np.load(os.path.join(index_dir, "centroids.npy"))
+        self.c_sq = np.einsum("ij,ij->i", self.centroids, self.centroids)
+        self.order = np.load(os.path.join(index_dir, "order.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(index_dir, "offsets.npy"))
+        self.sq_norms = np.load(os.path.join(index_dir, "sq_norms.npy"))
+        self.n_lists = len(self.centroids)
+        self.codebooks = None
+        self.codes = None
+        if self.meta.get("pq_m"):
+            self.codebooks = np.load(os.path.join(index_dir, "pq_codebooks.npy"))
+            self.codes = np.load(os.path.join(index_dir, "pq_codes.npy"), mmap_mode="r")
+        self._masks = OrderedDict()
+        self._masks_lock = threading.Lock()
+
+    def filter_bitmap(self, sql_filter_string):
+        """篩選條件的 bitmap (布林遮罩)；不支援的語法回傳 None。最近用過的 bitmap 會被快取。"""
+        key = " ".join((sql_filter_string or "").split()).lower()
+        with self._masks_lock:
+            if key in self._masks:
+                self._masks.move_to_end(key)
+                return self._masks[key]
+        predicates = embedding_store.parse_sql_filter(sql_filter_string)
+        if predicates is None:
+            return None
+        mask = embedding_store.filter_mask(self.store, predicates)
+        with self._masks_lock:
+            self._masks[key] = mask
+            while len(self._masks) > MASK_CACHE_SIZE:
+                self._masks.popitem(last=False)
+        return mask
+
+    def expected_rows_scanned(self, selectivity, limit_n, nprobe=DEFAULT_NPROBE, rerank_factor=RERANK_FACTOR):
+        """CBO 用：為了湊滿候選，預期要掃描的資料列數。"""
+        n_rows = self.meta["n_rows"]
+        min_rows = n_rows * min(nprobe, self.n_lists) / self.n_lists
+        needed = limit_n * rerank_factor / max(selectivity, 1e-9)
+        return min(max(min_rows, needed), n_rows * MAX_PROBE_FRACTION)
+
+    def _approx_distances(self, q, list_id, rows):
+        if self.codes is None:
+            block = np.asarray(self.store.embeddings[rows], dtype=np.float32)
+            return self.sq_norms[rows] - 2.0 * (block @ q)
+        # ADC：查詢殘差對每個子空間的每個 PQ 中心的距離表，再以 code 查表加總
+        pq_m, _, dsub = self.codebooks.shape
+        residual = (q - self.centroids[list_id]).reshape(pq_m, 1, dsub)
+        table = ((self.codebooks - residual) ** 2).sum(axis=2)
+        return table[np.arange(pq_m), np.asarray(self.codes[rows])].sum(axis=1)
+
+    def search(self, sql_filter_string, v_query, limit_n, nprobe=DEFAULT_NPROBE, rerank_factor=RERANK_FACTOR):
+        """
+        回傳 (結果 list, 掃描的資料列數)；篩選語法不支援時回傳 None。
+        """
+        mask = self.filter_bitmap(sql_filter_string)
+        if mask is None:
+            return None
+
+        q = np.asarray(v_query, dtype=np.float32)
+        wanted = limit_n * rerank_factor
+        max_probe = max(nprobe, int(self.n_lists * MAX_PROBE_FRACTION))
+        list_order = np.argsort(self.c_sq - 2.0 * (self.centroids @ q))
+
+        cand_rows, cand_dist = [], []
+        collected = scanned = 0
+        for probed, list_id in enumerate(list_order, start=1):
+            rows = self.order[self.offsets[list_id]:self.offsets[list_id + 1]]
+            scanned += len(rows)
+            rows = rows[mask[rows]]   # 在 list 掃描中直接套用屬性 bitmap
+            if len(rows):
+                cand_rows.append(rows)
+                cand_dist.append(self._approx_distances(q, list_id, rows))
+                collected += len(rows)
+            if (probed >= nprobe and collected >= wanted) or probed >= max_probe:
+                break
+
+        if not collected:
+            return [], scanned
+        rows = np.concatenate(cand_rows)
+        dist = np.concatenate(cand_dist)
+        if len(rows) > wanted:
+            keep = np.argpartition(dist, wanted - 1)[:wanted]
+            rows = rows[keep]
+
+        # 以原始向量精確重排
+        rows = np.sort(rows)
+        exact = self.sq_norms[rows] - 2.0 * (np.asarray(self.store.embeddings[rows], dtype=np.float32) @ q)
+        k = min(limit_n, len(rows))
+        top = np.argpartition(exact, k - 1)[:k]
+        top = top[np.argsort(exact[top])]
+
+        q_sq = float(q @ q)
+        store = self.store
+        results = []
+        for i in top:
+            row = rows[i]
+            brand_code = store.brand_code[row]
+            price = store.sales_price[row]
+            results.append({
+                "uniq_id": store.uniq_ids[row],
+                "brand": store.brand_vocab[brand_code] if brand_code >= 0 else None,
+                "sales_price": None if np.isnan(price) else float(price),
+                "similarity_score": float(np.sqrt(max(0.0, exact[i] + q_sq))),
+            })
+        return results, scanned
+
+
+# --- 4. 模組層級的單例 ---
+_index = None
+_index_lock = threading.Lock()
+_load_failed = False
+
+
+def get_index(index_dir=IVF_INDEX_DIR):
+    """回傳已載入的索引；索引不存在或載入失敗時回傳 None (只嘗試一次)。"""
+    global _index, _load_failed
+    if _index is not None or _load_failed:
+        return _index
+    with _index_lock:
+        if _index is None and not _load_failed:
+            if not os.path.exists(os.path.join(index_dir, "meta.json")):
+                logger.warning("找不到 %s/meta.json，PLAN_IVF 停用 (請先執行 ivf_index.py build)", index_dir)
+                _load_failed = True
+            else:
+                try:
+                    _index = IVFIndex(index_dir)
+                except Exception:
+                    logger.exception("IVF 索引載入失敗")
+                    _load_failed = True
+    return _index
+
+
+def reload(index_dir=IVF_INDEX_DIR):
+    global _index, _load_failed
+    with _index_lock:
+        _index = None
+        _load_failed = False
+    return get_index(index_dir)
+
+
+# --- 主程式區塊 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="建立程序內的 IVF / IVF-PQ 索引")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_build = sub.add_parser("build", help="建立索引")
+    p_build.add_argument("--store", default=embedding_store.STORE_DIR)
+    p_build.add_argument("--out", default=IVF_INDEX_DIR)
+    p_build.add_argument("--lists", type=int, default=None, help="list 數 (預設 4 * sqrt(N))")
+    p_build.add_argument("--pq-m", type=int, default=0, help="PQ 子空間數 (0 = 不使用 PQ)")
+    p_build.add_argument("--export", action="store_true", help="建索引前重新從資料庫匯出向量")
+    p_info = sub.add_parser("info", help="顯示索引資訊")
+    p_info.add_argument("--index", default=IVF_INDEX_DIR)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if args.export or not os.path.exists(os.path.join(args.store, "meta.json")):
+            embedding_store.export_store(args.store)
+        build_index(args.store, args.out, args.lists, args.pq_m)
+    else:
+        with open(os.path.join(args.index, "meta.json"), "r", encoding="utf-8") as f:
+            print(json.dumps(json.load(f), indent=2, ensure_ascii=False))
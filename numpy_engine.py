@@ -0,0 +1,132 @@
+# ---
+# 檔名：numpy_engine.py
+# 目的：(Phase 6) 程序內的 NumPy 精確搜尋引擎，作為計畫 A 的替代後端
+# 功能：
+#   1. 載入 embedding_store.py 匯出的向量矩陣 (memmap，float16 或 float32) 與欄位陣列
+#   2. 把 SQL 篩選解析成 NumPy 布林遮罩 (embedding_store.parse_sql_filter / filter_mask)
+#   3. 以分塊的矩陣-向量乘積算出篩選後每一筆的 L2 距離，再以 argpartition 取 Top-N
+#   4. 回傳與計畫 A 相同格式的結果 (uniq_id / brand / sales_price / similarity_score)
+# 使用方式：
+#   CBO_PLAN_A_BACKEND=numpy 時，cbo_proxy.execute_plan_a 會先嘗試本引擎；
+#   篩選語法不支援、或匯出的資料已經過期 (catalog 版本不同) 時，退回 SQL 執行。
+# 說明：
+#   Postgres 的計畫 A 要逐列 detoast 並計算 768 維距離；整個目錄放得進記憶體時，
+#   一次 BLAS 矩陣乘法通常快一個數量級以上。
+# ---
+
+import logging
+import os
+import threading
+
+import numpy as np
+
+import embedding_store
+
+logger = logging.getLogger(__name__)
+
+# 每次參與矩陣乘法的資料列數 (float16 需要先轉成 float32 才能走 BLAS，分塊可避免一次複製整個矩陣)
+BLOCK_ROWS = 65536
+
+# 篩選後的比例低於這個值時，只取出符合的資料列計算 (gather)；否則整塊計算再套遮罩
+GATHER_THRESHOLD = 0.3
+
+
+class NumpyEngine:
+    """記憶體中的精確搜尋引擎。"""
+
+    def __init__(self, store_dir=embedding_store.STORE_DIR):
+        self.store = embedding_store.load_store(store_dir)
+        self.catalog_version = self.store.meta.get("catalog_version")
+        # ||e||^2 預先算好 (L2 距離 = ||e||^2 - 2 e·q + ||q||^2)
+        self.sq_norms = np.empty(len(self.store), dtype=np.float32)
+        for start in range(0, len(self.store), BLOCK_ROWS):
+            block = np.asarray(self.store.embeddings[start:start + BLOCK_ROWS], dtype=np.float32)
+            self.sq_norms[start:start + BLOCK_ROWS] = np.einsum("ij,ij->i", block, block)
+        logger.info("NumPy 引擎載入 %s 筆向量 (%s, catalog 版本 %s)",
+                    len(self.store), self.store.embeddings.dtype, self.catalog_version)
+
+    def _scores(self, q, rows=None):
+        """回傳 e·q；rows 為 None 時計算全部資料列，否則只計算 rows 指定的資料列。"""
+        embeddings = self.store.embeddings
+        total = len(self.store) if rows is None else len(rows)
+        scores = np.empty(total, dtype=np.float32)
+        for start in range(0, total, BLOCK_ROWS):
+            if rows is None:
+                block = embeddings[start:start + BLOCK_ROWS]
+            else:
+                block = embeddings[rows[start:start + BLOCK_ROWS]]
+            scores[start:start + BLOCK_ROWS] = np.asarray(block, dtype=np.float32) @ q
+        return scores
+
+    def search(self, sql_filter_string, v_query, limit_n):
+        """
+        回傳 (結果 list, 實際篩選筆數)；篩選語法不支援時回傳 None (呼叫端應退回 SQL)。
+        """
+        predicates = embedding_store.parse_sql_filter(sql_filter_string)
+        if predicates is None:
+            return None
+
+        q = np.asarray(v_query, dtype=np.float32)
+        mask = embedding_store.filter_mask(self.store, predicates)
+        rows = np.flatnonzero(mask)
+        n_filtered = len(rows)
+        if n_filtered == 0:
+            return [], 0
+
+        if n_filtered < GATHER_THRESHOLD * len(self.store):
+            dist = self.sq_norms[rows] - 2.0 * self._scores(q, rows)
+        else:
+            dist = (self.sq_norms - 2.0 * self._scores(q))[rows]
+
+        k = min(limit_n, n_filtered)
+        top = np.argpartition(dist, k - 1)[:k]
+        top = top[np.argsort(dist[top])]
+
+        q_sq = float(q @ q)
+        store = self.store
+        results = []
+        for i in top:
+            row = rows[i]
+            brand_code = store.brand_code[row]
+            price = store.sales_price[row]
+            results.append({
+                "uniq_id": store.uniq_ids[row],
+                "brand": store.brand_vocab[brand_code] if brand_code >= 0 else None,
+                "sales_price": None if np.isnan(price) else float(price),
+                "similarity_score": float(np.sqrt(max(0.0, dist[i] + q_sq))),
+            })
+        return results, n_filtered
+
+
+# --- 模組層級的單例 (第一次使用時載入) ---
+_engine = None
+_engine_lock = threading.Lock()
+_load_failed = False
+
+
+def get_engine(store_dir=embedding_store.STORE_DIR):
+    """回傳已載入的引擎；匯出檔不存在或載入失敗時回傳 None (只嘗試一次)。"""
+    global _engine, _load_failed
+    if _engine is not None or _load_failed:
+        return _engine
+    with _engine_lock:
+        if _engine is None and not _load_failed:
+            if not os.path.exists(os.path.join(store_dir, "meta.json")):
+                logger.warning("找不到 %s/meta.json，NumPy 引擎停用 (請先執行 embedding_store.py 匯出)", store_dir)
+                _load_failed = True
+            else:
+                try:
+                    _engine = NumpyEngine(store_dir)
+                except Exception:
+                    logger.exception("NumPy 引擎載入失敗")
+                    _load_failed = True
+    return _engine
+
+
+def reload(store_dir=embedding_store.STORE_DIR):
+    """重新匯出之後呼叫，載入新的檔案。"""
+    global _engine, _load_failed
+    with _engine_lock:
+        _engine = None
+        _load_failed = False
+    return get_engine(store_dir)
@@ -0,0 +1,301 @@
+# ---
+# 檔名：pca_rerank.py
+# 目的：(Phase 6) 兩階段搜尋：降維向量的 HNSW 粗搜 + 完整 768 維向量精確重排
+# 功能：
+#   1. fit   ：以 embedding_store.py 匯出的向量 (分塊累加共變異數矩陣) 計算 PCA，存成 pca_model.npz
+#   2. load  ：重建側表 products_pca (uniq_id PRIMARY KEY, embedding_pca VECTOR(d))，以 COPY 寫入，
+#              再建立它自己的 HNSW 索引 idx_embedding_pca_hnsw (vector_l2_ops) 並 ANALYZE
+#   3. search：查詢向量以同一個 PCA 投影 -> 從側表的小索引取回較多的候選 (limit_n × CANDIDATE_FACTOR)
+#              -> 以 uniq_id join products，用完整的 embedding 計算 L2 距離重排並套用篩選 (與計畫 B 相同的後篩選)
+#   4. report：對抽樣查詢比較 計畫 B 與 不同候選倍數 的 recall@k / 延遲，以及兩個索引的大小
+# 說明：
+#   PCA 是正交投影，降維後的 L2 距離 = 完整距離在前 d 個主成分上的部分，排序大致保留；
+#   精確重排修正剩下的誤差。128 ~ 256 維的索引只有原本的 1/6 ~ 1/3 大，較容易整個留在記憶體中，
+#   每一步圖走訪計算的距離也較便宜。
+#   降維向量放在側表而不是 products 的新欄位：對 products 做全表 UPDATE 時每一列都產生新版本 (無法 HOT)，
+#   每一列都要在 idx_embedding_hnsw 插入新的項目，成本與重建主索引差不多，還會讓它膨脹。
+#   ingest 之後的新資料不在 products_pca，不會被這個模式找到，請重新執行 load。
+# 執行方式：
+#   python embedding_store.py
+#   python pca_rerank.py fit --dim 128
+#   python pca_rerank.py load
+#   python pca_rerank.py report --queries 100 --factors 2 5 10 --out pca_report.json
+# ---
+
+import argparse
+import io
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+
+import numpy as np
+import psycopg2
+from psycopg2 import sql, extras
+from dotenv import load_dotenv
+
+import cbo_proxy
+import embedding_store
+import evaluate_recall
+import finalize_database
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+DB_SETTINGS = {
+    "host": os.environ.get("DB_HOST"),
+    "port": os.environ.get("DB_PORT"),
+    "user": os.environ.get("DB_USER"),
+    "password": os.environ.get("DB_PASSWORD"),
+    "database": os.environ.get("DB_NAME")
+}
+
+PCA_MODEL_PATH = os.environ.get("CBO_PCA_MODEL", "pca_model.npz")
+PCA_DIM = 128
+PCA_TABLE = "products_pca"
+PCA_COLUMN = "embedding_pca"
+PCA_INDEX = "idx_embedding_pca_hnsw"
+BLOCK_ROWS = 50000
+
+# 粗搜取回的候選數 = limit_n × CANDIDATE_FACTOR
+CANDIDATE_FACTOR = 5
+PCA_EF_SEARCH = 100
+
+
+# --- 1. PCA ---
+def fit_pca(store, dim=PCA_DIM, block_rows=BLOCK_ROWS):
+    """分塊累加 Σx 與 XᵀX (float64)，不需要把整個矩陣載入記憶體。回傳 (mean, components, 解釋變異比例)。"""
+    n_rows, full_dim = store.embeddings.shape
+    total = np.zeros(full_dim, dtype=np.float64)
+    gram = np.zeros((full_dim, full_dim), dtype=np.float64)
+    for start in range(0, n_rows, block_rows):
+        block = np.asarray(store.embeddings[start:start + block_rows], dtype=np.float64)
+        total += block.sum(axis=0)
+        gram += block.T @ block
+    mean = total / n_rows
+    cov = gram / n_rows - np.outer(mean, mean)
+    eigvals, eigvecs = np.linalg.eigh(cov)          # 由小到大
+    order = np.argsort(eigvals)[::-1][:dim]
+    components = eigvecs[:, order].T.astype(np.float32)   # (dim, full_dim)
+    explained = float(eigvals[order].sum() / eigvals.sum())
+    return mean.astype(np.float32), components, explained
+
+
+def save_model(path, mean, components, explained, catalog_version):
+    np.savez(path, mean=mean, components=components, explained=np.float64(explained),
+             catalog_version=np.int64(-1 if catalog_version is None else catalog_version))
+
+
+def load_model(path=PCA_MODEL_PATH):
+    data = np.load(path)
+    version = int(data["catalog_version"])
+    return {"mean": data["mean"], "components": data["components"],
+            "explained": float(data["explained"]), "catalog_version": None if version < 0 else version}
+
+
+def project(model, vectors):
+    """(n, 768) 或 (768,) -> 降維後的向量。"""
+    return (np.asarray(vectors, dtype=np.float32) - model["mean"]) @ model["components"].T
+
+
+def _vector_text(vec):
+    return "[" + ",".join(f"{x:.6g}" for x in vec) + "]"
+
+
+# --- 2. 寫入降維側表並建立索引 ---
+def load_column(store, model, block_rows=BLOCK_ROWS):
+    dim = model["components"].shape[0]
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_SETTINGS)
+        cursor = conn.cursor()
+        print(f"[PCA] 重建 {PCA_TABLE} ({PCA_COLUMN} VECTOR({dim}))...")
+        # 舊版把降維向量放在 products 的欄位裡：DROP COLUMN 只改目錄 (不改寫資料列)，欄位上的索引一併刪除
+        cursor.execute(f"ALTER TABLE products DROP COLUMN IF EXISTS {PCA_COLUMN};")
+        cursor.execute(f"DROP TABLE IF EXISTS {PCA_TABLE};")
+        cursor.execute(f"CREATE TABLE {PCA_TABLE} (uniq_id VARCHAR(255) PRIMARY KEY, {PCA_COLUMN} VECTOR({dim}) NOT NULL);")
+
+        start = time.time()
+        for offset in range(0, len(store), block_rows):
+            reduced = project(model, store.embeddings[offset:offset + block_rows])
+            buf = io.StringIO()
+            for uniq_id, vec in zip(store.uniq_ids[offset:offset + block_rows], reduced):
+                buf.write(f"{uniq_id}\t{_vector_text(vec)}\n")
+            buf.seek(0)
+            cursor.copy_expert(f"COPY {PCA_TABLE} (uniq_id, {PCA_COLUMN}) FROM STDIN;", buf)
+            print(f"  投影：{min(offset + block_rows, len(store))}/{len(store)} 筆")
+        conn.commit()
+        print(f"[PCA] 已寫入 {len(store)} 筆 ({time.time() - start:.1f} 秒)")
+
+        conn.autocommit = True
+        print(f"[PCA] 建立 {PCA_INDEX} (m={finalize_database.HNSW_M}, "
+              f"ef_construction={finalize_database.HNSW_EF_CONSTRUCTION})...")
+        start = time.time()
+        cursor.execute(f"""
+            CREATE INDEX {PCA_INDEX} ON {PCA_TABLE}
+            USING HNSW ({PCA_COLUMN} vector_l2_ops)
+            WITH (m = {finalize_database.HNSW_M}, ef_construction = {finalize_database.HNSW_EF_CONSTRUCTION});
+        """)
+        cursor.execute(f"ANALYZE {PCA_TABLE};")
+        print(f"✅ 索引建立完成 ({time.time() - start:.1f} 秒)")
+    except Exception as e:
+        print(f"❌ 錯誤: {e}")
+        if conn and not conn.autocommit:
+            conn.rollback()
+    finally:
+        if conn:
+            conn.close()
+
+
+# --- 3. 兩階段搜尋 ---
+def build_query(sql_filter_string, n_candidates, limit_n):
+    """參數：(降維查詢向量, 完整查詢向量)"""
+    return sql.SQL("""
+        WITH Coarse AS MATERIALIZED (
+            SELECT uniq_id
+            FROM {pca_table}
+            ORDER BY {pca_column} <-> %s::vector -- 走 idx_embedding_pca_hnsw (vector_l2_ops)
+            LIMIT {limit_k}
+        )
+        SELECT p.uniq_id, p.brand, p.sales_price, (p.embedding <-> %s::vector) AS similarity_score
+        FROM Coarse c
+        JOIN products p ON p.uniq_id = c.uniq_id
+        WHERE {sql_filter}
+        ORDER BY similarity_score ASC
+        LIMIT {limit_n};
+    """).format(
+        pca_table=sql.Identifier(PCA_TABLE),
+        pca_column=sql.Identifier(PCA_COLUMN),
+        limit_k=sql.Literal(n_candidates),
+        sql_filter=cbo_proxy.filter_sql(sql_filter_string),
+        limit_n=sql.Literal(limit_n),
+    )
+
+
+_model = None
+
+
+def get_model():
+    global _model
+    if _model is None:
+        _model = load_model(PCA_MODEL_PATH)
+    return _model
+
+
+def search(v_query, sql_filter_string="1 = 1", limit_n=cbo_proxy.N_RESULTS,
+           candidate_factor=CANDIDATE_FACTOR, ef_search=PCA_EF_SEARCH, model=None):
+    """兩階段搜尋；回傳格式與 cbo_proxy.execute_plan_b 相同。"""
+    model = model or get_model()
+    n_candidates = limit_n * candidate_factor
+    reduced = project(model, v_query)
+    try:
+        with cbo_proxy.db_connection() as conn:
+            cursor = conn.cursor(cursor_factory=extras.DictCursor)
+            cursor.execute("SET hnsw.ef_search = %s;",
+                           (min(max(ef_search, n_candidates), cbo_proxy.HNSW_EF_SEARCH_MAX),))
+            cursor.execute(build_query(sql_filter_string, n_candidates, limit_n),
+                           (_vector_text(reduced), _vector_text(np.asarray(v_query, dtype=np.float32))))
+            return [dict(row) for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error("兩階段搜尋時發生錯誤：%s", e)
+        return []
+
+
+# --- 4. 與計畫 B 比較 ---
+def index_sizes():
+    with cbo_proxy.db_connection(autocommit=True) as conn:
+        cursor = conn.cursor()
+        sizes = {}
+        for name in ("idx_embedding_hnsw", PCA_INDEX):
+            cursor.execute("SELECT pg_relation_size(to_regclass(%s));", (name,))
+            size = cursor.fetchone()[0]
+            sizes[name] = None if size is None else size / 1024 ** 2
+        return sizes
+
+
+def report(store, model, n_queries, k, factors, noise=evaluate_recall.QUERY_NOISE):
+    queries = evaluate_recall.sample_queries(store, n_queries, noise)
+    truth = evaluate_recall.exact_top_k(store, queries, np.ones(len(store), dtype=bool), k)
+    samples = defaultdict(lambda: {"recall": [], "latency_ms": []})
+
+    for query_vec, truth_ids in zip(queries, truth):
+        v_query = query_vec.tolist()
+
+        def _add(config, results, latency_ms):
+            samples[config]["recall"].append(evaluate_recall.recall_at_k(truth_ids, results, k))
+            samples[config]["latency_ms"].append(latency_ms)
+
+        results, ms = evaluate_recall._timed(cbo_proxy.execute_plan_b, "1 = 1", v_query,
+                                             k_candidates=k, limit_n=k, ef_search=cbo_proxy.HNSW_EF_SEARCH)
+        _add(f"PLAN_B ef={max(cbo_proxy.HNSW_EF_SEARCH, k)}", results, ms)
+        for factor in factors:
+            results, ms = evaluate_recall._timed(search, v_query, "1 = 1", k, factor, model=model)
+            _add(f"PCA{model['components'].shape[0]} x{factor}", results, ms)
+
+    rows = []
+    for config, values in samples.items():
+        recalls = np.array(values["recall"], dtype=float)
+        latencies = np.array(values["latency_ms"], dtype=float)
+        rows.append({
+            "config": config, "n": len(recalls),
+            "mean_recall": float(recalls.mean()), "p10_recall": float(np.percentile(recalls, 10)),
+            "p50_latency_ms": float(np.percentile(latencies, 50)),
+            "p95_latency_ms": float(np.percentile(latencies, 95)),
+        })
+    return {"k": k, "n_queries": len(queries), "pca_dim": int(model["components"].shape[0]),
+            "explained_variance": model["explained"], "index_size_mb": index_sizes(), "results": rows}
+
+
+def print_report(result):
+    print("\n" + "=" * 80)
+    print(f"📊 兩階段 (PCA{result['pca_dim']}, 解釋變異 {result['explained_variance']:.1%}) vs 計畫 B："
+          f"recall@{result['k']}，{result['n_queries']} 個查詢")
+    for name, size in result["index_size_mb"].items():
+        print(f"  {name}: " + ("(不存在)" if size is None else f"{size:.1f} MB"))
+    print("=" * 80)
+    print(f"{'設定':<20} | {'平均 recall':>11} | {'P10 recall':>10} | {'P50 (ms)':>9} | {'P95 (ms)':>9}")
+    print("-" * 80)
+    for row in result["results"]:
+        print(f"{row['config']:<20} | {row['mean_recall']:>11.3f} | {row['p10_recall']:>10.3f} | "
+              f"{row['p50_latency_ms']:>9.2f} | {row['p95_latency_ms']:>9.2f}")
+    print("=" * 80)
+
+
+# --- 主程式區塊 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PCA 降維粗搜 + 完整向量重排")
+    parser.add_argument("--store", default=embedding_store.STORE_DIR)
+    parser.add_argument("--model", default=PCA_MODEL_PATH)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_fit = sub.add_parser("fit", help="以匯出的向量計算 PCA")
+    p_fit.add_argument("--dim", type=int, default=PCA_DIM)
+    sub.add_parser("load", help="寫入 products_pca 側表並建立 HNSW 索引")
+    p_report = sub.add_parser("report", help="與計畫 B 比較 recall 與延遲")
+    p_report.add_argument("--queries", type=int, default=100)
+    p_report.add_argument("--k", type=int, default=evaluate_recall.TOP_K)
+    p_report.add_argument("--factors", type=int, nargs="+", default=[2, CANDIDATE_FACTOR, 10])
+    p_report.add_argument("--out", default=None, help="把結果寫成 JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if not os.path.exists(os.path.join(args.store, "meta.json")):
+        embedding_store.export_store(args.store)
+    store = embedding_store.load_store(args.store)
+
+    if args.command == "fit":
+        start = time.time()
+        mean, components, explained = fit_pca(store, args.dim)
+        save_model(args.model, mean, components, explained, store.meta.get("catalog_version"))
+        print(f"✅ PCA {store.embeddings.shape[1]} -> {args.dim} 維，解釋變異 {explained:.1%} "
+              f"({time.time() - start:.1f} 秒)，已寫入 {args.model}")
+    elif args.command == "load":
+        load_column(store, load_model(args.model))
+    else:
+        result = report(store, load_model(args.model), args.queries, args.k, args.factors)
+        print_report(result)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2, ensure_ascii=False)
+            print(f"✅ 已寫入 {args.out}")
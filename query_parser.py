@@ -8,6 +8,11 @@ from sentence_transformers import SentenceTransformer
 from PIL import Image
 import numpy as np
 import re # 匯入「正則表達式」函式庫，用於解析文字
+import logging
+import tracing
+
+# 每個查詢都會走到的訊息使用 logging，由呼叫端決定要不要顯示
+logger = logging.getLogger(__name__)
 
 # --- 修改類型關鍵字（可以慢慢補）---
 COLOR_WORDS  = ["red", "blue", "black", "white", "green", "yellow",
@@ -103,55 +108,100 @@ def choose_img_weight(mod_text: str) -> float:
     return img_w
 
 
-def get_query_vector(base_image_path, modification_text):
+def compose_query_vector(v_img, modification_text):
     """
-    (Phase 2.1) 實作「AI 向量微調」
-    接收「基準圖片」和「微調文字」，回傳一個「組合」後的查詢向量。
+    把「基準圖片向量」與「微調文字」組合成查詢向量 (回傳正規化後的 list)。
+    v_img 可以來自剛編碼的圖片，也可以是資料庫中某個商品已存好的 embedding。
     """
     if not model:
-        print("錯誤：AI 模型未載入。")
+        logger.error("錯誤：AI 模型未載入。")
         return None
 
-    try:
-        # A. 圖片 → 向量
-        image = Image.open(base_image_path)
-        v_img = model.encode(image, normalize_embeddings=True)
-        
-        # B. 文字 → 向量（若沒有文字，就給個空字串）
-        modification_text = modification_text or ""
+    v_img = np.asarray(v_img, dtype=np.float32)
+
+    # B. 文字 → 向量（若沒有文字，就給個空字串）
+    modification_text = modification_text or ""
+    with tracing.stage("text_encode"):
         v_text = model.encode(modification_text, normalize_embeddings=True)
 
-        # C. 根據文字內容決定這次查詢的 IMG_WEIGHT
-        IMG_WEIGHT = choose_img_weight(modification_text)
-        print(f"[Query Parser] 本次查詢 IMG_WEIGHT = {IMG_WEIGHT:.2f}")
+    # C. 根據文字內容決定這次查詢的 IMG_WEIGHT
+    IMG_WEIGHT = choose_img_weight(modification_text)
+    logger.info("[Query Parser] 本次查詢 IMG_WEIGHT = %.2f", IMG_WEIGHT)
 
-        # D. 用 slerp 做圖文混合
+    # D. 用 slerp 做圖文混合
+    with tracing.stage("slerp"):
         v_query = slerp(IMG_WEIGHT, v_text, v_img)
 
         # E. 正規化後回傳
         v_query_normalized = v_query / np.linalg.norm(v_query)
-        return v_query_normalized.tolist()
+    return v_query_normalized.tolist()
+
+
+def get_query_vector_from_image(image, modification_text):
+    """
+    與 get_query_vector 相同，但直接接收已開啟的 PIL Image (例如 HTTP 上傳的圖片)。
+    """
+    if not model:
+        logger.error("錯誤：AI 模型未載入。")
+        return None
+
+    try:
+        # A. 圖片 → 向量
+        with tracing.stage("image_encode"):
+            v_img = model.encode(image, normalize_embeddings=True)
+        return compose_query_vector(v_img, modification_text)
+    except Exception as e:
+        logger.error("錯誤：在 get_query_vector_from_image 中發生錯誤：%s", e)
+        return None
+
+
+def get_query_vector(base_image_path, modification_text):
+    """
+    (Phase 2.1) 實作「AI 向量微調」
+    接收「基準圖片」和「微調文字」，回傳一個「組合」後的查詢向量。
+    """
+    if not model:
+        logger.error("錯誤：AI 模型未載入。")
+        return None
 
+    try:
+        image = Image.open(base_image_path)
     except FileNotFoundError:
-        print(f"錯誤：找不到圖片檔案 {base_image_path}")
+        logger.error("錯誤：找不到圖片檔案 %s", base_image_path)
         return None
     except Exception as e:
-        print(f"錯誤：在 get_query_vector 中發生錯誤：{e}")
+        logger.error("錯誤：在 get_query_vector 中發生錯誤：%s", e)
         return None
+    return get_query_vector_from_image(image, modification_text)
 
 # --- 3. SQL 篩選解析 (SQL Filter Parsing) ---
 
+def sql_string_literal(text):
+    """把使用者輸入變成 SQL 字串常數：前後加上單引號，內部的單引號加倍 (standard_conforming_strings 下反斜線不是跳脫字元)。"""
+    return "'" + text.replace("'", "''") + "'"
+
+
+def escape_like(text):
+    """把使用者輸入放進 LIKE 樣式：跳脫萬用字元 (%、_) 與跳脫字元本身 (單引號由 sql_string_literal 處理)。"""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
 def get_sql_filter(full_prompt_text):
     """
     (Phase 2.2) 實作「SQL 篩選解析」
     從使用者的完整提示中「萃取」結構化條件。
     
     [注意] 
-    這是一個「簡易版」的解析器，只處理 'price' 和 'brand'。
+    這是一個「簡易版」的解析器，只處理 'price'、'brand' 和 'keyword' (商品名稱關鍵字)。
     一個「真正」的專案會在這裡使用 LLM (大型語言模型) 來做「自然語言轉 SQL」。
     但對於我們的 CBO 專案，這個「簡易版」就足夠驗證了。
     """
-    print(f"[Query Parser] 正在解析 SQL 篩選條件：'{full_prompt_text}'")
+    with tracing.stage("sql_filter"):
+        return _parse_sql_filter(full_prompt_text)
+
+
+def _parse_sql_filter(full_prompt_text):
+    logger.info("[Query Parser] 正在解析 SQL 篩選條件：'%s'", full_prompt_text)
     
     sql_conditions = [] # 用來存放所有找到的 SQL 條件
 
@@ -170,18 +220,34 @@ def get_sql_filter(full_prompt_text):
 
     # 2. 搜尋「品牌 (Brand)」
     # 're.search' 會尋找 'brand = Gucci' 或 'brand is Nike' 或 'brand Gucci'
-    brand_match = re.search(r"brand\s*(=|is)?\s*\'?([a-zA-Z0-9\s']+)\'?", full_prompt_text, re.IGNORECASE)
+    # 與關鍵字相同，遇到 ';'、','、下一個 price / keyword 條件或結尾才結束，'brand is nike keyword: skirt' 的品牌只有 nike。
+    # 品牌名稱保留原樣 (o'neill、H&M、Levi's、非英文字母...)，不可截成前綴：截斷後查詢照樣執行，只是回傳錯的商品
+    brand_match = re.search(r"brand\s*(=|is\b)?\s*(.+?)\s*(?=[;,]|\bprice\b|\bkeywords?\b|$)",
+                            full_prompt_text, re.IGNORECASE)
     if brand_match:
-        # .strip() 用於去除 'Gucci' 前後的潛在空格
         brand_name = brand_match.group(2).strip()
-        # [安全] 我們必須在品牌名稱周圍加上「單引號」，SQL 才認得
-        sql_conditions.append(f"brand = '{brand_name}'")
-
-    # 3. 組合所有條件
+        # 只去掉包住整個名稱的引號 ('Gucci')，名稱內的引號 (Levi's) 保留
+        if len(brand_name) >= 2 and brand_name[0] == brand_name[-1] == "'":
+            brand_name = brand_name[1:-1].strip()
+        # [安全] 篩選字串會直接組進 SQL：以 sql_string_literal 組成字串常數 (單引號加倍)，使用者無法跳出字串
+        if brand_name:
+            sql_conditions.append(f"brand = {sql_string_literal(brand_name)}")
+
+    # 3. 搜尋「關鍵字 (Keyword)」
+    # 'keyword: black skirt' 或 'keywords = black, skirt'：每個字都要出現在 product_name 中 (不分大小寫)
+    # 以 ';' 或下一個 price / brand 條件結束。由 create_table.py 的 trigram GIN 索引支援。
+    keyword_match = re.search(r"\bkeywords?\s*(?::|=)\s*(.+?)\s*(?=;|\bprice\b|\bbrand\b|$)",
+                              full_prompt_text, re.IGNORECASE)
+    if keyword_match:
+        for word in re.split(r"[\s,]+", keyword_match.group(1)):
+            if word:
+                sql_conditions.append(f"product_name ILIKE {sql_string_literal('%' + escape_like(word) + '%')}")
+
+    # 4. 組合所有條件
     if not sql_conditions:
-        print("[Query Parser] 未找到 SQL 篩選條件。")
+        logger.info("[Query Parser] 未找到 SQL 篩選條件。")
         return "1 = 1" # 回傳一個「永遠為真」的條件，代表「不過濾」
     
     sql_filter_string = " AND ".join(sql_conditions)
-    print(f"[Query Parser] 成功解析 SQL 篩選：'{sql_filter_string}'")
+    logger.info("[Query Parser] 成功解析 SQL 篩選：'%s'", sql_filter_string)
     return sql_filter_string
\ No newline at end of file
@@ -0,0 +1,214 @@
+# ---
+# 檔名：result_cache.py
+# 目的：(Phase 5) 搜尋結果快取
+# 功能：
+#   1. 以「量化後的查詢向量 + 正規化的 SQL 篩選 + N」的雜湊作為 key，快取整個搜尋結果
+#   2. 有上限的 LRU 淘汰 + TTL 過期
+#   3. 以 catalog_version 表中的 products 版本號做失效：匯入資料 (input_to_db.py) 時會遞增版本號，
+#      快取發現版本變了就整批清空
+#   4. 提供命中率等統計數據 (stats)
+# 說明：
+#   熱門商品、預設篩選條件的查詢重複率很高，命中時不需要 EXPLAIN，也不需要連資料庫。
+# ---
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+DB_SETTINGS = {
+    "host": os.environ.get("DB_HOST"),
+    "port": os.environ.get("DB_PORT"),
+    "user": os.environ.get("DB_USER"),
+    "password": os.environ.get("DB_PASSWORD"),
+    "database": os.environ.get("DB_NAME")
+}
+
+# --- 1. 快取設定 ---
+CACHE_MAX_ENTRIES = int(os.environ.get("CBO_CACHE_MAX_ENTRIES", "10000"))
+CACHE_TTL_S = float(os.environ.get("CBO_CACHE_TTL_S", "300"))
+
+# 向量量化的刻度：每個維度四捨五入到 1/QUANTIZATION_SCALE
+# (CLIP 正規化向量的每個分量都在 ±1 之內，1/2048 的誤差不會改變 Top-N 排序)
+QUANTIZATION_SCALE = 2048
+
+# 最多每隔幾秒向資料庫確認一次 catalog 版本號 (其餘時間完全不碰資料庫)
+VERSION_CHECK_INTERVAL_S = 1.0
+
+CATALOG_TABLE = "products"
+
+# --- 2. 模組狀態 ---
+_lock = threading.Lock()
+_entries = OrderedDict()      # {key: (expires_at, catalog_version, value)}
+_stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "invalidations": 0, "stale_puts": 0}
+_known_version = None
+_version_checked_at = 0.0
+_catalog_table_ready = False  # 這個程序已確認 catalog_version 表存在
+
+
+def make_key(v_query, sql_filter_string, limit_n):
+    """
+    快取 key：量化後的查詢向量 + 正規化的篩選條件 + 回傳筆數。
+    """
+    quantized = np.round(np.asarray(v_query, dtype=np.float32) * QUANTIZATION_SCALE).astype(np.int16)
+    normalized_filter = " ".join((sql_filter_string or "").split()).lower()
+    digest = hashlib.sha1()
+    digest.update(quantized.tobytes())
+    digest.update(b"\x00")
+    digest.update(normalized_filter.encode("utf-8"))
+    digest.update(b"\x00")
+    digest.update(str(limit_n).encode("ascii"))
+    return digest.hexdigest()
+
+
+# --- 3. catalog 版本號 ---
+def get_catalog_version(cursor, table_name=CATALOG_TABLE):
+    cursor.execute("SELECT version FROM catalog_version WHERE table_name = %s;", (table_name,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def ensure_catalog_table(cursor):
+    """
+    建立 catalog_version 表 (可重複執行)。在這個功能之前建立的資料庫沒有這張表，
+    第一次遞增版本號時才建立，不必重跑 create_table.py。
+    """
+    global _catalog_table_ready
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            table_name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+    _catalog_table_ready = True
+
+
+def bump_catalog_version(cursor, table_name=CATALOG_TABLE):
+    """
+    遞增 catalog 版本號。由寫入 products 的程式在「同一個交易」中呼叫，
+    讓所有搜尋服務的快取在下一次版本檢查時失效。
+    """
+    if not _catalog_table_ready:
+        ensure_catalog_table(cursor)
+    cursor.execute("""
+        INSERT INTO catalog_version (table_name, version, updated_at)
+        VALUES (%s, 1, now())
+        ON CONFLICT (table_name)
+        DO UPDATE SET version = catalog_version.version + 1, updated_at = now();
+    """, (table_name,))
+
+
+def _fetch_version_direct():
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_SETTINGS)
+        conn.autocommit = True
+        return get_catalog_version(conn.cursor())
+    finally:
+        if conn:
+            conn.close()
+
+
+_fetch_version = _fetch_version_direct
+
+
+def set_version_source(fetch_version):
+    """
+    替換取得版本號的方式 (例如搜尋服務改用連線池)。fetch_version() 需回傳目前的版本號。
+    """
+    global _fetch_version
+    _fetch_version = fetch_version
+
+
+def _current_version():
+    """
+    每 VERSION_CHECK_INTERVAL_S 秒最多查一次資料庫；版本改變時清空快取。
+    查詢失敗 (例如 catalog_version 表尚未建立) 時沿用上次的版本號，只依賴 TTL。
+    """
+    global _known_version, _version_checked_at
+    now = time.monotonic()
+    if now - _version_checked_at < VERSION_CHECK_INTERVAL_S:
+        return _known_version
+    _version_checked_at = now
+
+    try:
+        version = _fetch_version()
+    except Exception:
+        return _known_version
+
+    with _lock:
+        if _known_version is not None and version != _known_version:
+            _entries.clear()
+            _stats["invalidations"] += 1
+        _known_version = version
+    return version
+
+
+def current_version():
+    """目前已知的 catalog 版本號 (同樣受 VERSION_CHECK_INTERVAL_S 限制查詢頻率)。"""
+    return _current_version()
+
+
+# --- 4. 快取操作 ---
+def get(key):
+    """
+    回傳 (快取的值, 查詢時的 catalog 版本號)；沒有命中時值為 None。
+    沒有命中的呼叫端算出結果後，要把這個版本號原封不動傳給 put()。
+    """
+    version = _current_version()
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            _stats["misses"] += 1
+            return None, version
+        expires_at, entry_version, value = entry
+        if expires_at < now or entry_version != version:
+            del _entries[key]
+            _stats["expired"] += 1
+            _stats["misses"] += 1
+            return None, version
+        _entries.move_to_end(key)
+        _stats["hits"] += 1
+        return value, version
+
+
+def put(key, value, version, ttl_s=CACHE_TTL_S):
+    """
+    存入以 version (get() 回傳的版本號) 算出的結果。計算期間其他執行緒已經看到新版本時不存：
+    以舊版資料算出的結果標上新版本號，會在 TTL 到期前一直被當成最新結果回傳。
+    """
+    with _lock:
+        if version != _known_version:
+            _stats["stale_puts"] += 1
+            return
+        _entries[key] = (time.monotonic() + ttl_s, version, value)
+        _entries.move_to_end(key)
+        while len(_entries) > CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+            _stats["evictions"] += 1
+
+
+def invalidate():
+    """手動清空快取 (本程序內寫入 products 之後可直接呼叫，不必等版本檢查)。"""
+    with _lock:
+        _entries.clear()
+        _stats["invalidations"] += 1
+
+
+def stats():
+    """回傳快取統計 (含命中率)。"""
+    with _lock:
+        snapshot = dict(_stats)
+        snapshot["entries"] = len(_entries)
+        snapshot["catalog_version"] = _known_version
+    lookups = snapshot["hits"] + snapshot["misses"]
+    snapshot["hit_rate"] = snapshot["hits"] / lookups if lookups else 0.0
+    return snapshot
@@ -10,6 +10,7 @@ import cbo_proxy
 import query_parser
 import os
 import sys
+import logging
 import shutil  # 用於刪除資料夾
 
 # --- 1. 全域參數設定 ---
@@ -84,12 +85,14 @@ def run_test_a():
     print(f"   SQL 條件: {sql_filter} (約 TWD {PRICE_NARROW_MIN}-{PRICE_NARROW_MAX})")
 
     # CBO 決策與執行
-    decision = cbo_proxy.get_cbo_decision(sql_filter)
+    estimate = cbo_proxy.get_cbo_estimate(sql_filter)
+    decision = estimate["plan"]
     
     if decision == "PLAN_A":
-        results = cbo_proxy.execute_plan_a(sql_filter, v_query)
+        results = cbo_proxy.execute_plan_a(sql_filter, v_query, n_estimated=estimate["n_filtered"])
     else:
-        results = cbo_proxy.execute_plan_b(sql_filter, v_query)
+        results = cbo_proxy.execute_plan_b(sql_filter, v_query, k_candidates=estimate["k_needed"],
+                                           n_estimated=estimate["n_filtered"])
     
     # 存檔
     cbo_proxy.save_result_images(results, target_folder="resultA")
@@ -117,12 +120,14 @@ def run_test_b():
     print(f"   SQL 條件: {sql_filter} (約 TWD {PRICE_WIDE_MIN}-{PRICE_WIDE_MAX})")
 
     # CBO 決策與執行
-    decision = cbo_proxy.get_cbo_decision(sql_filter)
+    estimate = cbo_proxy.get_cbo_estimate(sql_filter)
+    decision = estimate["plan"]
     
     if decision == "PLAN_A":
-        results = cbo_proxy.execute_plan_a(sql_filter, v_query)
+        results = cbo_proxy.execute_plan_a(sql_filter, v_query, n_estimated=estimate["n_filtered"])
     else:
-        results = cbo_proxy.execute_plan_b(sql_filter, v_query)
+        results = cbo_proxy.execute_plan_b(sql_filter, v_query, k_candidates=estimate["k_needed"],
+                                           n_estimated=estimate["n_filtered"])
     
     # 存檔
     cbo_proxy.save_result_images(results, target_folder="resultB")
@@ -184,6 +189,9 @@ def run_test_c():
 
 # --- 主程式進入點 ---
 if __name__ == "__main__":
+    # cbo_proxy / query_parser 的決策過程以 logging 輸出，CLI 用 INFO 顯示
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     # [新增] 執行前先清理舊資料
     cleanup_old_results()
 
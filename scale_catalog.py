@@ -0,0 +1,274 @@
+# ---
+# 檔名：scale_catalog.py
+# 目的：(Phase 6) 合成商品目錄產生器：把 products 放大到 100 萬 ~ 1000 萬筆，做規模測試
+# 功能：
+#   1. 以既有商品的向量為種子，加上高斯擾動後重新正規化，產生「相似但不相同」的新向量 (不需要 CLIP)
+#   2. brand / sales_price / rating / amazon_prime_y_or_n 從實際資料的分佈重新抽樣
+#      (marginal：各欄位獨立抽樣，與 analyze_distribution.py 畫出的分佈一致；
+#       source：沿用種子商品的欄位，保留品牌與價格之間的相關性)
+#   3. 以 COPY (BINARY) 批次寫入 UNLOGGED 暫存表，再 INSERT ... SELECT 進 products，
+#      每一批都在同一個交易中遞增 catalog 版本號，最後執行 ANALYZE
+#   4. --remove 可刪除所有合成資料 (uniq_id 以 "syn_" 開頭)
+# 說明：
+#   大量寫入時，HNSW 索引的逐筆維護會比資料本身慢很多；可以加上 --drop-vector-index，
+#   寫完再執行 finalize_database.py 重建索引 (建索引的時間本身也是規模測試要量的項目)。
+# 執行方式：
+#   python scale_catalog.py --target-rows 1000000 --jitter 0.3 --drop-vector-index
+#   python scale_catalog.py --remove
+# ---
+
+import argparse
+import io
+import os
+import struct
+import time
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+
+import embedding_store
+import result_cache
+import stats_maintenance
+
+load_dotenv()
+DB_SETTINGS = {
+    "host": os.environ.get("DB_HOST"),
+    "port": os.environ.get("DB_PORT"),
+    "user": os.environ.get("DB_USER"),
+    "password": os.environ.get("DB_PASSWORD"),
+    "database": os.environ.get("DB_NAME")
+}
+
+SYNTHETIC_PREFIX = "syn_"
+# 不用 LIKE 'syn_%'：底線在 LIKE 中是萬用字元
+SYNTHETIC_CONDITION = f"left(uniq_id, {len(SYNTHETIC_PREFIX)}) = '{SYNTHETIC_PREFIX}'"
+STAGING_TABLE = "products_scale_staging"
+EMBEDDING_DIM = 768
+BATCH_ROWS = 50000
+
+# 擾動向量的範數 (相對於單位向量)；0.3 時新向量與種子的餘弦相似度約 0.95
+DEFAULT_JITTER = 0.3
+
+
+# --- 1. 讀取種子資料與分佈 ---
+def load_seed_rows(conn, limit=None):
+    """讀取「真實」商品 (非合成) 的欄位與向量 (vector_send 二進位傳輸)。"""
+    select_sql = f"""
+        SELECT product_name, brand, sales_price, rating, amazon_prime_y_or_n, vector_send(embedding)
+        FROM products
+        WHERE embedding IS NOT NULL AND left(uniq_id, {len(SYNTHETIC_PREFIX)}) <> '{SYNTHETIC_PREFIX}'
+        {"LIMIT %s" if limit else ""};
+    """
+    attributes, vectors = [], []
+    for rows in embedding_store.iter_rows(conn, select_sql, (limit,) if limit else None,
+                                          cursor_name="scale_seed"):
+        for name, brand, price, rating, prime, vec_buf in rows:
+            attributes.append((name, brand, None if price is None else float(price),
+                               None if rating is None else float(rating), prime))
+            vectors.append(embedding_store.decode_vector(vec_buf))
+    return attributes, np.vstack(vectors) if vectors else np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+
+
+def jitter_embeddings(seeds, jitter, rng):
+    """種子向量 + 高斯擾動 (期望範數 = jitter)，再重新正規化成單位向量。"""
+    noise = rng.standard_normal(seeds.shape).astype(np.float32) * (jitter / np.sqrt(seeds.shape[1]))
+    vectors = seeds + noise
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+# --- 2. COPY BINARY ---
+_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_COPY_TRAILER = struct.pack("!h", -1)
+_NULL = struct.pack("!i", -1)
+
+
+def _text_field(value):
+    if value is None:
+        return _NULL
+    data = str(value).encode("utf-8")
+    return struct.pack("!i", len(data)) + data
+
+
+def _float8_field(value):
+    if value is None:
+        return _NULL
+    return struct.pack("!id", 8, value)
+
+
+def _vector_field(vec_be):
+    # pgvector 的二進位格式：int16 維度 + int16 保留 + big-endian float4 陣列
+    payload = struct.pack("!hh", len(vec_be), 0) + vec_be.tobytes()
+    return struct.pack("!i", len(payload)) + payload
+
+
+def build_copy_buffer(rows):
+    """rows: [(uniq_id, name, brand, price, rating, prime, embedding)] -> COPY BINARY 的內容。"""
+    buf = io.BytesIO()
+    buf.write(_COPY_HEADER)
+    field_count = struct.pack("!h", 7)
+    for uniq_id, name, brand, price, rating, prime, vec in rows:
+        buf.write(field_count)
+        buf.write(_text_field(uniq_id))
+        buf.write(_text_field(name))
+        buf.write(_text_field(brand))
+        buf.write(_float8_field(price))
+        buf.write(_float8_field(rating))
+        buf.write(_text_field(prime))
+        buf.write(_vector_field(vec.astype(">f4")))
+    buf.write(_COPY_TRAILER)
+    buf.seek(0)
+    return buf
+
+
+# --- 3. 產生與寫入 ---
+def sample_attributes(seed_attributes, seed_rows, mode, rng):
+    """
+    mode="marginal"：每個欄位各自從實際值中抽樣 (獨立)；mode="source"：沿用種子商品的欄位。
+    商品名稱一律沿用種子商品 (關鍵字篩選的測試需要真實的文字)。
+    """
+    n_seed = len(seed_attributes)
+    if mode == "source":
+        return [seed_attributes[i] for i in seed_rows]
+    picks = rng.integers(0, n_seed, size=(len(seed_rows), 4))
+    return [
+        (seed_attributes[seed][0],
+         seed_attributes[p_brand][1], seed_attributes[p_price][2],
+         seed_attributes[p_rating][3], seed_attributes[p_prime][4])
+        for seed, (p_brand, p_price, p_rating, p_prime) in zip(seed_rows, picks)
+    ]
+
+
+def existing_counts(cursor):
+    cursor.execute(f"SELECT COUNT(*), COUNT(*) FILTER (WHERE {SYNTHETIC_CONDITION}) FROM products;")
+    return cursor.fetchone()
+
+
+def scale_catalog(target_rows, jitter=DEFAULT_JITTER, mode="marginal", batch_rows=BATCH_ROWS,
+                  drop_vector_index=False, seed_limit=None, random_seed=0):
+    rng = np.random.default_rng(random_seed)
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_SETTINGS)
+        cursor = conn.cursor()
+
+        total, synthetic = existing_counts(cursor)
+        n_new = target_rows - total
+        if n_new <= 0:
+            print(f"products 已有 {total} 筆 (>= {target_rows})，不需要產生。")
+            return
+        conn.commit()
+
+        print(f"[Scale] 讀取種子資料...")
+        seed_attributes, seed_vectors = load_seed_rows(conn, seed_limit)
+        conn.commit()
+        if not seed_attributes:
+            print("[Scale] 找不到任何種子資料 (products 是空的？)")
+            return
+        print(f"[Scale] 種子 {len(seed_attributes)} 筆；將產生 {n_new} 筆合成資料 "
+              f"(jitter={jitter}, 欄位抽樣={mode})")
+
+        if drop_vector_index:
+            print("[Scale] 刪除 idx_embedding_hnsw (寫入完成後請執行 finalize_database.py 重建)...")
+            cursor.execute("DROP INDEX IF EXISTS idx_embedding_hnsw;")
+            conn.commit()
+
+        cursor.execute(f"""
+            CREATE UNLOGGED TABLE IF NOT EXISTS {STAGING_TABLE} (
+                uniq_id TEXT, product_name TEXT, brand TEXT,
+                sales_price FLOAT8, rating FLOAT8, amazon_prime_y_or_n TEXT,
+                embedding VECTOR({EMBEDDING_DIM})
+            );
+        """)
+        cursor.execute(f"TRUNCATE {STAGING_TABLE};")
+        conn.commit()
+
+        start = time.time()
+        written = 0
+        while written < n_new:
+            batch = min(batch_rows, n_new - written)
+            seed_rows = rng.integers(0, len(seed_attributes), size=batch)
+            vectors = jitter_embeddings(seed_vectors[seed_rows], jitter, rng)
+            attributes = sample_attributes(seed_attributes, seed_rows, mode, rng)
+            rows = [
+                (f"{SYNTHETIC_PREFIX}{synthetic + written + i:010d}", *attrs, vec)
+                for i, (attrs, vec) in enumerate(zip(attributes, vectors))
+            ]
+
+            cursor.copy_expert(f"COPY {STAGING_TABLE} FROM STDIN WITH (FORMAT BINARY);", build_copy_buffer(rows))
+            cursor.execute(f"""
+                INSERT INTO products (uniq_id, product_name, brand, sales_price, rating, amazon_prime_y_or_n, embedding)
+                SELECT uniq_id, product_name, brand, sales_price::numeric(10, 2), rating::numeric(3, 1),
+                       amazon_prime_y_or_n, embedding
+                FROM {STAGING_TABLE}
+                ON CONFLICT (uniq_id) DO NOTHING;
+            """)
+            cursor.execute(f"TRUNCATE {STAGING_TABLE};")
+            result_cache.bump_catalog_version(cursor) # 與寫入在同一個交易中
+            stats_maintenance.record_modified_rows(cursor, batch)
+            conn.commit()
+
+            written += batch
+            elapsed = time.time() - start
+            print(f"  進度：{written}/{n_new} 筆 ({written / elapsed:.0f} 筆/秒)")
+
+        cursor.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE};")
+        conn.commit()
+
+        print("[Scale] 執行 ANALYZE products...")
+        conn.autocommit = True
+        cursor.execute("ANALYZE products;")
+        stats_maintenance.mark_analyzed(cursor)
+        print(f"✅ 完成：寫入 {written} 筆，花費 {time.time() - start:.1f} 秒；products 共約 {total + written} 筆。")
+
+    except Exception as e:
+        print(f"❌ 錯誤: {e}")
+        if conn and not conn.autocommit:
+            conn.rollback()
+    finally:
+        if conn:
+            conn.close()
+
+
+def remove_synthetic():
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_SETTINGS)
+        cursor = conn.cursor()
+        cursor.execute(f"DELETE FROM products WHERE {SYNTHETIC_CONDITION};")
+        deleted = cursor.rowcount
+        result_cache.bump_catalog_version(cursor)
+        conn.commit()
+        conn.autocommit = True
+        cursor.execute("VACUUM ANALYZE products;")
+        stats_maintenance.mark_analyzed(cursor)
+        print(f"✅ 已刪除 {deleted} 筆合成資料。")
+    except Exception as e:
+        print(f"❌ 錯誤: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+
+# --- 主程式區塊 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="以擾動的既有向量把 products 放大到指定筆數")
+    parser.add_argument("--target-rows", type=int, help="products 的目標總筆數")
+    parser.add_argument("--jitter", type=float, default=DEFAULT_JITTER)
+    parser.add_argument("--attributes", choices=["marginal", "source"], default="marginal",
+                        help="marginal：各欄位獨立抽樣；source：沿用種子商品的欄位")
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS)
+    parser.add_argument("--seed-limit", type=int, default=None, help="最多使用幾筆種子資料")
+    parser.add_argument("--drop-vector-index", action="store_true", help="寫入前刪除 HNSW 索引")
+    parser.add_argument("--random-seed", type=int, default=0)
+    parser.add_argument("--remove", action="store_true", help="刪除所有合成資料")
+    args = parser.parse_args()
+
+    if args.remove:
+        remove_synthetic()
+    elif args.target_rows:
+        scale_catalog(args.target_rows, args.jitter, args.attributes, args.batch_rows,
+                      args.drop_vector_index, args.seed_limit, args.random_seed)
+    else:
+        parser.error("需要 --target-rows 或 --remove")
@@ -0,0 +1,357 @@
+# ---
+# 檔名：search_server.py
+# 目的：(Phase 5) 長駐的 HTTP 搜尋服務 (只用標準函式庫)
+# 功能：
+#   1. CLIP 模型在啟動時載入一次 (import query_parser)，之後每個請求都直接使用
+#   2. 資料庫連線池 (cbo_proxy.init_pool)，不再每個查詢都重新連線
+#   3. 每個連線一個執行緒 (閒置的 keep-alive 連線不佔 worker)，同時執行的搜尋數以 workers 為上限；
+#      連線數超過上限時直接回傳 503，不讓新連線無限排隊
+#   4. 設定 CBO_SHARDS (分片設定檔) 時改用 sharding.sharded_search 平行搜尋所有分片
+#   5. 收到 SIGTERM / SIGINT 時停止接受新請求，等進行中的請求處理完再關閉 (graceful shutdown)
+#   6. 加上 --warmup 時，開始接受請求前先預熱 (warmup.py：pg_prewarm、模型、連線池)
+# 端點：
+#   POST /search   {"catalog_id": "...", "text": "red color", "filter": "price < 500", "n": 20}
+#                  或以 "image_base64" 取代 "catalog_id" 上傳圖片
+#                  加上 "cursor" (第一頁為 null，之後填上一頁回傳的 next_cursor) 時以 keyset 分頁
+#                  "priority"："high" / "normal" (預設) / "low"；負載過高時依此排隊或捨棄，被捨棄時回傳 503 + Retry-After
+#   GET  /healthz  模型與資料庫都正常時回傳 200，否則 503
+#   GET  /stats    結果快取與准入控制統計
+#   GET  /metrics  各階段延遲直方圖 + 快取 / 准入控制佇列 gauge (Prometheus 文字格式，見 tracing.py)
+# 執行方式：
+#   python search_server.py --port 8080 --workers 16 [--max-connections 128] [--metrics-file /var/lib/node_exporter/search.prom] [--warmup]
+# ---
+
+import argparse
+import base64
+import decimal
+import io
+import json
+import logging
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+import admission_control
+import bitmap_index
+import cbo_proxy
+import query_parser
+import result_cache
+import sharding
+import tracing
+import warmup
+
+MAX_BODY_BYTES = 10 * 1024 * 1024   # 上傳圖片上限 10MB
+MAX_RESULTS = 200                   # 單次請求可要求的最大筆數
+CONNECTIONS_PER_WORKER = 8          # 同時保持的連線數上限 = workers * CONNECTIONS_PER_WORKER (預設)
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _json_default(value):
+    # sales_price / rating 是 NUMERIC，psycopg2 回傳 Decimal
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    raise TypeError(f"無法序列化的型別：{type(value)}")
+
+
+def handle_search(payload):
+    """
+    處理一個搜尋請求：組合查詢向量 -> 解析篩選 -> cbo_proxy.hybrid_search。
+    每個階段的耗時都記錄在 tracing 的直方圖中。
+    """
+    with tracing.trace():
+        return _handle_search(payload)
+
+
+def _handle_search(payload):
+    text = payload.get("text") or ""
+    filter_text = payload.get("filter") or ""
+    try:
+        limit_n = int(payload.get("n", cbo_proxy.N_RESULTS))
+    except (TypeError, ValueError):
+        raise BadRequest("n 必須是整數")
+    if not 1 <= limit_n <= MAX_RESULTS:
+        raise BadRequest(f"n 必須介於 1 與 {MAX_RESULTS} 之間")
+    priority_name = payload.get("priority") or "normal"
+    if priority_name not in admission_control.PRIORITIES:
+        raise BadRequest(f"priority 必須是 {', '.join(admission_control.PRIORITIES)} 之一")
+    priority = admission_control.PRIORITIES[priority_name]
+
+    if payload.get("catalog_id"):
+        v_img = cbo_proxy.get_product_embedding(payload["catalog_id"])
+        if v_img is None:
+            raise BadRequest(f"找不到商品 {payload['catalog_id']}")
+        v_query = query_parser.compose_query_vector(v_img, text)
+    elif payload.get("image_base64"):
+        try:
+            image = Image.open(io.BytesIO(base64.b64decode(payload["image_base64"])))
+            image.load()
+        except Exception as e:
+            raise BadRequest(f"無法解析上傳的圖片：{e}")
+        v_query = query_parser.get_query_vector_from_image(image, text)
+    else:
+        raise BadRequest("需要 catalog_id 或 image_base64")
+
+    if v_query is None:
+        raise RuntimeError("無法產生查詢向量")
+
+    # 篩選條件一律經過 query_parser 解析，不接受使用者直接送 SQL：
+    # 解析器只產生固定形式的條件，使用者提供的字串 (品牌、關鍵字) 都以 sql_string_literal 跳脫
+    sql_filter = query_parser.get_sql_filter(filter_text) if filter_text else "1 = 1"
+    if "cursor" in payload:
+        if sharding.get_config() is not None:
+            raise BadRequest("分片模式不支援分頁")
+        try:
+            page = cbo_proxy.search_page(v_query, sql_filter, limit_n=limit_n, cursor_token=payload["cursor"])
+        except ValueError as e:
+            raise BadRequest(str(e))
+        return {
+            "plan": page["plan"],
+            "cache_hit": False,
+            "filter": sql_filter,
+            "results": page["results"],
+            "next_cursor": page["next_cursor"],
+        }
+    if sharding.get_config() is not None:
+        outcome = sharding.sharded_search(v_query, sql_filter, limit_n=limit_n)
+    else:
+        outcome = cbo_proxy.hybrid_search(v_query, sql_filter, limit_n=limit_n, priority=priority)
+    return {
+        "plan": outcome["plan"],
+        "cache_hit": outcome["cache_hit"],
+        "filter": sql_filter,
+        "results": outcome["results"],
+    }
+
+
+def cache_gauges():
+    """把結果快取的統計輸出成 Prometheus gauge。"""
+    stats = result_cache.stats()
+    return {
+        "result_cache_hit_rate": stats["hit_rate"],
+        "result_cache_entries": stats["entries"],
+        "result_cache_hits": stats["hits"],
+        "result_cache_misses": stats["misses"],
+    }
+
+
+def service_gauges():
+    """/metrics 與指標檔輸出的所有 gauge：結果快取 + 准入控制 (佇列深度、執行中的成本...) + 預熱耗時。"""
+    gauges = cache_gauges()
+    gauges.update(admission_control.gauges())
+    gauges.update(warmup.gauges())
+    return gauges
+
+
+def check_health():
+    """回傳 (是否健康, 細節)。"""
+    details = {"model_loaded": query_parser.model is not None, "database": False}
+    try:
+        with cbo_proxy.db_connection(autocommit=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1;")
+            details["database"] = cursor.fetchone()[0] == 1
+    except Exception as e:
+        details["database_error"] = str(e)
+    return details["model_loaded"] and details["database"], details
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 讓客戶端可以重複使用 keep-alive 連線 (每個回應都必須帶 Content-Length)
+    protocol_version = "HTTP/1.1"
+    server_version = "HybridSearch/1.0"
+    access_log = False
+    # keep-alive 連線閒置超過這個秒數就關閉 (閒置連線只佔住自己的連線執行緒，不佔 worker 名額)
+    timeout = 5
+
+    def _end_headers(self):
+        # 服務關閉中：回應後關閉連線，不再等 keep-alive 的下一個請求
+        if self.server.shutting_down:
+            self.send_header("Connection", "close")
+        self.end_headers()
+
+    def _send_text(self, status, text, content_type="text/plain; version=0.0.4; charset=utf-8"):
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self._end_headers()
+        self.wfile.write(data)
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body, default=_json_default, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self._end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            healthy, details = check_health()
+            self._send_json(200 if healthy else 503, details)
+        elif self.path == "/stats":
+            self._send_json(200, {"result_cache": result_cache.stats(), "admission": admission_control.stats()})
+        elif self.path == "/metrics":
+            self._send_text(200, tracing.render_prometheus(service_gauges()))
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/search":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+        except ValueError:
+            length = -1
+        if length <= 0 or length > MAX_BODY_BYTES:
+            self._send_json(413 if length > MAX_BODY_BYTES else 400, {"error": "invalid Content-Length"})
+            return
+
+        try:
+            payload = json.loads(self.rfile.read(length))
+            if not isinstance(payload, dict):
+                raise BadRequest("請求內容必須是 JSON 物件")
+            # 只有實際搜尋時才佔用 worker 名額；名額用完時在這裡排隊 (排隊的連線數受 max_connections 限制)
+            with self.server.work_slots:
+                response = handle_search(payload)
+            self._send_json(200, response)
+        except (BadRequest, ValueError) as e:
+            self._send_json(400, {"error": str(e)})
+        except admission_control.Overloaded as e:
+            self._send_json(503, {"error": str(e), "plan": e.plan, "reason": e.reason},
+                            headers={"Retry-After": str(e.retry_after_s)})
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+
+    def log_message(self, format, *args):
+        if self.access_log:
+            super().log_message(format, *args)
+
+
+class PooledHTTPServer(ThreadingHTTPServer):
+    """
+    ThreadingHTTPServer 每個連線開一個執行緒：閒置的 keep-alive 連線只佔住自己的執行緒，
+    不會讓新連線排在閒置連線後面。同時執行的搜尋以 work_slots (workers 個名額) 限制，
+    讓對連線池 / CLIP 的壓力有上限；同時保持的連線超過 max_connections 時直接回傳 503 並關閉。
+    """
+    # 非 daemon 執行緒 + block_on_close：server_close() 會等所有進行中的請求完成
+    daemon_threads = False
+    block_on_close = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers, max_connections=None):
+        super().__init__(server_address, handler_class)
+        self.work_slots = threading.BoundedSemaphore(workers)
+        self.max_connections = max_connections or workers * CONNECTIONS_PER_WORKER
+        self.shutting_down = False
+        self._connections = 0
+        self._connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self._connections_lock:
+            full = self._connections >= self.max_connections
+            if not full:
+                self._connections += 1
+        if full:
+            self._reject(request)
+            return
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self._connections_lock:
+                self._connections -= 1
+
+    def _reject(self, request):
+        """連線數已滿：不讀請求，直接回傳 503 + Retry-After 後關閉連線 (在接受連線的執行緒上，不開新執行緒)。"""
+        body = json.dumps({"error": "too many connections", "reason": "connections"}).encode("utf-8")
+        head = ("HTTP/1.1 503 Service Unavailable\r\n"
+                "Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Retry-After: 1\r\n"
+                "Connection: close\r\n\r\n").encode("ascii")
+        try:
+            request.sendall(head + body)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+
+def serve(host, port, workers, pool_min, pool_max, access_log=False, metrics_file=None, warm=False,
+          max_connections=None):
+    if query_parser.model is None:
+        print("[Search Server] 致命錯誤：AI 模型未載入，無法啟動服務。")
+        return
+
+    cbo_proxy.init_pool(min(pool_min, pool_max), pool_max)
+    if cbo_proxy.ENABLE_BITMAP_INDEX:
+        # 啟動時就建好 bitmap 索引，第一個請求不必退回 EXPLAIN
+        print("[Search Server] 建立篩選欄位的 bitmap 索引...")
+        bitmap_index.get_index(result_cache.current_version(), cbo_proxy.db_connection, wait=True)
+    if sharding.get_config() is not None:
+        print(f"[Search Server] 分片模式：{len(sharding.get_config()['shards'])} 個分片 ({sharding.SHARDS_FILE})")
+        sharding.init_pools(maxconn=pool_max)
+    if warm:
+        # 連線池的每一條連線都先建立好，第一波請求不必等連線
+        warmup.run_warmup(pool_connections=pool_max)
+    SearchRequestHandler.access_log = access_log
+    if metrics_file:
+        tracing.start_metrics_writer(metrics_file, extra_gauges_fn=service_gauges)
+    server = PooledHTTPServer((host, port), SearchRequestHandler, workers, max_connections)
+
+    def _shutdown(signum, frame):
+        print(f"\n[Search Server] 收到信號 {signum}，停止接受新請求...")
+        server.shutting_down = True
+        # shutdown() 會等待 serve_forever 結束，必須在另一個執行緒呼叫
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, _shutdown)
+    signal.signal(signal.SIGINT, _shutdown)
+
+    print(f"[Search Server] 服務啟動於 http://{host}:{port} (workers={workers}, pool={pool_min}-{pool_max}, "
+          f"max_connections={server.max_connections})")
+    try:
+        server.serve_forever()
+    finally:
+        print("[Search Server] 等待進行中的請求完成...")
+        server.server_close()
+        tracing.stop_metrics_writer()
+        sharding.close_pools()
+        cbo_proxy.close_pool()
+        print("[Search Server] 已關閉。")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hybrid Search HTTP 服務")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=16, help="處理請求的 worker 執行緒數")
+    parser.add_argument("--pool-min", type=int, default=4, help="資料庫連線池最小連線數")
+    parser.add_argument("--pool-max", type=int, default=None,
+                        help="資料庫連線池最大連線數 (預設與 workers 相同)")
+    parser.add_argument("--max-connections", type=int, default=None,
+                        help=f"同時保持的連線數上限，超過時回傳 503 (預設 workers * {CONNECTIONS_PER_WORKER})")
+    parser.add_argument("--access-log", action="store_true", help="印出每個請求的存取紀錄")
+    parser.add_argument("--metrics-file", default=None,
+                        help="定期把 Prometheus 指標寫入此檔案 (textfile collector)")
+    parser.add_argument("--log-level", default="WARNING",
+                        help="logging 等級；INFO 會印出每個查詢的 CBO 決策過程 (高負載下不建議)")
+    parser.add_argument("--warmup", action="store_true",
+                        help="開始接受請求前先預熱 (pg_prewarm、模型、連線池)，避免部署 / failover 後的第一波慢查詢")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    serve(args.host, args.port, args.workers, args.pool_min,
+          args.pool_max or args.workers, access_log=args.access_log, metrics_file=args.metrics_file,
+          warm=args.warmup, max_connections=args.max_connections)
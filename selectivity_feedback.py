@@ -0,0 +1,234 @@
+# ---
+# 檔名：selectivity_feedback.py
+# 目的：(Phase 4 延伸) 以「執行回饋」修正 CBO 的篩選筆數預估
+# 背景：
+#   inspect_db_stats.py 顯示 Postgres 對價格區間的預估誤差很大；
+#   像 `product_name ILIKE '%black%' AND product_name ILIKE '%skirt%'` 或「品牌 + 價格」
+#   這類相關 (correlated) 條件，Postgres 會假設彼此獨立，把選擇率直接相乘，誤差更大。
+# 功能：
+#   1. 依「條件簽章」記錄 (EXPLAIN 預估筆數, 實際篩選筆數)，學出修正係數 (對數空間的指數平滑)
+#   2. get_cbo_estimate 以修正後的筆數做決策
+#   3. 可對相關欄位建立延伸統計 (CREATE STATISTICS)，從根本改善 Postgres 的預估
+# ---
+
+import argparse
+import json
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import psycopg2
+from psycopg2 import sql
+from dotenv import load_dotenv
+
+load_dotenv()
+DB_SETTINGS = {
+    "host": os.environ.get("DB_HOST"),
+    "port": os.environ.get("DB_PORT"),
+    "user": os.environ.get("DB_USER"),
+    "password": os.environ.get("DB_PASSWORD"),
+    "database": os.environ.get("DB_NAME")
+}
+
+# --- 1. 設定 ---
+FEEDBACK_FILE = os.environ.get("CBO_SELECTIVITY_FEEDBACK_FILE", "selectivity_feedback.json")
+
+ALPHA = 0.3                 # 指數平滑權重：新觀測佔 30%
+MIN_OBSERVATIONS = 3        # 至少觀測幾次才套用修正
+MAX_CORRECTION = 1000.0     # 修正倍率上限 (雙向)
+SAVE_EVERY = 20             # 每累積幾筆新觀測寫一次檔
+MAX_PENDING_ESTIMATES = 1024
+
+# 預設建立延伸統計的相關欄位組合
+DEFAULT_STATISTICS_COLUMNS = [
+    ("brand", "sales_price"),
+    ("brand", "rating"),
+    ("brand", "amazon_prime_y_or_n"),
+]
+
+# --- 2. 模組狀態 ---
+_lock = threading.Lock()
+_corrections = None                   # {簽章: {"log_ratio": float, "count": int}}
+_pending_estimates = OrderedDict()    # {篩選字串: Postgres 原始預估筆數}
+_unsaved = 0
+
+_NUMBER_RE = re.compile(r"(?<![\w.])-?\d+(\.\d+)?")
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+
+
+def exact_signature(sql_filter_string):
+    """完整條件 (大小寫與空白正規化)，例如 ILIKE 的關鍵字會保留下來。"""
+    return " ".join(sql_filter_string.lower().split())
+
+
+def template_signature(sql_filter_string):
+    """
+    條件「樣板」：把常數換成 ?，例如
+    "sales_price BETWEEN 260 AND 1300 AND brand = 'Nike'" -> "sales_price between ? and ? and brand = ?"
+    讓同一種形狀的條件共用修正係數。
+    """
+    text = _STRING_RE.sub("?", exact_signature(sql_filter_string))
+    return _NUMBER_RE.sub("?", text)
+
+
+def _load():
+    global _corrections
+    if _corrections is not None:
+        return
+    _corrections = {}
+    if os.path.exists(FEEDBACK_FILE):
+        try:
+            with open(FEEDBACK_FILE, "r", encoding="utf-8") as f:
+                _corrections = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[Selectivity Feedback] 無法讀取 {FEEDBACK_FILE}：{e}")
+
+
+def save():
+    """原子性地寫入修正係數檔。"""
+    global _unsaved
+    with _lock:
+        _load()
+        snapshot = dict(_corrections)
+        _unsaved = 0
+    tmp_path = FEEDBACK_FILE + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, FEEDBACK_FILE)
+    except OSError as e:
+        print(f"[Selectivity Feedback] 無法寫入 {FEEDBACK_FILE}：{e}")
+
+
+def get_correction(sql_filter_string):
+    """
+    回傳 (修正倍率, 使用的簽章)。先找完整條件，再退回樣板；都沒有足夠觀測時倍率為 1.0。
+    """
+    with _lock:
+        _load()
+        for signature in (exact_signature(sql_filter_string), template_signature(sql_filter_string)):
+            entry = _corrections.get(signature)
+            if entry and entry["count"] >= MIN_OBSERVATIONS:
+                return math.exp(entry["log_ratio"]), signature
+    return 1.0, None
+
+
+def correct_estimate(sql_filter_string, estimated_rows):
+    """
+    以學到的修正倍率調整 Postgres 的預估筆數，並記住原始預估，
+    以便計畫執行後與實際筆數比對 (見 record_actual)。
+    """
+    with _lock:
+        _pending_estimates[sql_filter_string] = estimated_rows
+        _pending_estimates.move_to_end(sql_filter_string)
+        while len(_pending_estimates) > MAX_PENDING_ESTIMATES:
+            _pending_estimates.popitem(last=False)
+
+    factor, _ = get_correction(sql_filter_string)
+    return estimated_rows * factor
+
+
+def record(sql_filter_string, estimated_rows, actual_rows):
+    """記錄一筆 (預估, 實際)，同時更新完整條件與樣板兩個簽章的修正係數。"""
+    global _unsaved
+    log_ratio = math.log((actual_rows + 1.0) / (estimated_rows + 1.0))
+    bound = math.log(MAX_CORRECTION)
+    log_ratio = max(-bound, min(bound, log_ratio))
+
+    with _lock:
+        _load()
+        for signature in {exact_signature(sql_filter_string), template_signature(sql_filter_string)}:
+            entry = _corrections.get(signature)
+            if entry is None:
+                _corrections[signature] = {"log_ratio": log_ratio, "count": 1}
+            else:
+                entry["log_ratio"] = (1 - ALPHA) * entry["log_ratio"] + ALPHA * log_ratio
+                entry["count"] += 1
+        _unsaved += 1
+        should_save = _unsaved >= SAVE_EVERY
+
+    if should_save:
+        save()
+
+
+def record_actual(sql_filter_string, actual_rows):
+    """
+    計畫執行後回報實際篩選筆數；若這個條件最近有經過 CBO 預估，就記錄一筆回饋。
+    """
+    with _lock:
+        estimated_rows = _pending_estimates.pop(sql_filter_string, None)
+    if estimated_rows is not None:
+        record(sql_filter_string, estimated_rows, actual_rows)
+
+
+def reset():
+    """清除所有修正係數 (例如 ANALYZE 之後，舊的修正已不再適用)。"""
+    global _corrections
+    with _lock:
+        _corrections = {}
+        _pending_estimates.clear()
+    save()
+
+
+# --- 3. 延伸統計 (Extended Statistics) ---
+def create_extended_statistics(cursor, columns, kinds=("ndistinct", "dependencies", "mcv")):
+    """
+    在 products 的相關欄位上建立延伸統計，讓 Postgres 不再假設欄位彼此獨立。
+    建立後需要 ANALYZE 才會生效 (由呼叫端負責)。
+    """
+    stats_name = "stx_products_" + "_".join(columns)
+    query = sql.SQL("CREATE STATISTICS IF NOT EXISTS {name} ({kinds}) ON {columns} FROM products;").format(
+        name=sql.Identifier(stats_name),
+        kinds=sql.SQL(", ").join(sql.SQL(kind) for kind in kinds),
+        columns=sql.SQL(", ").join(sql.Identifier(col) for col in columns),
+    )
+    cursor.execute(query)
+    return stats_name
+
+
+def create_default_statistics(column_groups=DEFAULT_STATISTICS_COLUMNS):
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_SETTINGS)
+        conn.autocommit = True
+        cursor = conn.cursor()
+        for columns in column_groups:
+            name = create_extended_statistics(cursor, columns)
+            print(f"  已建立延伸統計：{name} ON ({', '.join(columns)})")
+        print("正在執行 ANALYZE products (讓延伸統計生效)...")
+        cursor.execute("ANALYZE products;")
+        print("完成。")
+    except Exception as e:
+        print(f"建立延伸統計時發生錯誤：{e}")
+    finally:
+        if conn:
+            conn.close()
+
+
+def print_report(top_n=20):
+    """列出誤差最大的條件簽章。"""
+    with _lock:
+        _load()
+        entries = sorted(_corrections.items(), key=lambda kv: -abs(kv[1]["log_ratio"]))
+    print(f"{'修正倍率':>10} | {'觀測數':>6} | 條件簽章")
+    print("-" * 70)
+    for signature, entry in entries[:top_n]:
+        print(f"{math.exp(entry['log_ratio']):>10.3f} | {entry['count']:>6} | {signature}")
+
+
+# --- 主程式區塊 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CBO 選擇率回饋修正工具")
+    parser.add_argument("--create-stats", action="store_true",
+                        help="在預設的相關欄位組合上建立延伸統計 (CREATE STATISTICS) 並 ANALYZE")
+    parser.add_argument("--reset", action="store_true", help="清除所有學到的修正係數")
+    args = parser.parse_args()
+
+    if args.create_stats:
+        create_default_statistics()
+    if args.reset:
+        reset()
+        print("已清除所有修正係數。")
+    print_report()
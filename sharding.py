@@ -0,0 +1,445 @@
+# ---
+# 檔名：sharding.py
+# 目的：(Phase 6) 把 products 分散到多個 Postgres (或同一個資料庫的多個 schema)，平行搜尋後合併 Top-N
+# 功能：
+#   1. 分片設定檔 (JSON)：每個分片一組連線設定 (未寫的欄位沿用 .env 的 DB_SETTINGS)，
+#      以 "schema" 指定 schema 時以 options=-c search_path 連線，程式中的 SQL 不需要修改
+#   2. 分片方式：
+#        hash  ：md5(uniq_id) 取前 8 個 hex 對分片數取餘數 (Python 與 SQL 算出相同結果)
+#        range ：依 sales_price 的區間 [lo, hi)；NULL 放在第一個分片。
+#                篩選條件帶價格範圍時，區間不重疊的分片直接略過 (shard pruning)
+#   3. setup：在每個分片建立 products (含 B-Tree 索引、catalog_version)，從主資料庫以 COPY BINARY 搬入
+#      屬於該分片的資料，再各自建立 HNSW 索引並 ANALYZE
+#   4. sharded_search：以執行緒池對每個分片「各自」做 CBO 決策 (以該分片的 EXPLAIN 預估與總筆數)
+#      並執行計畫 A / B，最後以 heap 合併各分片的 Top-N
+# 說明：
+#   每個分片都必須回傳完整的 Top-N (而不是 N / 分片數)，合併後的結果才會與單一資料表相同。
+#   分片模式下 bitmap / NumPy / IVF 等程序內結構不使用 (見 cbo_proxy.use_shard)。
+# 執行方式：
+#   python sharding.py init-schemas --shards 4 --strategy hash     (產生同一資料庫 4 個 schema 的設定檔)
+#   python sharding.py setup                                        (建立分片並搬入資料)
+#   python sharding.py status
+#   CBO_SHARDS=shards.json python search_server.py                  (服務改用分片搜尋)
+# ---
+
+import argparse
+import contextvars
+import hashlib
+import heapq
+import json
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2 import sql
+from dotenv import load_dotenv
+
+import cbo_proxy
+import embedding_store
+import finalize_database
+import result_cache
+import stats_maintenance
+import tracing
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+DB_SETTINGS = {
+    "host": os.environ.get("DB_HOST"),
+    "port": os.environ.get("DB_PORT"),
+    "user": os.environ.get("DB_USER"),
+    "password": os.environ.get("DB_PASSWORD"),
+    "database": os.environ.get("DB_NAME")
+}
+
+# 分片設定檔；沒有設定時不啟用分片
+SHARDS_FILE = os.environ.get("CBO_SHARDS", "")
+DEFAULT_SHARDS_FILE = "shards.json"
+EMBEDDING_DIM = 768
+COLUMNS = ("uniq_id", "product_name", "brand", "sales_price", "rating", "amazon_prime_y_or_n", "embedding")
+CONNECTION_KEYS = ("host", "port", "user", "password", "database")
+
+
+# --- 1. 分片設定 ---
+def shard_settings(entry):
+    """設定檔中的一個分片 -> psycopg2.connect 的參數。"""
+    settings = {key: entry.get(key, DB_SETTINGS[key]) for key in CONNECTION_KEYS}
+    if entry.get("schema"):
+        # public 放在後面：vector 型別與運算子在 public
+        settings["options"] = f"-c search_path={entry['schema']},public"
+    return settings
+
+
+def load_config(path=None):
+    """
+    讀取分片設定檔，回傳 {"strategy": ..., "shards": [{"name", "settings", "schema", "bounds"}]}。
+    """
+    with open(path or SHARDS_FILE or DEFAULT_SHARDS_FILE, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    strategy = config.get("strategy", "hash")
+    if strategy not in ("hash", "range"):
+        raise ValueError(f"不支援的分片方式：{strategy}")
+    shards = []
+    for i, entry in enumerate(config["shards"]):
+        shards.append({
+            "name": entry.get("name", f"shard_{i}"),
+            "settings": shard_settings(entry),
+            "schema": entry.get("schema"),
+            "bounds": tuple(entry["bounds"]) if strategy == "range" else None,
+        })
+    if not shards:
+        raise ValueError("分片設定檔中沒有任何分片")
+    return {"strategy": strategy, "shards": shards}
+
+
+def price_boundaries(n_shards):
+    """從主資料庫的 sales_price 分位數切出 n_shards 個等筆數的區間 (range 分片用)。"""
+    conn = psycopg2.connect(**DB_SETTINGS)
+    try:
+        cursor = conn.cursor()
+        fractions = [i / n_shards for i in range(1, n_shards)]
+        cursor.execute("""
+            SELECT percentile_cont(%s::float8[]) WITHIN GROUP (ORDER BY sales_price)
+            FROM products WHERE sales_price IS NOT NULL;
+        """, (fractions,))
+        cuts = [round(float(v), 2) for v in (cursor.fetchone()[0] or [])]
+    finally:
+        conn.close()
+    edges = [None] + cuts + [None]
+    return [[edges[i], edges[i + 1]] for i in range(n_shards)]
+
+
+def write_schema_config(n_shards, strategy="hash", path=DEFAULT_SHARDS_FILE, prefix="shard_"):
+    """產生「同一個資料庫、n 個 schema」的設定檔 (單機測試用)。多台 Postgres 請直接編輯設定檔的連線欄位。"""
+    bounds = price_boundaries(n_shards) if strategy == "range" else [None] * n_shards
+    shards = []
+    for i in range(n_shards):
+        entry = {"name": f"{prefix}{i}", "schema": f"{prefix}{i}"}
+        if strategy == "range":
+            entry["bounds"] = bounds[i]
+        shards.append(entry)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"strategy": strategy, "shards": shards}, f, ensure_ascii=False, indent=2)
+    print(f"已寫入 {path}：{n_shards} 個分片 ({strategy})")
+    for entry in shards:
+        print(f"  {entry['name']}: schema={entry['schema']}" + (f", 價格區間={entry['bounds']}" if strategy == "range" else ""))
+
+
+# --- 2. 路由 ---
+def shard_for(config, uniq_id, sales_price=None):
+    """回傳一筆資料所屬的分片 (寫入新資料時使用)。"""
+    shards = config["shards"]
+    if config["strategy"] == "hash":
+        return shards[int(hashlib.md5(uniq_id.encode("utf-8")).hexdigest()[:8], 16) % len(shards)]
+    if sales_price is None:
+        return shards[0]
+    for shard in shards:
+        lo, hi = shard["bounds"]
+        if (lo is None or sales_price >= lo) and (hi is None or sales_price < hi):
+            return shard
+    return shards[-1]
+
+
+def shard_condition(config, index):
+    """第 index 個分片在主資料庫上的 WHERE 條件 (與 shard_for 一致)。"""
+    shard = config["shards"][index]
+    if config["strategy"] == "hash":
+        return sql.SQL("('x' || substr(md5(uniq_id), 1, 8))::bit(32)::bigint % {} = {}").format(
+            sql.Literal(len(config["shards"])), sql.Literal(index))
+    lo, hi = shard["bounds"]
+    parts = []
+    if lo is not None:
+        parts.append(sql.SQL("sales_price >= {}").format(sql.Literal(lo)))
+    if hi is not None:
+        parts.append(sql.SQL("sales_price < {}").format(sql.Literal(hi)))
+    condition = sql.SQL(" AND ").join(parts) if parts else sql.SQL("TRUE")
+    if index == 0:
+        condition = sql.SQL("({}) OR sales_price IS NULL").format(condition)
+    return condition
+
+
+def _price_interval(predicates):
+    """把篩選條件中的 sales_price 條件收斂成一個區間 (lo, hi)；無法收斂時回傳 (None, None)。"""
+    lo, hi = None, None
+    for column, op, value in predicates:
+        if column != "sales_price":
+            continue
+        if op == "between":
+            op_lo, op_hi = value
+        elif op in (">", ">="):
+            op_lo, op_hi = value, None
+        elif op in ("<", "<="):
+            op_lo, op_hi = None, value
+        elif op == "=":
+            op_lo, op_hi = value, value
+        else:
+            continue
+        if op_lo is not None:
+            lo = op_lo if lo is None else max(lo, op_lo)
+        if op_hi is not None:
+            hi = op_hi if hi is None else min(hi, op_hi)
+    return lo, hi
+
+
+def prune_shards(config, sql_filter_string):
+    """range 分片：略過價格區間與篩選條件不重疊的分片 (區間端點保守地視為重疊)。"""
+    shards = config["shards"]
+    if config["strategy"] != "range":
+        return shards
+    predicates = embedding_store.parse_sql_filter(sql_filter_string)
+    if not predicates:
+        return shards
+    f_lo, f_hi = _price_interval(predicates)
+    if f_lo is None and f_hi is None:
+        return shards
+    selected = []
+    for shard in shards:
+        lo, hi = shard["bounds"]
+        if f_hi is not None and lo is not None and f_hi < lo:
+            continue
+        if f_lo is not None and hi is not None and f_lo >= hi:
+            continue
+        selected.append(shard)
+    return selected
+
+
+# --- 3. 建立分片並搬入資料 ---
+def _shard_relation(shard, name):
+    """
+    分片內的關聯名稱。search_path 是「分片 schema, public」，不加 schema 的名稱在分片還沒有這個關聯時
+    會落到 public (例如 DROP INDEX idx_embedding_hnsw 會刪掉主資料庫的索引)，所以一律加上分片的 schema。
+    """
+    if shard["schema"]:
+        return sql.Identifier(shard["schema"], name)
+    return sql.Identifier(name)
+
+
+def _create_shard_schema(cursor, shard):
+    if shard["schema"]:
+        cursor.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {};").format(sql.Identifier(shard["schema"])))
+    # 與 create_table.py 相同的結構 (search_path 已指向分片的 schema)
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS vector SCHEMA public;")
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS products (
+            uniq_id VARCHAR(255) PRIMARY KEY,
+            product_name TEXT,
+            brand VARCHAR(255),
+            sales_price NUMERIC(10, 2),
+            rating NUMERIC(3, 1),
+            amazon_prime_y_or_n CHAR(1),
+            embedding VECTOR({EMBEDDING_DIM})
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_brand ON products USING btree(brand);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_price ON products USING btree(sales_price);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_rating ON products USING btree(rating);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_amazon_prime ON products USING btree(amazon_prime_y_or_n);")
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public;")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_name_trgm ON products USING gin(product_name gin_trgm_ops);")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            table_name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            rows_since_analyze BIGINT NOT NULL DEFAULT 0,
+            stats_version BIGINT NOT NULL DEFAULT 0,
+            analyzed_at TIMESTAMPTZ
+        );
+    """)
+    stats_maintenance.ensure_columns(cursor) # 舊版建立的分片補上統計欄位
+    stats_maintenance.apply_statistics_targets(cursor)
+
+
+def setup_shards(config, truncate=False):
+    """
+    建立每個分片的資料表，從主資料庫搬入資料 (COPY BINARY，經由暫存檔，所以分片可以在另一台 Postgres)，
+    最後建立 HNSW 索引並 ANALYZE。搬入時先不建 HNSW 索引，比逐筆維護索引快很多。
+    """
+    column_list = sql.SQL(", ").join(sql.Identifier(c) for c in COLUMNS)
+    source = None
+    try:
+        source = psycopg2.connect(**DB_SETTINGS)
+        source_cursor = source.cursor()
+        for i, shard in enumerate(config["shards"]):
+            print(f"\n[Shard] {shard['name']}：建立資料表...")
+            conn = psycopg2.connect(**shard["settings"])
+            try:
+                conn.autocommit = True
+                cursor = conn.cursor()
+                _create_shard_schema(cursor, shard)
+                if truncate:
+                    cursor.execute(sql.SQL("TRUNCATE {};").format(_shard_relation(shard, "products")))
+                cursor.execute(sql.SQL("DROP INDEX IF EXISTS {};").format(
+                    _shard_relation(shard, "idx_embedding_hnsw")))
+
+                start = time.time()
+                copy_out = sql.SQL("COPY (SELECT {} FROM public.products WHERE {}) TO STDOUT WITH (FORMAT BINARY);").format(
+                    column_list, shard_condition(config, i))
+                copy_in = sql.SQL("COPY products ({}) FROM STDIN WITH (FORMAT BINARY);").format(column_list)
+                with tempfile.TemporaryFile() as buf:
+                    source_cursor.copy_expert(copy_out.as_string(source), buf)
+                    source.commit()
+                    buf.seek(0)
+                    conn.autocommit = False
+                    cursor.copy_expert(copy_in.as_string(conn), buf)
+                    n_rows = cursor.rowcount
+                    result_cache.bump_catalog_version(cursor)
+                    conn.commit()
+                    conn.autocommit = True
+                print(f"[Shard] {shard['name']}：搬入 {n_rows} 筆 ({time.time() - start:.1f} 秒)")
+
+                print(f"[Shard] {shard['name']}：建立 HNSW 索引 (m={finalize_database.HNSW_M}, "
+                      f"ef_construction={finalize_database.HNSW_EF_CONSTRUCTION})...")
+                start = time.time()
+                cursor.execute(f"""
+                    CREATE INDEX IF NOT EXISTS idx_embedding_hnsw
+                    ON products USING HNSW (embedding vector_cosine_ops)
+                    WITH (m = {finalize_database.HNSW_M}, ef_construction = {finalize_database.HNSW_EF_CONSTRUCTION});
+                """)
+                cursor.execute("ANALYZE products;")
+                stats_maintenance.mark_analyzed(cursor)
+                print(f"[Shard] {shard['name']}：索引與 ANALYZE 完成 ({time.time() - start:.1f} 秒)")
+            finally:
+                conn.close()
+        print("\n✅ 所有分片建立完成。")
+    except Exception as e:
+        print(f"❌ 錯誤: {e}")
+    finally:
+        if source:
+            source.close()
+
+
+def print_status(config):
+    print(f"分片方式：{config['strategy']}")
+    for shard in config["shards"]:
+        try:
+            conn = psycopg2.connect(**shard["settings"])
+            try:
+                cursor = conn.cursor()
+                # 以「建在這張 products 上的索引」判斷，不用 to_regclass (會依 search_path 落到 public 的索引)
+                cursor.execute("""
+                    SELECT reltuples::bigint, pg_size_pretty(pg_total_relation_size(oid)),
+                           EXISTS (SELECT 1 FROM pg_index i JOIN pg_class ic ON ic.oid = i.indexrelid
+                                   WHERE i.indrelid = 'products'::regclass AND ic.relname = 'idx_embedding_hnsw')
+                    FROM pg_class WHERE oid = 'products'::regclass;
+                """)
+                rows, size, has_hnsw = cursor.fetchone()
+            finally:
+                conn.close()
+            extra = f", 價格區間={list(shard['bounds'])}" if shard["bounds"] else ""
+            print(f"  {shard['name']}: ≈{rows} 筆, {size}, HNSW={'有' if has_hnsw else '無'}{extra}")
+        except psycopg2.Error as e:
+            print(f"  {shard['name']}: 無法連線 ({e})")
+
+
+# --- 4. 平行搜尋與合併 ---
+_config = None
+_executor = None
+
+
+def get_config():
+    """回傳分片設定 (第一次使用時載入)；沒有設定 CBO_SHARDS 時回傳 None。"""
+    global _config
+    if _config is None and SHARDS_FILE:
+        _config = load_config(SHARDS_FILE)
+    return _config
+
+
+def init_pools(config=None, minconn=1, maxconn=10):
+    """長駐服務用：每個分片一個連線池，並建立 fan-out 用的執行緒池。"""
+    global _executor
+    config = config or get_config()
+    for shard in config["shards"]:
+        cbo_proxy.init_shard_pool(shard["name"], shard["settings"], minconn, maxconn)
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=len(config["shards"]) * maxconn,
+                                       thread_name_prefix="shard-search")
+
+
+def close_pools():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+    cbo_proxy.close_shard_pools()
+
+
+def _search_shard(shard, v_query, sql_filter_string, limit_n):
+    """在單一分片上：以該分片自己的統計資料做 CBO 決策並執行。"""
+    with cbo_proxy.use_shard(shard["name"], shard["settings"]):
+        start = time.perf_counter()
+        estimate = cbo_proxy.get_cbo_estimate(sql_filter_string, limit_n)
+        results = cbo_proxy.execute_plan(estimate, sql_filter_string, v_query, limit_n)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+    return estimate, results, elapsed_ms
+
+
+def sharded_search(v_query, sql_filter_string, limit_n=cbo_proxy.N_RESULTS, config=None):
+    """
+    對所有 (未被略過的) 分片平行搜尋，合併成全域 Top-N。
+    回傳格式與 cbo_proxy.hybrid_search 相同，另外附上每個分片的決策 ("shards")。
+    """
+    config = config or get_config()
+    targets = prune_shards(config, sql_filter_string)
+    tracing.set_plan("SHARDED")
+    logger.info("分片搜尋：%s / %s 個分片", len(targets), len(config["shards"]))
+
+    executor = _executor or ThreadPoolExecutor(max_workers=max(1, len(targets)))
+    try:
+        with tracing.stage("shard_fanout"):
+            # 每個工作複製目前的 context，追蹤資料 (tracing) 才會記在同一個請求上
+            futures = [
+                (shard, executor.submit(contextvars.copy_context().run, _search_shard,
+                                        shard, v_query, sql_filter_string, limit_n))
+                for shard in targets
+            ]
+            per_shard = {}
+            candidates = []
+            for shard, future in futures:
+                try:
+                    estimate, results, elapsed_ms = future.result()
+                except Exception as e:
+                    logger.error("分片 %s 搜尋失敗：%s", shard["name"], e)
+                    per_shard[shard["name"]] = {"plan": None, "error": str(e)}
+                    continue
+                per_shard[shard["name"]] = {"plan": estimate["plan"], "n_filtered": estimate["n_filtered"],
+                                            "returned": len(results), "elapsed_ms": elapsed_ms}
+                for row in results:
+                    row["shard"] = shard["name"]
+                    candidates.append(row)
+    finally:
+        if executor is not _executor:
+            executor.shutdown(wait=False)
+
+    with tracing.stage("shard_merge"):
+        merged = heapq.nsmallest(limit_n, candidates, key=lambda row: row["similarity_score"])
+    return {"plan": "SHARDED", "results": merged, "cache_hit": False, "shards": per_shard}
+
+
+# --- 主程式區塊 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="products 分片：設定、搬移資料與狀態")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_init = sub.add_parser("init-schemas", help="產生同一資料庫多個 schema 的分片設定檔")
+    p_init.add_argument("--shards", type=int, default=4)
+    p_init.add_argument("--strategy", choices=["hash", "range"], default="hash")
+    p_init.add_argument("--out", default=DEFAULT_SHARDS_FILE)
+
+    p_setup = sub.add_parser("setup", help="建立分片資料表並從主資料庫搬入資料")
+    p_setup.add_argument("--config", default=None)
+    p_setup.add_argument("--truncate", action="store_true", help="搬入前先清空分片中的資料")
+
+    p_status = sub.add_parser("status", help="顯示每個分片的筆數與大小")
+    p_status.add_argument("--config", default=None)
+    args = parser.parse_args()
+
+    if args.command == "init-schemas":
+        write_schema_config(args.shards, args.strategy, args.out)
+    elif args.command == "setup":
+        setup_shards(load_config(args.config), truncate=args.truncate)
+    else:
+        print_status(load_config(args.config))
@@ -0,0 +1,253 @@
+# ---
+# 檔名：stats_maintenance.py
+# 目的：(Phase 6) 依資料變動量自動 ANALYZE，讓 CBO 使用的 pg_stats / EXPLAIN 預估不會隨匯入逐漸過期
+# 功能：
+#   1. catalog_version 表新增 rows_since_analyze (上次 ANALYZE 之後變動的資料列數) 與
+#      stats_version (每次 ANALYZE 遞增) 兩個欄位
+#   2. 匯入程式在寫入的同一個交易中呼叫 record_modified_rows() 累加變動筆數；
+#      commit 之後呼叫 maybe_analyze()：變動筆數超過
+#      ANALYZE_BASE_THRESHOLD + ANALYZE_SCALE_FACTOR × 總筆數 (與 autovacuum 相同的公式) 時，
+#      只對篩選欄位執行 ANALYZE，並遞增 stats_version
+#   3. sales_price / brand 的統計目標 (SET STATISTICS) 可設定：值越大，直方圖 / 常見值清單越細，
+#      窄價格區間與冷門品牌的預估越準 (ANALYZE 也越久)
+#   4. cbo_proxy 發現 stats_version 改變時，清掉總筆數快取與選擇率回饋 (那些修正是針對舊統計學的)
+# 說明：
+#   autovacuum 也會自動 ANALYZE，但門檻是「表格的 10%」：1000 萬筆的目錄要變動 100 萬筆才會更新，
+#   這期間新品牌、新價格區間的預估都是錯的。
+# 執行方式：
+#   python stats_maintenance.py init       (既有資料庫：新增欄位並設定統計目標)
+#   python stats_maintenance.py status
+#   python stats_maintenance.py analyze    (不論變動量，立即 ANALYZE)
+# ---
+
+import argparse
+import logging
+import os
+import time
+
+import psycopg2
+from psycopg2 import sql
+from dotenv import load_dotenv
+
+import result_cache
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+DB_SETTINGS = {
+    "host": os.environ.get("DB_HOST"),
+    "port": os.environ.get("DB_PORT"),
+    "user": os.environ.get("DB_USER"),
+    "password": os.environ.get("DB_PASSWORD"),
+    "database": os.environ.get("DB_NAME")
+}
+
+# --- 1. 設定 ---
+# 變動筆數 > ANALYZE_BASE_THRESHOLD + ANALYZE_SCALE_FACTOR × 總筆數 時執行 ANALYZE
+ANALYZE_BASE_THRESHOLD = int(os.environ.get("CBO_ANALYZE_THRESHOLD", "1000"))
+ANALYZE_SCALE_FACTOR = float(os.environ.get("CBO_ANALYZE_SCALE_FACTOR", "0.02"))
+
+# CBO 篩選會用到的欄位 (product_name 的統計供 ILIKE 關鍵字條件使用)
+FILTER_COLUMNS = ("brand", "sales_price", "rating", "amazon_prime_y_or_n", "product_name")
+
+# 各欄位的統計目標 (Postgres 預設 default_statistics_target = 100，上限 10000)
+STATISTICS_TARGETS = {
+    "sales_price": int(os.environ.get("CBO_STATS_TARGET_SALES_PRICE", "1000")),
+    "brand": int(os.environ.get("CBO_STATS_TARGET_BRAND", "1000")),
+}
+
+
+# 這個程序已確認 catalog_version 有統計欄位 (寫入路徑第一次使用時才檢查，不必先執行 init)
+_columns_ready = False
+
+
+# --- 2. 結構與統計目標 ---
+def ensure_columns(cursor, table_name=result_cache.CATALOG_TABLE):
+    """為既有的 catalog_version 表補上 rows_since_analyze / stats_version 欄位 (可重複執行，表不存在時一併建立)。"""
+    global _columns_ready
+    result_cache.ensure_catalog_table(cursor)
+    cursor.execute("""
+        ALTER TABLE catalog_version
+            ADD COLUMN IF NOT EXISTS rows_since_analyze BIGINT NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS stats_version BIGINT NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS analyzed_at TIMESTAMPTZ;
+    """)
+    cursor.execute("""
+        INSERT INTO catalog_version (table_name, version) VALUES (%s, 0)
+        ON CONFLICT (table_name) DO NOTHING;
+    """, (table_name,))
+    _columns_ready = True
+
+
+def _ensure_columns_once(cursor, table_name):
+    """
+    在這個功能之前建立的資料庫沒有統計欄位，寫入路徑的 UPDATE 會失敗並讓整個匯入交易中止；
+    每個程序第一次使用時補上欄位 (ALTER TABLE 會短暫鎖住 catalog_version，所以只做一次)。
+    """
+    if not _columns_ready:
+        ensure_columns(cursor, table_name)
+
+
+def apply_statistics_targets(cursor, targets=STATISTICS_TARGETS):
+    """ALTER TABLE ... SET STATISTICS；下一次 ANALYZE 才會依新的目標取樣。"""
+    for column, target in targets.items():
+        cursor.execute(sql.SQL("ALTER TABLE products ALTER COLUMN {col} SET STATISTICS {target};").format(
+            col=sql.Identifier(column), target=sql.Literal(target)
+        ))
+
+
+# --- 3. 變動筆數 ---
+def record_modified_rows(cursor, n_rows, table_name=result_cache.CATALOG_TABLE):
+    """
+    累加上次 ANALYZE 之後的變動筆數。由寫入 products 的程式在「同一個交易」中呼叫
+    (與 result_cache.bump_catalog_version 相同)，寫入失敗 rollback 時計數也一起還原。
+    """
+    if n_rows <= 0:
+        return
+    _ensure_columns_once(cursor, table_name)
+    cursor.execute("""
+        UPDATE catalog_version SET rows_since_analyze = rows_since_analyze + %s
+        WHERE table_name = %s;
+    """, (n_rows, table_name))
+
+
+def get_stats_version(cursor, table_name=result_cache.CATALOG_TABLE):
+    cursor.execute("SELECT stats_version FROM catalog_version WHERE table_name = %s;", (table_name,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def analyze_threshold(total_rows):
+    return ANALYZE_BASE_THRESHOLD + ANALYZE_SCALE_FACTOR * total_rows
+
+
+def _total_rows(cursor):
+    cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = 'products'::regclass;")
+    return max(int(cursor.fetchone()[0]), 0)
+
+
+# --- 4. ANALYZE ---
+def analyze_filter_columns(cursor, columns=FILTER_COLUMNS, table_name=result_cache.CATALOG_TABLE):
+    """只對篩選欄位執行 ANALYZE (不取樣 768 維的 embedding，快很多)，並遞增 stats_version。"""
+    cursor.execute(sql.SQL("ANALYZE products ({columns});").format(
+        columns=sql.SQL(", ").join(sql.Identifier(col) for col in columns)
+    ))
+    mark_analyzed(cursor, table_name)
+
+
+def mark_analyzed(cursor, table_name=result_cache.CATALOG_TABLE):
+    """ANALYZE products 之後呼叫 (例如 finalize_database.py)：歸零變動筆數並遞增 stats_version。"""
+    _ensure_columns_once(cursor, table_name)
+    cursor.execute("""
+        UPDATE catalog_version
+        SET rows_since_analyze = 0, stats_version = stats_version + 1, analyzed_at = now()
+        WHERE table_name = %s;
+    """, (table_name,))
+
+
+def maybe_analyze(conn, force=False, table_name=result_cache.CATALOG_TABLE):
+    """
+    在寫入交易 commit 之後呼叫。變動筆數超過門檻 (或 force=True) 時 ANALYZE 篩選欄位，回傳是否有執行。
+    先在一個短交易中「認領」變動筆數 (SELECT ... FOR UPDATE 後歸零)，多個匯入程式同時呼叫時只有一個會執行 ANALYZE，
+    也不會在 ANALYZE 期間鎖住 catalog_version 這一列；ANALYZE 失敗時把認領的筆數加回去。
+    """
+    cursor = conn.cursor()
+    _ensure_columns_once(cursor, table_name)
+    threshold = 0 if force else analyze_threshold(_total_rows(cursor))
+    cursor.execute("""
+        SELECT rows_since_analyze FROM catalog_version WHERE table_name = %s FOR UPDATE;
+    """, (table_name,))
+    row = cursor.fetchone()
+    if row is None or row[0] < threshold:
+        conn.commit()
+        return False
+    cursor.execute("UPDATE catalog_version SET rows_since_analyze = 0 WHERE table_name = %s;", (table_name,))
+    conn.commit()
+
+    claimed = row[0]
+    start = time.time()
+    try:
+        analyze_filter_columns(cursor, table_name=table_name)
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        record_modified_rows(cursor, claimed, table_name)
+        conn.commit()
+        raise
+    logger.info("ANALYZE products (%s)：上次之後變動 %s 筆，%.2f 秒",
+                ", ".join(FILTER_COLUMNS), claimed, time.time() - start)
+    return True
+
+
+# --- 5. 狀態 ---
+def print_status():
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_SETTINGS)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT rows_since_analyze, stats_version, analyzed_at
+            FROM catalog_version WHERE table_name = %s;
+        """, (result_cache.CATALOG_TABLE,))
+        row = cursor.fetchone()
+        total_rows = _total_rows(cursor)
+        cursor.execute("""
+            SELECT attname, attstattarget FROM pg_attribute
+            WHERE attrelid = 'products'::regclass AND attname = ANY(%s);
+        """, (list(FILTER_COLUMNS),))
+        targets = dict(cursor.fetchall())
+        cursor.execute("""
+            SELECT last_analyze, last_autoanalyze, n_mod_since_analyze
+            FROM pg_stat_user_tables WHERE relid = 'products'::regclass;
+        """)
+        pg_row = cursor.fetchone()
+        conn.commit()
+
+        rows_since, stats_version, analyzed_at = row if row else (0, 0, None)
+        print(f"📊 products 約 {total_rows} 筆；上次 ANALYZE 之後變動 {rows_since} 筆 "
+              f"(門檻 {analyze_threshold(total_rows):.0f} 筆)；stats_version {stats_version}，上次 {analyzed_at}")
+        if pg_row:
+            print(f"   pg_stat_user_tables：last_analyze={pg_row[0]}，last_autoanalyze={pg_row[1]}，"
+                  f"n_mod_since_analyze={pg_row[2]}")
+        for column in FILTER_COLUMNS:
+            target = targets.get(column)
+            # attstattarget = -1 (或 NULL) 代表使用 default_statistics_target
+            label = "預設" if target is None or target < 0 else target
+            print(f"   {column}: 統計目標 {label}")
+    except Exception as e:
+        print(f"❌ 錯誤: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+
+# --- 主程式區塊 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="依資料變動量自動 ANALYZE")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("init", help="新增 catalog_version 的統計欄位並設定統計目標")
+    sub.add_parser("status", help="顯示變動筆數、stats_version 與統計目標")
+    sub.add_parser("analyze", help="立即 ANALYZE 篩選欄位")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "status":
+        print_status()
+    else:
+        conn = None
+        try:
+            conn = psycopg2.connect(**DB_SETTINGS)
+            cursor = conn.cursor()
+            if args.command == "init":
+                ensure_columns(cursor)
+                apply_statistics_targets(cursor)
+                conn.commit()
+                print("✅ 已新增統計欄位並設定統計目標：" +
+                      ", ".join(f"{col}={target}" for col, target in STATISTICS_TARGETS.items()))
+            maybe_analyze(conn, force=True)
+            print("✅ ANALYZE 完成")
+        except Exception as e:
+            print(f"❌ 錯誤: {e}")
+        finally:
+            if conn:
+                conn.close()
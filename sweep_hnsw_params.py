@@ -0,0 +1,271 @@
+# ---
+# 檔名：sweep_hnsw_params.py
+# 目的：(Phase 6) HNSW 建索引參數 (m / ef_construction) 的掃描工具
+# 功能：
+#   1. 把 products 的向量複製到一張暫存表 (UNLOGGED，可只抽樣一部分)，不影響正式的 idx_embedding_hnsw
+#   2. 在還沒有任何索引時，以精確掃描算出每個查詢的 Top-k 作為 Ground Truth
+#   3. 對每個 m × ef_construction 組合：建索引並記錄建置時間、索引大小 (pg_relation_size)，
+#      再對多個 hnsw.ef_search 量測查詢延遲與 recall@k
+#   4. 輸出 Pareto 前緣 (recall 越高、延遲 / 大小 / 建置時間越低越好) 與建議設定
+# 說明：
+#   finalize_database.py 的 m = 16, ef_construction = 64 只是 pgvector 的預設值；
+#   建議值可以透過 HNSW_M / HNSW_EF_CONSTRUCTION 環境變數交給 finalize_database.py 使用。
+# 執行方式：
+#   python sweep_hnsw_params.py --sample-pct 100 --queries 100 --target-recall 0.95 --out hnsw_sweep.json
+# ---
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+DB_SETTINGS = {
+    "host": os.environ.get("DB_HOST"),
+    "port": os.environ.get("DB_PORT"),
+    "user": os.environ.get("DB_USER"),
+    "password": os.environ.get("DB_PASSWORD"),
+    "database": os.environ.get("DB_NAME")
+}
+
+SCRATCH_TABLE = "hnsw_sweep_scratch"
+SCRATCH_INDEX = "idx_hnsw_sweep_scratch"
+
+M_VALUES = [8, 16, 24, 32]
+EF_CONSTRUCTION_VALUES = [32, 64, 128, 256]
+EF_SEARCH_VALUES = [20, 40, 100, 200]
+TOP_K = 20
+EF_SEARCH_MAX = 1000    # pgvector 的 hnsw.ef_search 上限
+N_QUERIES = 100
+QUERY_NOISE = 0.02
+TARGET_RECALL = 0.95
+
+
+# --- 1. 暫存表與 Ground Truth ---
+def create_scratch_table(cursor, sample_pct):
+    """複製 (或抽樣) products 的向量到 UNLOGGED 暫存表；UNLOGGED 不寫 WAL，建立與建索引都比較快。"""
+    cursor.execute(f"DROP TABLE IF EXISTS {SCRATCH_TABLE};")
+    sample_clause = f"TABLESAMPLE SYSTEM ({float(sample_pct)})" if sample_pct < 100 else ""
+    cursor.execute(f"""
+        CREATE UNLOGGED TABLE {SCRATCH_TABLE} AS
+        SELECT uniq_id, embedding FROM products {sample_clause}
+        WHERE embedding IS NOT NULL;
+    """)
+    cursor.execute(f"ANALYZE {SCRATCH_TABLE};")
+    cursor.execute(f"SELECT COUNT(*) FROM {SCRATCH_TABLE};")
+    return cursor.fetchone()[0]
+
+
+def sample_queries(cursor, n_queries, noise=QUERY_NOISE, seed=0):
+    """抽樣暫存表中的向量，加上雜訊並重新正規化後作為查詢向量 (pgvector 文字格式)。"""
+    cursor.execute(f"SELECT embedding::text FROM {SCRATCH_TABLE} ORDER BY md5(uniq_id) LIMIT %s;", (n_queries,))
+    rng = np.random.default_rng(seed)
+    queries = []
+    for (text,) in cursor.fetchall():
+        vec = np.array(json.loads(text), dtype=np.float64)
+        if noise > 0:
+            vec = vec + rng.normal(0, noise, size=vec.shape)
+        queries.append(str((vec / np.linalg.norm(vec)).tolist()))
+    return queries
+
+
+def _top_k_ids(cursor, query_vec, k):
+    cursor.execute(
+        f"SELECT uniq_id FROM {SCRATCH_TABLE} ORDER BY embedding <=> %s LIMIT %s;",
+        (query_vec, k)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def exact_ground_truth(cursor, queries, k):
+    """在暫存表還沒有索引時執行，ORDER BY 必定是精確的循序掃描。"""
+    return [_top_k_ids(cursor, query_vec, k) for query_vec in queries]
+
+
+# --- 2. 建索引與量測 ---
+def build_index(cursor, m, ef_construction):
+    cursor.execute(f"DROP INDEX IF EXISTS {SCRATCH_INDEX};")
+    start = time.perf_counter()
+    cursor.execute(f"""
+        CREATE INDEX {SCRATCH_INDEX} ON {SCRATCH_TABLE}
+        USING HNSW (embedding vector_cosine_ops)
+        WITH (m = {int(m)}, ef_construction = {int(ef_construction)});
+    """)
+    build_s = time.perf_counter() - start
+    cursor.execute("SELECT pg_relation_size(%s::regclass);", (SCRATCH_INDEX,))
+    return build_s, cursor.fetchone()[0]
+
+
+def effective_ef_search(ef_search, k):
+    """實際使用的 ef_search：至少 k (才拿得到 k 筆)，但不超過 pgvector 的上限。"""
+    return min(max(ef_search, k), EF_SEARCH_MAX)
+
+
+def measure_queries(cursor, queries, truth, k, ef_search):
+    cursor.execute("SET hnsw.ef_search = %s;", (effective_ef_search(ef_search, k),))
+    latencies, recalls = [], []
+    for query_vec, truth_ids in zip(queries, truth):
+        start = time.perf_counter()
+        ids = _top_k_ids(cursor, query_vec, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        if truth_ids:
+            recalls.append(len(set(ids) & set(truth_ids)) / len(truth_ids))
+    return {
+        "p50_latency_ms": float(np.percentile(latencies, 50)),
+        "p95_latency_ms": float(np.percentile(latencies, 95)),
+        "mean_recall": float(np.mean(recalls)) if recalls else 0.0,
+    }
+
+
+# --- 3. Pareto 前緣與建議值 ---
+def pareto_front(rows):
+    """
+    回傳不被其他設定「支配」的設定：recall 不低於、且延遲 / 索引大小 / 建置時間都不高於，並至少一項嚴格更好。
+    """
+    def dominates(a, b):
+        no_worse = (a["mean_recall"] >= b["mean_recall"] and a["p50_latency_ms"] <= b["p50_latency_ms"]
+                    and a["index_bytes"] <= b["index_bytes"] and a["build_s"] <= b["build_s"])
+        better = (a["mean_recall"] > b["mean_recall"] or a["p50_latency_ms"] < b["p50_latency_ms"]
+                  or a["index_bytes"] < b["index_bytes"] or a["build_s"] < b["build_s"])
+        return no_worse and better
+    return [row for row in rows if not any(dominates(other, row) for other in rows if other is not row)]
+
+
+def recommend(rows, target_recall):
+    """
+    在達到 target_recall 的設定中，選 P50 延遲最低者 (延遲差距 10% 以內時選索引較小者)；
+    都達不到時選 recall 最高者。
+    """
+    qualified = [row for row in rows if row["mean_recall"] >= target_recall]
+    if not qualified:
+        return max(rows, key=lambda row: (row["mean_recall"], -row["p50_latency_ms"]))
+    fastest = min(row["p50_latency_ms"] for row in qualified)
+    near_fastest = [row for row in qualified if row["p50_latency_ms"] <= fastest * 1.10]
+    return min(near_fastest, key=lambda row: (row["index_bytes"], row["build_s"]))
+
+
+def print_table(title, rows):
+    print("\n" + "=" * 86)
+    print(title)
+    print("=" * 86)
+    print(f"{'m':>4} | {'ef_constr':>9} | {'ef_search':>9} | {'建置 (s)':>9} | {'索引 (MB)':>10} | "
+          f"{'recall':>7} | {'P50 (ms)':>9} | {'P95 (ms)':>9}")
+    print("-" * 86)
+    for row in rows:
+        print(f"{row['m']:>4} | {row['ef_construction']:>9} | {row['ef_search']:>9} | {row['build_s']:>9.1f} | "
+              f"{row['index_bytes'] / 1024 / 1024:>10.1f} | {row['mean_recall']:>7.3f} | "
+              f"{row['p50_latency_ms']:>9.2f} | {row['p95_latency_ms']:>9.2f}")
+
+
+# --- 4. 主流程 ---
+def sweep(m_values, efc_values, ef_search_values, sample_pct, n_queries, k, target_recall,
+          maintenance_work_mem=None, keep_table=False):
+    conn = None
+    rows = []
+    failed = []
+    aborted = False
+    try:
+        conn = psycopg2.connect(**DB_SETTINGS)
+        conn.autocommit = True
+        cursor = conn.cursor()
+        if maintenance_work_mem:
+            # HNSW 圖放不進 maintenance_work_mem 時建置會明顯變慢，掃描時應與正式環境設定一致
+            cursor.execute("SET maintenance_work_mem = %s;", (maintenance_work_mem,))
+
+        print(f"🚀 建立暫存表 {SCRATCH_TABLE} (抽樣 {sample_pct}%)...")
+        n_rows = create_scratch_table(cursor, sample_pct)
+        print(f"   共 {n_rows} 筆向量。")
+
+        queries = sample_queries(cursor, n_queries)
+        print(f"🔎 計算 {len(queries)} 個查詢的精確 Top-{k} (循序掃描)...")
+        truth = exact_ground_truth(cursor, queries, k)
+
+        for m in m_values:
+            for ef_construction in efc_values:
+                if ef_construction < 2 * m:
+                    # pgvector 要求 ef_construction >= 2 * m，CREATE INDEX 會直接失敗
+                    print(f"\n[m={m}, ef_construction={ef_construction}] 略過：ef_construction 必須 >= 2 * m")
+                    continue
+                try:
+                    build_s, index_bytes = build_index(cursor, m, ef_construction)
+                    print(f"\n[m={m}, ef_construction={ef_construction}] 建置 {build_s:.1f} 秒，"
+                          f"索引 {index_bytes / 1024 / 1024:.1f} MB")
+                    for ef_search in ef_search_values:
+                        stats = measure_queries(cursor, queries, truth, k, ef_search)
+                        ef_eff = effective_ef_search(ef_search, k)
+                        print(f"   ef_search={ef_eff:<5} recall={stats['mean_recall']:.3f} "
+                              f"P50={stats['p50_latency_ms']:.2f}ms")
+                        rows.append({"m": m, "ef_construction": ef_construction, "ef_search": ef_eff,
+                                     "build_s": build_s, "index_bytes": index_bytes, **stats})
+                except psycopg2.Error as e:
+                    # 單一組合失敗不影響其他組合 (連線是 autocommit，不會卡在失敗的交易中)
+                    print(f"\n[m={m}, ef_construction={ef_construction}] ❌ 失敗：{e}")
+                    failed.append({"m": m, "ef_construction": ef_construction, "error": str(e).strip()})
+
+    except Exception as e:
+        print(f"❌ 錯誤: {e}")
+        aborted = True
+    finally:
+        if conn:
+            # 不論成功與否都清掉暫存索引 / 暫存表 (UNLOGGED 表不會自己消失)
+            try:
+                if not conn.closed:
+                    cursor = conn.cursor()
+                    cursor.execute(f"DROP INDEX IF EXISTS {SCRATCH_INDEX};")
+                    if not keep_table:
+                        cursor.execute(f"DROP TABLE IF EXISTS {SCRATCH_TABLE};")
+            except psycopg2.Error as e:
+                print(f"⚠️ 無法清除暫存表 {SCRATCH_TABLE}：{e}")
+            conn.close()
+
+    if failed:
+        print(f"\n⚠️ 有 {len(failed)} 個組合失敗，以下結果不含這些組合：" +
+              ", ".join(f"m={row['m']}/ef_construction={row['ef_construction']}" for row in failed))
+    if not rows:
+        return None
+    if aborted:
+        print("⚠️ 掃描中途中斷，以下只是已完成組合的結果 (不完整)")
+
+    front = sorted(pareto_front(rows), key=lambda row: (-row["mean_recall"], row["p50_latency_ms"]))
+    print_table("📊 所有設定", rows)
+    print_table("🏆 Pareto 前緣", front)
+
+    best = recommend(rows, target_recall)
+    print("\n" + "=" * 86)
+    print(f"✅ 建議設定 (目標 recall@{k} >= {target_recall})：m = {best['m']}, "
+          f"ef_construction = {best['ef_construction']}, hnsw.ef_search = {best['ef_search']}")
+    print(f"   recall = {best['mean_recall']:.3f}, P50 = {best['p50_latency_ms']:.2f} ms, "
+          f"索引 = {best['index_bytes'] / 1024 / 1024:.1f} MB, 建置 = {best['build_s']:.1f} 秒 "
+          f"({n_rows} 筆)")
+    print(f"   套用方式：HNSW_M={best['m']} HNSW_EF_CONSTRUCTION={best['ef_construction']} "
+          f"python finalize_database.py")
+    print("=" * 86)
+    return {"n_rows": n_rows, "k": k, "target_recall": target_recall,
+            "complete": not aborted, "results": rows, "failed": failed, "pareto": front, "recommended": best}
+
+
+# --- 主程式區塊 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="掃描 HNSW 的 m / ef_construction / ef_search")
+    parser.add_argument("--m", type=int, nargs="+", default=M_VALUES)
+    parser.add_argument("--ef-construction", type=int, nargs="+", default=EF_CONSTRUCTION_VALUES)
+    parser.add_argument("--ef-search", type=int, nargs="+", default=EF_SEARCH_VALUES)
+    parser.add_argument("--sample-pct", type=float, default=100.0, help="暫存表抽樣的百分比 (TABLESAMPLE)")
+    parser.add_argument("--queries", type=int, default=N_QUERIES)
+    parser.add_argument("--k", type=int, default=TOP_K)
+    parser.add_argument("--target-recall", type=float, default=TARGET_RECALL)
+    parser.add_argument("--maintenance-work-mem", default=None, help="例如 2GB")
+    parser.add_argument("--keep-table", action="store_true", help="結束後保留暫存表")
+    parser.add_argument("--out", default=None, help="把結果寫成 JSON")
+    args = parser.parse_args()
+
+    report = sweep(args.m, args.ef_construction, args.ef_search, args.sample_pct, args.queries,
+                   args.k, args.target_recall, args.maintenance_work_mem, args.keep_table)
+    if report and args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"已寫入 {args.out}")
@@ -0,0 +1,10 @@
+# ---
+# 檔名：tests/conftest.py
+# 目的：讓測試可以直接 import 專案根目錄下的模組 (專案是平鋪的腳本，沒有套件結構)
+# 執行方式：在專案根目錄執行 python -m pytest -q
+# ---
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,100 @@
+# ---
+# 檔名：tests/test_filter_semantics.py
+# 目的：NumPy 端 (embedding_store.filter_mask) 與 bitmap 索引 (BitmapIndex.count) 的篩選結果與 SQL 相同
+# 說明：SQL 的 = / <> 區分大小寫，NULL 在兩種比較下都不成立；數值欄位的 NULL 同樣不符合任何比較。
+#       這裡以一個小型匯出檔與 bitmap 索引，對照以 SQL 三值邏輯逐列計算的預期結果。
+# ---
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("dotenv")
+
+import bitmap_index  # noqa: E402
+import embedding_store  # noqa: E402
+
+BRANDS = ["Nike", "nike", None, "Adidas", "Nike", None, "Puma"]
+PRICES = [100.0, 250.0, None, 300.0, 50.0, 75.0, 500.0]
+RATINGS = [4.5, None, 3.0, 4.0, 5.0, 2.5, 4.5]
+PRIME_FLAGS = ["Y", "N", None, "y", "N", "Y", "X"]
+
+FILTERS = [
+    "amazon_prime_y_or_n = 'Y'",
+    "amazon_prime_y_or_n <> 'Y'",
+    "amazon_prime_y_or_n = 'N'",
+    "amazon_prime_y_or_n <> 'N'",
+    "amazon_prime_y_or_n = 'y'",
+    "amazon_prime_y_or_n = 'Z'",
+    "amazon_prime_y_or_n <> 'Z'",
+    "brand = 'Nike'",
+    "brand <> 'Nike'",
+    "brand = 'Reebok'",
+    "sales_price < 200",
+    "rating <> 4.5",
+    "sales_price BETWEEN 50 AND 300 AND amazon_prime_y_or_n <> 'Y'",
+    "brand <> 'Puma' AND amazon_prime_y_or_n = 'N'",
+    "1 = 1",
+]
+
+
+def _sql_compare(row_value, op, value):
+    """SQL 三值邏輯：NULL 與任何值比較都是 UNKNOWN (不符合)。"""
+    if row_value is None:
+        return False
+    if op == "between":
+        return value[0] <= row_value <= value[1]
+    return {
+        "=": row_value == value, "<>": row_value != value, "<": row_value < value,
+        "<=": row_value <= value, ">": row_value > value, ">=": row_value >= value,
+    }[op]
+
+
+def _expected(predicates):
+    columns = {"brand": BRANDS, "sales_price": PRICES, "rating": RATINGS, "amazon_prime_y_or_n": PRIME_FLAGS}
+    return [
+        all(_sql_compare(columns[column][i], op, value) for column, op, value in predicates)
+        for i in range(len(PRICES))
+    ]
+
+
+def _floats(values):
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+@pytest.fixture
+def store(tmp_path):
+    n_rows = len(PRICES)
+    np.save(os.path.join(tmp_path, "embeddings.npy"), np.zeros((n_rows, 4), dtype=np.float32))
+    brand_vocab, prime_vocab = {}, {}
+    brand_codes = [brand_vocab.setdefault(b, len(brand_vocab)) if b is not None else -1 for b in BRANDS]
+    prime_codes = [prime_vocab.setdefault(p, len(prime_vocab)) if p is not None else -1 for p in PRIME_FLAGS]
+    np.savez(
+        os.path.join(tmp_path, "attributes.npz"),
+        uniq_id=np.array([f"id{i}" for i in range(n_rows)], dtype=object),
+        sales_price=_floats(PRICES), rating=_floats(RATINGS),
+        prime_code=np.array(prime_codes, dtype=np.int8),
+        prime_vocab=np.array(list(prime_vocab), dtype=object),
+        brand_code=np.array(brand_codes, dtype=np.int32),
+        brand_vocab=np.array(list(brand_vocab), dtype=object),
+    )
+    with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"n_rows": n_rows, "dim": 4, "dtype": "float32", "catalog_version": None}, f)
+    return embedding_store.load_store(str(tmp_path), mmap=False)
+
+
+@pytest.mark.parametrize("sql_filter", FILTERS)
+def test_filter_mask_matches_sql(store, sql_filter):
+    predicates = embedding_store.parse_sql_filter(sql_filter)
+    assert predicates is not None
+    assert embedding_store.filter_mask(store, predicates).tolist() == _expected(predicates)
+
+
+@pytest.mark.parametrize("sql_filter", FILTERS)
+def test_bitmap_count_matches_sql(sql_filter):
+    index = bitmap_index.BitmapIndex(BRANDS, _floats(PRICES), _floats(RATINGS), PRIME_FLAGS)
+    predicates = embedding_store.parse_sql_filter(sql_filter)
+    assert index.count(sql_filter) == sum(_expected(predicates))
@@ -0,0 +1,113 @@
+# ---
+# 檔名：tests/test_pagination_pool.py
+# 目的：分頁 / 串流搜尋在連線池只有 1 條連線時不會卡死
+# 說明：CBO 估計 (EXPLAIN、關鍵字計數、bitmap 重建、catalog_version) 會向連線池借連線；
+#       search_page / iter_search 若先握著一條連線再做估計，連線池滿載時每個 worker 都會卡在 semaphore。
+#       這裡以只有一條連線的假連線池，同時送出多個分頁請求，確認都能在時限內完成。
+# ---
+
+import threading
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("dotenv")
+pytest.importorskip("sentence_transformers")
+
+import cbo_proxy  # noqa: E402
+
+THREADS = 4
+TIMEOUT_S = 10.0
+
+
+class _FakeCursor:
+    def __init__(self):
+        self._rows = []
+
+    def execute(self, query, params=None):
+        self._rows = [([1], None)]   # supports_iterative_scan：不支援
+
+    def fetchone(self):
+        return self._rows[0]
+
+    def fetchall(self):
+        return []
+
+    def fetchmany(self, size):
+        return []
+
+    def close(self):
+        pass
+
+
+class _FakeConnection:
+    closed = 0
+    autocommit = False
+
+    def cursor(self, *args, **kwargs):
+        return _FakeCursor()
+
+    def rollback(self):
+        pass
+
+
+class _FakePool:
+    """只有一條連線的 ThreadedConnectionPool 替身 (同時借出第二條即為錯誤)。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_use = 0
+
+    def getconn(self):
+        with self._lock:
+            assert self.in_use == 0, "連線池只有一條連線，卻同時借出兩條"
+            self.in_use += 1
+        return _FakeConnection()
+
+    def putconn(self, conn, close=False):
+        with self._lock:
+            self.in_use -= 1
+
+
+@pytest.fixture
+def single_connection_pool(monkeypatch):
+    monkeypatch.setattr(cbo_proxy, "_pool", _FakePool())
+    monkeypatch.setattr(cbo_proxy, "_pool_slots", threading.BoundedSemaphore(1))
+
+    def estimate(sql_filter_string, limit_n=cbo_proxy.N_RESULTS):
+        # 與真正的估計一樣向連線池借一條連線 (EXPLAIN)
+        with cbo_proxy.db_connection(autocommit=True) as conn:
+            conn.cursor().execute("EXPLAIN SELECT 1;")
+        return {"plan": "PLAN_B"}
+
+    monkeypatch.setattr(cbo_proxy, "get_cbo_estimate", estimate)
+    monkeypatch.setattr(cbo_proxy, "_iterative_scan_supported", None)
+
+
+def _run_concurrently(target):
+    errors = []
+
+    def worker():
+        try:
+            target()
+        except Exception as e:  # 讓主執行緒看到失敗原因
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(TIMEOUT_S)
+    assert not any(thread.is_alive() for thread in threads), "連線池只有一條連線時分頁請求卡死"
+    assert errors == []
+
+
+def test_search_page_does_not_deadlock_with_single_connection(single_connection_pool):
+    results = []
+    _run_concurrently(lambda: results.append(cbo_proxy.search_page([0.0, 1.0], "brand = 'nike'", limit_n=5)))
+    assert len(results) == THREADS
+    assert all(page["plan"] == "PLAN_A" and page["next_cursor"] is None for page in results)
+
+
+def test_iter_search_does_not_deadlock_with_single_connection(single_connection_pool):
+    _run_concurrently(lambda: list(cbo_proxy.iter_search([0.0, 1.0], "brand = 'nike'", page_size=5)))
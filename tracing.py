@@ -0,0 +1,245 @@
+# ---
+# 檔名：tracing.py
+# 目的：(Phase 5) 每個搜尋請求的分段延遲追蹤與指標輸出
+# 功能：
+#   1. trace()：包住一個請求；stage("名稱")：量測請求中的某一段
+#      (image_encode / text_encode / slerp / sql_filter / cbo_decision / plan_execute / fetch)
+#   2. 依「計畫類型 × 階段」累積延遲直方圖
+#   3. 以 Prometheus 文字格式輸出 (render_prometheus / write_prometheus，或服務的 /metrics 端點)
+#   4. (選用) 取樣式 profiler：依 CBO_PROFILE_SAMPLE_RATE 的機率對請求開啟 cProfile，
+#      若該請求超過 CBO_SLOW_QUERY_MS，就把 profile 存到 CBO_PROFILE_DIR
+# 說明：
+#   沒有進行中的 trace 時，stage() 幾乎沒有成本，所以可以直接放在 CLI 也會走到的熱路徑上。
+# ---
+
+import contextvars
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# --- 1. 設定 ---
+# 直方圖的桶 (秒)，與 Prometheus 慣例相同以秒為單位
+BUCKETS_S = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROFILE_SAMPLE_RATE = float(os.environ.get("CBO_PROFILE_SAMPLE_RATE", "0"))
+SLOW_QUERY_MS = float(os.environ.get("CBO_SLOW_QUERY_MS", "500"))
+PROFILE_DIR = os.environ.get("CBO_PROFILE_DIR", "profiles")
+
+METRIC_PREFIX = "hybrid_search"
+
+# --- 2. 模組狀態 ---
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_lock = threading.Lock()
+_histograms = {}          # {(plan, stage): {"buckets": [...], "sum": float, "count": int}}
+_counters = {"requests": 0, "slow_requests": 0, "profiles_saved": 0}
+_slow_query_hooks = []
+_writer_thread = None
+_writer_stop = threading.Event()
+
+
+class Trace:
+    """一個請求的追蹤紀錄。plan 由呼叫端在決策後填入。"""
+
+    __slots__ = ("plan", "stages", "start", "profiler")
+
+    def __init__(self):
+        self.plan = "UNKNOWN"
+        self.stages = []
+        self.start = time.perf_counter()
+        self.profiler = None
+
+
+def _observe(plan, stage_name, seconds):
+    key = (plan, stage_name)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = {"buckets": [0] * len(BUCKETS_S), "sum": 0.0, "count": 0}
+            _histograms[key] = hist
+        for i, bound in enumerate(BUCKETS_S):
+            if seconds <= bound:
+                hist["buckets"][i] += 1
+                break
+        hist["sum"] += seconds
+        hist["count"] += 1
+
+
+@contextmanager
+def stage(name):
+    """量測目前請求中的一個階段；沒有進行中的 trace 時不做任何記錄。"""
+    trace_obj = _current_trace.get()
+    if trace_obj is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace_obj.stages.append((name, time.perf_counter() - start))
+
+
+def set_plan(plan):
+    """在目前的 trace 上標記這個請求最後使用的計畫。"""
+    trace_obj = _current_trace.get()
+    if trace_obj is not None:
+        trace_obj.plan = plan
+
+
+def add_slow_query_hook(hook):
+    """註冊慢查詢回呼：hook(trace, total_ms, profile_path_or_None)。"""
+    _slow_query_hooks.append(hook)
+
+
+def _maybe_start_profiler(trace_obj):
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # 同一時間只能有一個 profiler 在跑 (其他請求正在被取樣)，這次就略過
+        return
+    trace_obj.profiler = profiler
+
+
+def _finish(trace_obj):
+    total_s = time.perf_counter() - trace_obj.start
+    profile_path = None
+    if trace_obj.profiler is not None:
+        trace_obj.profiler.disable()
+
+    for stage_name, seconds in trace_obj.stages:
+        _observe(trace_obj.plan, stage_name, seconds)
+    _observe(trace_obj.plan, "total", total_s)
+
+    total_ms = total_s * 1000
+    with _lock:
+        _counters["requests"] += 1
+        is_slow = total_ms >= SLOW_QUERY_MS
+        if is_slow:
+            _counters["slow_requests"] += 1
+
+    if not is_slow:
+        return
+
+    if trace_obj.profiler is not None:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profile_path = os.path.join(
+            PROFILE_DIR, f"slow_{time.strftime('%Y%m%d_%H%M%S')}_{trace_obj.plan}_{int(total_ms)}ms.prof"
+        )
+        trace_obj.profiler.dump_stats(profile_path)
+        with _lock:
+            _counters["profiles_saved"] += 1
+
+    stages_text = ", ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in trace_obj.stages)
+    logger.warning("慢查詢 %.1fms (plan=%s): %s", total_ms, trace_obj.plan, stages_text)
+    for hook in _slow_query_hooks:
+        try:
+            hook(trace_obj, total_ms, profile_path)
+        except Exception:
+            logger.exception("慢查詢回呼失敗")
+
+
+@contextmanager
+def trace():
+    """
+    追蹤一個請求：
+        with tracing.trace() as t:
+            ...
+            tracing.set_plan("PLAN_A")
+    """
+    trace_obj = Trace()
+    token = _current_trace.set(trace_obj)
+    _maybe_start_profiler(trace_obj)
+    try:
+        yield trace_obj
+    finally:
+        _current_trace.reset(token)
+        _finish(trace_obj)
+
+
+# --- 3. 指標輸出 ---
+def _format_labels(labels):
+    return ",".join(f'{key}="{value}"' for key, value in labels)
+
+
+def render_prometheus(extra_gauges=None):
+    """
+    以 Prometheus 文字格式輸出所有直方圖與計數器。
+    extra_gauges: {指標名稱: 數值}，例如結果快取的命中率。
+    """
+    with _lock:
+        histograms = {key: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]}
+                      for key, h in _histograms.items()}
+        counters = dict(_counters)
+
+    name = f"{METRIC_PREFIX}_stage_latency_seconds"
+    lines = [
+        f"# HELP {name} Latency of each hybrid search stage, by chosen plan.",
+        f"# TYPE {name} histogram",
+    ]
+    for (plan, stage_name), hist in sorted(histograms.items()):
+        labels = [("plan", plan), ("stage", stage_name)]
+        cumulative = 0
+        for bound, count in zip(BUCKETS_S, hist["buckets"]):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{_format_labels(labels + [("le", bound)])}}} {cumulative}')
+        lines.append(f'{name}_bucket{{{_format_labels(labels + [("le", "+Inf")])}}} {hist["count"]}')
+        lines.append(f"{name}_sum{{{_format_labels(labels)}}} {hist['sum']:.6f}")
+        lines.append(f"{name}_count{{{_format_labels(labels)}}} {hist['count']}")
+
+    for counter_name, value in sorted(counters.items()):
+        metric = f"{METRIC_PREFIX}_{counter_name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+
+    for gauge_name, value in sorted((extra_gauges or {}).items()):
+        metric = f"{METRIC_PREFIX}_{gauge_name}"
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, extra_gauges=None):
+    """原子性地寫入 Prometheus 文字檔 (給 node_exporter 的 textfile collector 讀取)。"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render_prometheus(extra_gauges))
+    os.replace(tmp_path, path)
+
+
+def start_metrics_writer(path, interval_s=15.0, extra_gauges_fn=None):
+    """背景執行緒每 interval_s 秒寫一次指標檔。"""
+    global _writer_thread
+    if _writer_thread is not None and _writer_thread.is_alive():
+        return
+
+    def _loop():
+        while not _writer_stop.wait(interval_s):
+            try:
+                write_prometheus(path, extra_gauges_fn() if extra_gauges_fn else None)
+            except Exception:
+                logger.exception("寫入指標檔失敗")
+
+    _writer_stop.clear()
+    _writer_thread = threading.Thread(target=_loop, name="metrics-writer", daemon=True)
+    _writer_thread.start()
+
+
+def stop_metrics_writer():
+    _writer_stop.set()
+
+
+def reset():
+    """清除所有累積的指標 (benchmark 每一輪開始前使用)。"""
+    with _lock:
+        _histograms.clear()
+        for key in _counters:
+            _counters[key] = 0
@@ -0,0 +1,230 @@
+# ---
+# 檔名：warmup.py
+# 目的：(Phase 6) 冷啟動預熱：服務啟動 (或 Postgres 重啟 / failover) 後，先把「第一個查詢」要付的代價付掉
+# 功能：
+#   1. pg_prewarm：把 HNSW 索引 idx_embedding_hnsw 與常用篩選欄位的索引讀進 shared_buffers
+#      (分片模式下每個分片各做一次)；設 CBO_PREWARM_HEAP=1 時連 products 表本身也讀進來
+#   2. 模型預熱：以假圖片與假文字各 encode 一次，讓 CLIP 的延遲初始化 (kernel 選擇、記憶體配置) 在啟動時完成
+#   3. 連線池預熱：同時借出 N 條連線並各執行一次 SELECT 1，連線池裡的連線都先建立好 (含 TLS / 認證)
+#   4. 載入程序內的引擎 (NumPy 計畫 A、IVF 索引，有啟用時)
+#   5. 印出每個步驟的耗時與總耗時 (time-to-ready)；服務啟動時另外輸出成 /metrics 的 gauge
+# 說明：
+#   Postgres 重啟後 shared_buffers 是空的，前幾個計畫 B 查詢要從磁碟一頁一頁讀 HNSW 圖 (隨機 I/O)，
+#   再加上 CLIP 第一次 encode 的初始化，第一個查詢常常要好幾秒。部署與 failover 時這個延遲斷崖很明顯。
+#   pg_prewarm 需要 CREATE EXTENSION 的權限；沒有權限時跳過這一步 (只印出警告)，其他步驟照常進行。
+# 執行方式：
+#   python warmup.py                       (Postgres 重啟後單獨執行，預熱資料庫並量測模型初始化時間)
+#   python warmup.py --no-model --pool 0   (只預熱資料庫)
+#   python search_server.py --warmup       (服務啟動時預熱，完成後才開始接受請求)
+# ---
+
+import argparse
+import logging
+import os
+import time
+from contextlib import ExitStack
+
+import psycopg2
+from PIL import Image
+
+import cbo_proxy
+import ivf_index
+import numpy_engine
+import query_parser
+import sharding
+
+logger = logging.getLogger(__name__)
+
+# --- 1. 設定 ---
+# 要預熱的索引 (不存在的會略過，例如還沒執行 finalize_database.py 時沒有 HNSW 索引)
+PREWARM_INDEXES = (
+    "idx_embedding_hnsw",
+    "idx_brand",
+    "idx_sales_price",
+    "idx_rating",
+    "idx_amazon_prime",
+    "idx_product_name_trgm",
+)
+# 計畫 B 取回候選之後要讀 products 的資料頁；表很大時會把索引擠出 shared_buffers，預設不預熱
+PREWARM_HEAP = os.environ.get("CBO_PREWARM_HEAP", "0") == "1"
+# pg_prewarm 的模式：buffer (讀進 shared_buffers) / read (讀進 OS 快取) / prefetch (非同步預讀)
+PREWARM_MODE = os.environ.get("CBO_PREWARM_MODE", "buffer")
+
+DUMMY_IMAGE_SIZE = (224, 224)
+DUMMY_TEXT = "red color"
+
+# 最近一次 run_warmup 的結果 (gauges() 使用)
+_last_report = None
+
+
+# --- 2. 資料庫預熱 ---
+def prewarm_relations(cursor, relations, mode=PREWARM_MODE):
+    """
+    以 pg_prewarm 讀入指定的索引 / 表，回傳 [(名稱, 讀入的頁數, 耗時秒數)]；不存在的關聯略過。
+    """
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_prewarm;")
+    results = []
+    for name in relations:
+        # 只找與 products 同一個 schema 的關聯：分片的 search_path 是「分片 schema, public」，
+        # 用 to_regclass 在分片還沒有這個索引時會落到 public 的同名索引
+        cursor.execute("""
+            SELECT c.oid FROM pg_class c
+            WHERE c.relname = %s
+              AND c.relnamespace = (SELECT relnamespace FROM pg_class WHERE oid = 'products'::regclass);
+        """, (name,))
+        row = cursor.fetchone()
+        if row is None:
+            logger.warning("找不到 %s，略過預熱", name)
+            continue
+        start = time.perf_counter()
+        cursor.execute("SELECT pg_prewarm(%s::regclass, %s);", (row[0], mode))
+        blocks = cursor.fetchone()[0]
+        results.append((name, blocks, time.perf_counter() - start))
+    return results
+
+
+def prewarm_database(relations=None):
+    """
+    預熱主資料庫 (分片模式下改為每個分片)，回傳 {資料庫名稱: [(名稱, 頁數, 秒數)]}。
+    沒有權限建立 pg_prewarm 擴充等錯誤只記錄警告，不中斷預熱。
+    """
+    relations = list(relations or PREWARM_INDEXES)
+    if PREWARM_HEAP:
+        relations.append("products")
+
+    config = sharding.get_config()
+    targets = [(shard["name"], shard["settings"]) for shard in config["shards"]] if config else [(None, None)]
+    results = {}
+    for name, settings in targets:
+        label = name or cbo_proxy.DB_SETTINGS["database"]
+        try:
+            with ExitStack() as stack:
+                if name is not None:
+                    stack.enter_context(cbo_proxy.use_shard(name, settings))
+                with cbo_proxy.db_connection(autocommit=True) as conn:
+                    results[label] = prewarm_relations(conn.cursor(), relations)
+        except psycopg2.Error as e:
+            logger.warning("%s 的 pg_prewarm 失敗，略過：%s", label, e)
+            results[label] = []
+    return results
+
+
+def prime_pool(n_connections):
+    """
+    同時借出 n_connections 條連線並各執行一次 SELECT 1 (依序借用只會重複拿到同一條)。
+    n_connections 不可超過連線池的 maxconn，否則會卡在 semaphore。回傳實際借出的連線數。
+    """
+    config = sharding.get_config()
+    targets = [(shard["name"], shard["settings"]) for shard in config["shards"]] if config else [(None, None)]
+    primed = 0
+    for name, settings in targets:
+        with ExitStack() as stack:
+            if name is not None:
+                stack.enter_context(cbo_proxy.use_shard(name, settings))
+            for _ in range(n_connections):
+                conn = stack.enter_context(cbo_proxy.db_connection(autocommit=True))
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1;")
+                primed += 1
+    return primed
+
+
+# --- 3. 模型與程序內引擎 ---
+def warm_model():
+    """以假圖片與假文字各 encode 一次，回傳 (圖片秒數, 文字秒數)；模型未載入時回傳 None。"""
+    if query_parser.model is None:
+        logger.warning("AI 模型未載入，略過模型預熱")
+        return None
+    image = Image.new("RGB", DUMMY_IMAGE_SIZE, color=(128, 128, 128))
+    start = time.perf_counter()
+    query_parser.model.encode(image, normalize_embeddings=True)
+    image_s = time.perf_counter() - start
+    start = time.perf_counter()
+    query_parser.model.encode(DUMMY_TEXT, normalize_embeddings=True)
+    text_s = time.perf_counter() - start
+    return image_s, text_s
+
+
+def load_engines():
+    """載入有啟用的程序內引擎 (NumPy 計畫 A、IVF 索引)，回傳已載入的名稱。"""
+    loaded = []
+    if cbo_proxy.PLAN_A_BACKEND == "numpy" and numpy_engine.get_engine() is not None:
+        loaded.append("numpy_engine")
+    if cbo_proxy.ENABLE_IVF and ivf_index.get_index() is not None:
+        loaded.append("ivf_index")
+    return loaded
+
+
+# --- 4. 主流程 ---
+def run_warmup(pool_connections=0, prewarm=True, model=True):
+    """
+    依序執行各預熱步驟並印出耗時，回傳 {"steps": {步驟: 秒數}, "time_to_ready_s": 總秒數}。
+    pool_connections：要預先建立的連線數 (服務啟動時傳入連線池大小；0 表示不預熱連線池)。
+    """
+    global _last_report
+    steps = {}
+    total_start = time.perf_counter()
+    print("[Warmup] 開始預熱...")
+
+    if pool_connections > 0:
+        start = time.perf_counter()
+        try:
+            primed = prime_pool(pool_connections)
+            steps["pool"] = time.perf_counter() - start
+            print(f"[Warmup]   連線池：建立 {primed} 條連線，{steps['pool']:.2f} 秒")
+        except psycopg2.Error as e:
+            print(f"[Warmup]   ❌ 連線池預熱失敗：{e}")
+
+    if prewarm:
+        start = time.perf_counter()
+        results = prewarm_database()
+        steps["prewarm"] = time.perf_counter() - start
+        for label, relations in results.items():
+            for name, blocks, seconds in relations:
+                print(f"[Warmup]   pg_prewarm {label}.{name}：{blocks} 頁 "
+                      f"({blocks * 8 / 1024:.1f} MB)，{seconds:.2f} 秒")
+        print(f"[Warmup]   資料庫預熱合計 {steps['prewarm']:.2f} 秒")
+
+    if model:
+        start = time.perf_counter()
+        timings = warm_model()
+        if timings is not None:
+            steps["model"] = time.perf_counter() - start
+            print(f"[Warmup]   模型：圖片 encode {timings[0]:.2f} 秒，文字 encode {timings[1]:.2f} 秒")
+
+    start = time.perf_counter()
+    loaded = load_engines()
+    if loaded:
+        steps["engines"] = time.perf_counter() - start
+        print(f"[Warmup]   載入 {', '.join(loaded)}：{steps['engines']:.2f} 秒")
+
+    report = {"steps": steps, "time_to_ready_s": time.perf_counter() - total_start}
+    _last_report = report
+    print(f"[Warmup] ✅ 預熱完成，time-to-ready {report['time_to_ready_s']:.2f} 秒")
+    return report
+
+
+def gauges():
+    """把最近一次預熱的耗時輸出成 Prometheus gauge (尚未預熱時回傳空的 dict)。"""
+    if _last_report is None:
+        return {}
+    result = {"warmup_time_to_ready_seconds": _last_report["time_to_ready_s"]}
+    for step, seconds in _last_report["steps"].items():
+        result[f"warmup_{step}_seconds"] = seconds
+    return result
+
+
+# --- 主程式區塊 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="冷啟動預熱：pg_prewarm + 模型 + 連線")
+    parser.add_argument("--no-prewarm", action="store_true", help="不執行 pg_prewarm")
+    parser.add_argument("--no-model", action="store_true", help="不預熱 CLIP 模型")
+    parser.add_argument("--pool", type=int, default=1,
+                        help="預先建立的連線數 (單獨執行時只用來確認資料庫可連線；0 表示略過)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        run_warmup(pool_connections=args.pool, prewarm=not args.no_prewarm, model=not args.no_model)
+    except Exception as e:
+        print(f"❌ 錯誤: {e}")